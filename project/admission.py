@@ -0,0 +1,123 @@
+"""
+Admission control of Command Channel connections - bounded pool of threads running sessions, limits of sessions per
+client address and per user and counters of admitted, queued and rejected connections.
+"""
+import queue
+import threading
+from collections import Counter
+from typing import Callable, Dict
+
+# Defaults of server options, 0 disables a per-address or per-user limit
+MAX_SESSIONS = 64
+SESSION_QUEUE = 64
+LISTEN_BACKLOG = 128
+MAX_PER_ADDRESS = 16
+MAX_PER_USER = 8
+# Seconds a connection may take to finish TLS handshake and send credentials
+LOGIN_TIMEOUT = 10
+# Threads answering rejected connections and number of rejected connections waiting for them, further ones are closed
+REJECT_WORKERS = 2
+REJECT_QUEUE = 64
+
+# Status sent instead of "OK" to a connection over limits
+BUSY = 'BUSY'
+
+
+class WorkerPool:
+    """
+    Fixed number of threads running submitted calls. Calls waiting for a free thread are queued, up to queue_size of
+    them, further calls are refused - a burst of clients never creates more threads than there are workers.
+    """
+
+    def __init__(self, workers: int, queue_size: int, name: str):
+        self.queue = queue.Queue(max(1, queue_size))
+        self.peak_depth = 0
+        for i in range(max(1, workers)):
+            threading.Thread(target=self.work, name=f'{name}-{i}', daemon=True).start()
+
+    def submit(self, function: Callable, *args) -> bool:
+        """
+        Queues call, returns False if queue is full.
+        """
+        try:
+            self.queue.put_nowait((function, args))
+        except queue.Full:
+            return False
+        self.peak_depth = max(self.peak_depth, self.queue.qsize())
+        return True
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def work(self) -> None:
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print(f'Exception occurred in {threading.current_thread().name}!\n{e}')
+
+
+class SessionLimits:
+    """
+    Counts sessions per client address and per logged in user. Thread-safe. Each worker process of asyncio engine
+    has its own counts.
+    """
+
+    def __init__(self, max_per_address: int = MAX_PER_ADDRESS, max_per_user: int = MAX_PER_USER):
+        self.max_per_address = max_per_address
+        self.max_per_user = max_per_user
+        self.addresses = Counter()
+        self.users = Counter()
+        self.admitted = 0
+        self.rejected = 0
+        self.mutex = threading.Lock()
+
+    def enter_address(self, host: str) -> bool:
+        with self.mutex:
+            if self.max_per_address and self.addresses[host] >= self.max_per_address:
+                self.rejected += 1
+                return False
+            self.addresses[host] += 1
+            return True
+
+    def leave_address(self, host: str) -> None:
+        with self.mutex:
+            SessionLimits.leave(self.addresses, host)
+
+    def enter_user(self, name: bytes) -> bool:
+        with self.mutex:
+            if self.max_per_user and self.users[name] >= self.max_per_user:
+                self.rejected += 1
+                return False
+            self.users[name] += 1
+            return True
+
+    def leave_user(self, name: bytes) -> None:
+        with self.mutex:
+            SessionLimits.leave(self.users, name)
+
+    def admit(self) -> None:
+        """
+        Counts connection which got a session slot.
+        """
+        with self.mutex:
+            self.admitted += 1
+
+    def reject(self) -> None:
+        """
+        Counts connection rejected for other reason than its address, e.g. full queue.
+        """
+        with self.mutex:
+            self.rejected += 1
+
+    @staticmethod
+    def leave(counter: Counter, key) -> None:
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self.mutex:
+            return {'connections': sum(self.addresses.values()), 'users': sum(self.users.values()),
+                    'admitted': self.admitted, 'rejected': self.rejected}
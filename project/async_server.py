@@ -0,0 +1,589 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from functools import partial
+from typing import AsyncIterator, BinaryIO, Callable, Coroutine, List, Optional, Tuple
+
+from server import COMMANDS, TRANSFER_COMMANDS, Server
+from ciphers import DEFAULT_CIPHER, Encryptor, Decryptor, choose_cipher, make_encryptor, make_decryptor
+from transfer import MAX_FRAME_LENGTH, async_send_file_striped, async_receive_file_striped, \
+    async_send_batch_striped, async_receive_batch_striped, complete_partial
+from mux import AsyncDataChannel, abandon_streams
+from delta import async_send_delta, async_receive_delta
+from hash_index import HashingFile
+from passive import AsyncPassivePorts, split_ports
+from sessions import Session
+from admission import LOGIN_TIMEOUT, BUSY
+from metrics import Metrics, SessionMetrics, start_reporting, worker_targets
+from compression import Decompressor
+from codec import encode_message, decode_message
+from framing import MAX_MESSAGE_LENGTH, async_send_frame, async_receive_frame
+
+DataConnection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class AsyncServer:
+    """
+    Event loop engine of simple FTP server. Command Channel and Data Channel of each session are handled by
+    coroutines instead of threads. One event loop runs in each worker process, workers share listening socket.
+    Protocol and command semantics are the same as in the threaded engine.
+    """
+
+    def __init__(self, server: Server, workers: int):
+        self.server = server
+        self.host = server.host
+        self.port = server.port
+        self.workers = max(1, workers)
+        # Session slots of worker's event loop, created by serve(), and connections waiting for one
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.queued = 0
+        self.peak_queued = 0
+        # Passive mode Data Channel listeners of worker, created by serve()
+        self.passive: Optional[AsyncPassivePorts] = None
+        # Index of worker process, set by run_worker()
+        self.index = 0
+
+    @staticmethod
+    async def send_object_message(writer: asyncio.StreamWriter, message: object) -> None:
+        """
+        Serializes and sends 1 object message.
+        Sends header with message length.
+        """
+        await async_send_frame(writer, encode_message(message))
+
+    @staticmethod
+    async def receive_object_message(reader: asyncio.StreamReader) -> Optional[dict]:
+        """
+        Receives 1 object message and deserialize it.
+        """
+        try:
+            message = await async_receive_frame(reader, MAX_MESSAGE_LENGTH)
+            return decode_message(message)
+
+        except asyncio.IncompleteReadError:
+            print('Failed to receive message!')
+            return None
+
+        except Exception as e:
+            print(f'Exception occurred during receiving a message!\n{e}')
+            return None
+
+    def run(self) -> None:
+        """
+        Binds Command Channel socket and starts worker processes, each serving connections with its own event loop.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, self.port))
+        sock.listen(self.server.backlog)
+        sock.setblocking(False)
+        split_ports(self.server.passive_ports, self.workers, 0)  # Fail early if range is too small
+        print(f'Server listening on {self.host}:{self.port} (asyncio engine, {self.workers} worker(s))')
+
+        # Processes inherit listening socket, so fork is needed to run more than one worker
+        if self.workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            self.run_worker(sock, 0, 1)
+            return
+
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=self.run_worker, args=(sock, i, self.workers), daemon=True)
+                   for i in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        # Make sure workers do not outlive the parent when it is terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in workers:
+                worker.terminate()
+            sock.close()
+
+    def run_worker(self, sock: socket.socket, index: int, workers: int) -> None:
+        self.index = index
+        # Threads of reporting are started in worker, forked processes do not inherit them
+        stats_port, stats_file = worker_targets(self.server.stats_port, self.server.stats_file, index, workers)
+        start_reporting(self.stats, stats_port, stats_file, self.server.stats_interval)
+        self.server.hash_index.start_saving()
+        if self.server.profiler:
+            # Sessions of worker share thread of its event loop, so CPU is profiled for the whole worker
+            self.server.profiler.profile_process()
+        try:
+            asyncio.run(self.serve(sock, split_ports(self.server.passive_ports, workers, index)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.hash_index.save()
+
+    async def serve(self, sock: socket.socket, passive_ports: List[int]) -> None:
+        self.passive = AsyncPassivePorts(self.host, passive_ports, self.server.backlog)
+        await self.passive.start()
+        self.slots = asyncio.Semaphore(max(1, self.server.max_sessions))
+        server = await asyncio.start_server(self.admit_connection, sock=sock, ssl=Server.make_tls_context(),
+                                            ssl_handshake_timeout=LOGIN_TIMEOUT)
+        async with server:
+            await server.serve_forever()
+
+    def admission_stats(self) -> dict:
+        """
+        Returns counts of sessions and connections admitted, queued and rejected by this worker.
+        """
+        stats = self.server.limits.stats()
+        stats.update(queued=self.queued, peak_queued=self.peak_queued)
+        return stats
+
+    def stats(self) -> dict:
+        """
+        Returns metrics of sessions of this worker together with its admission counts. Called from thread of stats
+        endpoint, so it reads only counters safe to read outside of event loop.
+        """
+        return {'engine': 'asyncio', 'worker': self.index, 'admission': self.admission_stats(),
+                'throttle': self.server.throttles.stats(), **self.server.metrics.snapshot()}
+
+    async def admit_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves connection once a session slot is free. Connections over limits are answered with "BUSY" status.
+        """
+        address = writer.get_extra_info('peername')
+        print(f'Connection from {address}')
+        limits = self.server.limits
+        if not limits.enter_address(address[0]):
+            await self.refuse_session(reader, writer, address, 'too many sessions from address')
+            return
+
+        try:
+            if self.slots.locked() and self.queued >= self.server.session_queue:
+                limits.reject()
+                await self.refuse_session(reader, writer, address, 'session queue is full')
+                return
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            try:
+                await self.slots.acquire()
+            finally:
+                self.queued -= 1
+            limits.admit()
+            try:
+                await self.handle_connection(reader, writer, address)
+            finally:
+                self.slots.release()
+        finally:
+            limits.leave_address(address[0])
+
+    async def refuse_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                             address: Tuple[str, int], reason: str) -> None:
+        print(f'Connection from {address} rejected: {reason} {self.admission_stats()}')
+        try:
+            if await asyncio.wait_for(AsyncServer.receive_object_message(reader), LOGIN_TIMEOUT) is not None:
+                await AsyncServer.send_object_message(writer, {'status': BUSY})
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f'Could not answer rejected connection from {address}\n{e}')
+        finally:
+            writer.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                address: Tuple[str, int]) -> None:
+        """
+        Handles connection with individual client, manages Command Channel, starts task handling Data Channel.
+        """
+        # Authenticate user
+        login = await self.authenticate_user(reader, writer)
+        if not login:
+            print(f'User authentication from {address} failed!')
+            print(f'Connection with {address} closed')
+            writer.close()
+            return
+
+        user_credentials, session = login
+        print(f'User authentication from {address} successful{" (session resumed)" if session else ""}!')
+        try:
+            await self.serve_session(reader, writer, address, user_credentials, session)
+        finally:
+            self.server.limits.leave_user(user_credentials['name'])
+
+    async def serve_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                            address: Tuple[str, int], user_credentials: dict, session: Optional[Session]) -> None:
+        """
+        Serves session of logged in user.
+        """
+        # Agree on Data Channel
+        data_channel = await self.agree_on_data_channel(reader, writer, address, session)
+        if not data_channel:
+            print(f'Failed to establish Data Channel connection with {address}')
+            print(f'Connection with {address} closed')
+            writer.close()
+            return
+
+        data_conns, key, iv, cipher = data_channel
+        ports = [data_writer.get_extra_info('sockname')[1] for _, data_writer in data_conns]
+        print(f'Data channel established with {address} on port(s) {ports} using {cipher}')
+
+        # Client may reconnect later with the ticket instead of logging in and agreeing on keys again
+        try:
+            await AsyncServer.send_object_message(writer, {'ticket': self.server.issue_ticket(user_credentials, cipher,
+                                                                                              key, iv)})
+        except OSError as e:
+            print(f'Exception occurred during sending session ticket to {address}\n{e}')
+
+        # Start tasks receiving frames of all transfers of the session, one per connection
+        throttle = self.server.throttles.open_session(user_credentials['name'])
+        channels = [AsyncDataChannel(data_reader, data_writer, MAX_FRAME_LENGTH, throttle)
+                    for data_reader, data_writer in data_conns]
+        data_tasks = [asyncio.create_task(channel.run()) for channel in channels]
+
+        # Listen for new commands from user, verify and respond to them
+        metrics = self.server.metrics.open_session(address, user_credentials['name'].decode('utf-8', 'replace'))
+        metrics.channels = channels
+        if self.server.profiler:
+            metrics.profile = self.server.profiler.session(f'{metrics.user}-{address[0]}-{address[1]}')
+        try:
+            await self.handle_commands(reader, writer, address, channels, key, iv, cipher, metrics)
+            await asyncio.gather(*data_tasks)
+        finally:
+            self.server.throttles.close_session(throttle)
+            self.server.metrics.close_session(metrics)
+            if metrics.profile:
+                # Writing profiles blocks, but only sessions being profiled
+                metrics.profile.close()
+
+    async def authenticate_user(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> \
+            Optional[Tuple[dict, Optional[Session]]]:
+        """
+        Handles user authentication by comparing hash received from user with hashes stored in authentication file.
+        Returns credentials of authenticated user and session resumed with ticket, None if authentication failed.
+        """
+        try:
+            user_credentials = await asyncio.wait_for(AsyncServer.receive_object_message(reader), LOGIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print('Client did not log in in time!')
+            return None
+        if not user_credentials:
+            return None
+
+        try:
+            # Password hash is verified with a deliberately slow KDF, so it must not block event loop
+            status, session = await asyncio.get_running_loop().run_in_executor(None, self.server.log_in,
+                                                                               user_credentials)
+        except Exception as e:
+            print(f'Exception occurred during user authentication!\n{e}')
+            return None
+
+        logged_in = status in ('OK', 'RESUMED')
+        try:
+            await AsyncServer.send_object_message(writer, {'status': status})
+        except Exception as e:
+            print(f'Exception occurred during user authentication!\n{e}')
+            if logged_in:
+                self.server.limits.leave_user(user_credentials['name'])
+            return None
+        return (user_credentials, session) if logged_in else None
+
+    async def agree_on_data_channel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                    address: Tuple[str, int], session: Optional[Session] = None) -> \
+            Optional[Tuple[List[DataConnection], bytes, bytes, str]]:
+        """
+        Negotiates Data Channel - connection mode, number of connections and cipher used for file transfers.
+        Cipher and keys of resumed session are kept.
+        """
+        await AsyncServer.send_object_message(writer, {'mode': 'ready'})
+        connection_mode_message = await AsyncServer.receive_object_message(reader)
+        try:
+            if session:
+                cipher = session.cipher
+            else:
+                try:
+                    cipher = choose_cipher(connection_mode_message.get('ciphers', [DEFAULT_CIPHER]),
+                                           self.server.ciphers)
+                except ValueError as e:
+                    # Client is told which ciphers server accepts, e.g. when it offers only unencrypted one
+                    await AsyncServer.send_object_message(writer, {'ERR': str(e), 'ciphers': self.server.ciphers})
+                    raise
+            connections = Server.choose_connections(connection_mode_message)
+            await AsyncServer.send_object_message(writer, {'cipher': cipher, 'connections': connections})
+
+            if connection_mode_message['mode'] == 'p':
+                data_channel = await self.connect_data_channel_passive(writer, connections, session)
+            elif connection_mode_message['mode'] == 'a':
+                data_channel = await self.connect_data_channel_active(reader, writer, connections, session)
+            else:
+                raise Exception('Client sent invalid Data Channel connection mode argument!')
+
+            if not data_channel:
+                return None
+            return (*data_channel, cipher)
+
+        except Exception as e:
+            print(f'Exception occurred during attempt to establish Data Channel connection with {address}\n{e}')
+            return None
+
+    async def connect_data_channel_passive(self, writer: asyncio.StreamWriter, connections: int,
+                                           session: Optional[Session] = None) -> \
+            Tuple[List[DataConnection], bytes, bytes]:
+        """
+        Performs connection with server Data Channel in passive mode. Client connects to listeners of passive port
+        pool of this worker and identifies its connections with token. Keys are sent only for a new session.
+        """
+        token, ports = self.passive.expect(connections)
+        try:
+            await AsyncServer.send_object_message(writer, {'ports': ports, 'token': token})
+
+            if session:
+                key, iv = session.key, session.iv
+            else:
+                key = Server.generate_secret(32)
+                await AsyncServer.send_object_message(writer, key)
+
+                iv = Server.generate_secret(16)
+                await AsyncServer.send_object_message(writer, iv)
+
+            return await self.passive.wait(token), key, iv
+
+        finally:
+            self.passive.cancel(token)
+
+    @staticmethod
+    async def connect_data_channel_active(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                          connections: int, session: Optional[Session] = None) -> \
+            Optional[Tuple[List[DataConnection], bytes, bytes]]:
+        """
+        Performs connection with client Data Channel in active mode. Keys are received only for a new session.
+        """
+        message = await AsyncServer.receive_object_message(reader)
+        if not message['ports']:
+            return None
+
+        if session:
+            key, iv = session.key, session.iv
+        else:
+            key = await AsyncServer.receive_object_message(reader)
+            iv = await AsyncServer.receive_object_message(reader)
+
+        # Connect to ports specified by client
+        data_conns = []
+        for port in message['ports'][:connections]:
+            data_conns.append(await asyncio.wait_for(
+                asyncio.open_connection(writer.get_extra_info('sockname')[0], int(port)), timeout=5))
+
+        return data_conns, key, iv
+
+    async def handle_commands(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              address: Tuple[str, int], channels: List[AsyncDataChannel],
+                              key: bytes, iv: bytes, cipher: str, metrics: SessionMetrics) -> None:
+        """
+        Receives commands from client, verifies and responds to them. Each accepted "get", "put", "mget" and "mput" is
+        prepared by Server.prepare_transfer and transferred by its own task on Data Channel stream chosen by client,
+        large files over all Data Channel connections.
+        """
+        loop = asyncio.get_running_loop()
+        current_dir = os.getcwd()  # Only to init
+        listing = None  # "ls" being sent in pages
+        transfers = set()
+        new_encryptor = partial(make_encryptor, cipher, key, iv)
+        new_decryptor = partial(make_decryptor, cipher, key, iv)
+        while True:
+            command = await AsyncServer.receive_object_message(reader)
+
+            if not command:
+                writer.close()
+                print(f'Connection with {address} closed!')
+                # Let transfers consume frames already sent by client before Data Channel is torn down
+                await asyncio.gather(*transfers, return_exceptions=True)
+                for channel in channels:
+                    channel.close()
+                print(f'Data Channel of {address} closed.')
+                break
+
+            verb = next((name for name in COMMANDS if name in command), 'invalid')
+            start = time.perf_counter()
+            try:
+                if 'cd' in command.keys():
+                    # Change current working directory if path is valid
+                    try:
+                        current_dir = Server.change_directory(current_dir, command['cd'])
+                        await AsyncServer.send_object_message(writer, {'cd': current_dir})
+
+                    except Exception as e:
+                        print(f'Exception occurred in command channel of {address}\n{e}')
+                        await AsyncServer.send_object_message(writer, {'cd': 'ERR'})
+
+                elif 'ls' in command.keys():
+                    try:
+                        # Walking directory tree blocks, so it is done outside of event loop
+                        page, listing = await loop.run_in_executor(None, Server.next_listing_page, listing,
+                                                                   current_dir, command['ls'],
+                                                                   command.get('cursor', 0), self.server.listing_cache)
+                        await AsyncServer.send_object_message(writer, page)
+
+                    except Exception as e:
+                        listing = None
+                        print(f'Exception occurred in command channel of {address}\n{e}')
+                        await AsyncServer.send_object_message(writer, {'ls': 'ERR'})
+
+                elif 'mlsd' in command.keys():
+                    try:
+                        # Stat and hashing of entries block, so they are done outside of event loop
+                        records = await loop.run_in_executor(None, Server.list_records, current_dir, command['mlsd'],
+                                                             command.get('hashes', False), self.server.hash_index)
+                        await AsyncServer.send_object_message(writer, {'mlsd': records})
+
+                    except Exception as e:
+                        print(f'Exception occurred in command channel of {address}\n{e}')
+                        await AsyncServer.send_object_message(writer, {'mlsd': 'ERR'})
+
+                elif verb in TRANSFER_COMMANDS:
+                    try:
+                        # Resolving, reserving and opening files blocks, so it is done outside of event loop
+                        transfer = await loop.run_in_executor(None, self.server.prepare_transfer, verb, command,
+                                                              current_dir, channels, address, metrics, new_encryptor,
+                                                              new_decryptor)
+                        args = Server.open_transfer(transfer)
+                        await AsyncServer.send_object_message(writer, transfer.reply)
+                        if transfer.method:
+                            AsyncServer.start_transfer(transfers, getattr(self, transfer.method)(*args))
+
+                    except Exception as e:
+                        print(f'Exception occurred in command channel of {address}\n{e}')
+                        await AsyncServer.send_object_message(writer, {verb: 'ERR'})
+
+                else:
+                    print(f'Received invalid command from {address}')
+
+            except Exception as e:
+                print(f'Exception occurred in command channel of {address}\n{e}')
+                try:
+                    await AsyncServer.send_object_message(writer, {'ERR': str(e)})
+                except Exception as e:
+                    print(f'Exception occurred in command channel of {address}\n{e}')
+
+            finally:
+                metrics.observe(f'command.{verb}', time.perf_counter() - start)
+
+    @staticmethod
+    def start_transfer(transfers: set, coroutine: Coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        transfers.add(task)
+        task.add_done_callback(transfers.discard)
+
+    @staticmethod
+    async def upload_file(channels: List[AsyncDataChannel], stream_id: int, f: BinaryIO, size: int, offset: int,
+                          new_encryptor: Callable[[], Encryptor], new_compressor: Optional[Callable],
+                          address: Tuple[str, int], metrics: Metrics) -> None:
+        """
+        Sends file requested with "get" command on its Data Channel streams, starting from offset.
+        """
+        with f:
+            try:
+                with metrics.timed('transfer.get'):
+                    await async_send_file_striped(channels, stream_id, f, size, new_encryptor, offset,
+                                                  new_compressor)
+
+            except Exception as e:
+                print(f'Exception occurred during sending data to {address}!\n{e}')
+
+    async def download_file(self, streams: List[AsyncIterator[bytes]], f: BinaryIO, filepath: str, size: int,
+                            offset: int, new_decryptor: Callable[[], Decryptor],
+                            new_decompressor: Optional[Callable[[], Decompressor]], is_text_mode: bool,
+                            digest: Optional[str], address: Tuple[str, int], metrics: Metrics) -> None:
+        """
+        Receives file sent with "put" command from its Data Channel streams into partial file, which replaces
+        filepath once complete. File offered with its hash is indexed. Disk is touched in default executor only.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.timed('transfer.put'):
+                if digest:
+                    f = HashingFile(f, offset)
+                with f:
+                    await async_receive_file_striped(streams, f, size, new_decryptor, is_text_mode, offset,
+                                                     new_decompressor)
+                    received = await loop.run_in_executor(None, f.hexdigest, size) if digest else None
+                await loop.run_in_executor(None, complete_partial, filepath, None if is_text_mode else size)
+            if digest:
+                await loop.run_in_executor(None, self.server.index_file, filepath, digest, received)
+
+        except Exception as e:
+            print(f'Exception occurred during receiving data from {address}!\n{e}')
+
+        finally:
+            abandon_streams(streams)
+            await loop.run_in_executor(None, self.server.release_upload, filepath)
+
+    @staticmethod
+    async def upload_delta(channel: AsyncDataChannel, stream_id: int, f: BinaryIO, size: int, signature: bytes,
+                           block_size: int, encryptor: Encryptor, address: Tuple[str, int],
+                           metrics: Metrics) -> None:
+        """
+        Sends changes of file requested with "get" command against client's copy of signature.
+        """
+        with f:
+            try:
+                with metrics.timed('transfer.get_delta'):
+                    await async_send_delta(channel, stream_id, f, size, signature, block_size, encryptor)
+
+            except Exception as e:
+                print(f'Exception occurred during sending data to {address}!\n{e}')
+
+    async def download_delta(self, streams: List[AsyncIterator[bytes]], f: BinaryIO, filepath: str, size: int,
+                             block_size: int, decryptor: Decryptor, digest: Optional[str],
+                             address: Tuple[str, int], metrics: Metrics) -> None:
+        """
+        Rebuilds file updated by "put" command from its current content and changes received on its one stream into
+        partial file, which replaces filepath once complete. Disk is touched in default executor only.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.timed('transfer.put_delta'):
+                if digest:
+                    f = HashingFile(f)
+                with f, metrics.timed_file(await loop.run_in_executor(None, open, filepath, 'rb')) as basis:
+                    await async_receive_delta(streams[0], basis, f, block_size, decryptor)
+                    received = await loop.run_in_executor(None, f.hexdigest, size) if digest else None
+                await loop.run_in_executor(None, complete_partial, filepath, size)
+            if digest:
+                await loop.run_in_executor(None, self.server.index_file, filepath, digest, received)
+
+        except Exception as e:
+            print(f'Exception occurred during receiving data from {address}!\n{e}')
+
+        finally:
+            abandon_streams(streams)
+            await loop.run_in_executor(None, self.server.release_upload, filepath)
+
+    @staticmethod
+    async def upload_files(channels: List[AsyncDataChannel], stream_id: int, files: List[Tuple[str, int]],
+                           new_encryptor: Callable[[], Encryptor], address: Tuple[str, int],
+                           metrics: Metrics) -> None:
+        """
+        Sends batch of files requested with "mget" command on its Data Channel streams.
+        """
+        try:
+            with metrics.timed('transfer.mget'):
+                await async_send_batch_striped(channels, stream_id, files, new_encryptor)
+
+        except Exception as e:
+            print(f'Exception occurred during sending data to {address}!\n{e}')
+
+    async def download_files(self, streams: List[AsyncIterator[bytes]], files: List[Tuple[str, int]],
+                             new_decryptor: Callable[[], Decryptor], is_text_mode: bool,
+                             address: Tuple[str, int], metrics: Metrics) -> None:
+        """
+        Receives batch of files sent with "mput" command from its Data Channel streams.
+        """
+        try:
+            with metrics.timed('transfer.mput'):
+                await async_receive_batch_striped(streams, files, new_decryptor, is_text_mode)
+
+        except Exception as e:
+            print(f'Exception occurred during receiving data from {address}!\n{e}')
+
+        finally:
+            abandon_streams(streams)
+            await asyncio.get_running_loop().run_in_executor(None, self.server.release_uploads,
+                                                             [filepath for filepath, _ in files])
@@ -0,0 +1,86 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+
+
+def make_files(directory: str, prefix: str, number: int, size: int) -> list:
+    os.makedirs(directory)
+    filepaths = []
+    for i in range(number):
+        filepath = os.path.join(directory, f'{prefix}_{i:06}.bin')
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(size))
+        filepaths.append(filepath)
+    return filepaths
+
+
+def run_session(args: argparse.Namespace, directory: str, commands: list) -> float:
+    """
+    Runs client with commands in directory and returns duration of the session in seconds. Client exits only once
+    its transfers are finished.
+    """
+    os.makedirs(directory, exist_ok=True)
+    shutil.copy(args.cert, directory)
+    script = [args.user, args.password, f'cd {args.remote_dir}', *commands, 'exit', '']
+    start = time.perf_counter()
+    subprocess.run([sys.executable, CLIENT, '-H', args.host, '-p', str(args.port), *args.client_args.split()],
+                   input='\n'.join(script), text=True, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare files per second of per-file get/put and batched mget/mput '
+                                                 'against a running server.')
+    parser.add_argument('-H', '--host', type=str, default='127.0.0.1', metavar='', help='Address of server')
+    parser.add_argument('-p', '--port', type=int, default=65000, metavar='', help='Port number of server')
+    parser.add_argument('-u', '--user', type=str, required=True, metavar='', help='Username')
+    parser.add_argument('-P', '--password', type=str, required=True, metavar='', help='Password')
+    parser.add_argument('-r', '--remote-dir', type=str, default='.', metavar='',
+                        help='Remote directory benchmark files are uploaded to and left in (default: server directory)')
+    parser.add_argument('-n', '--number', type=int, default=1000, metavar='',
+                        help='Number of files per run (default: 1000)')
+    parser.add_argument('-s', '--size', type=int, default=1024, metavar='', help='Size of file in bytes (default: 1024)')
+    parser.add_argument('--cert', type=str, default='cert.pem', metavar='', help='Server certificate (default: cert.pem)')
+    parser.add_argument('--client-args', type=str, default='', metavar='',
+                        help='Additional client options e.g. "-n 4 -c none"')
+    args = parser.parse_args()
+    args.cert = os.path.abspath(args.cert)
+
+    workdir = tempfile.mkdtemp(prefix='batch_benchmark_')
+    try:
+        # Upload and download different files, so uploads are never renamed and downloads read what was uploaded
+        single = make_files(os.path.join(workdir, 'single'), 'single', args.number, args.size)
+        make_files(os.path.join(workdir, 'batch'), 'batch', args.number, args.size)
+        setup = run_session(args, os.path.join(workdir, 'setup'), [])
+
+        results = {
+            'put': run_session(args, os.path.join(workdir, 'put'), [f'put {filepath}' for filepath in single]),
+            'mput': run_session(args, os.path.join(workdir, 'mput'), [f'mput {os.path.join(workdir, "batch", "*")}']),
+            'get': run_session(args, os.path.join(workdir, 'get'),
+                               [f'get {os.path.basename(filepath)}' for filepath in single]),
+            'mget': run_session(args, os.path.join(workdir, 'mget'), ['mget batch_*']),
+        }
+        for name in ('get', 'mget'):
+            received = len([f for f in os.listdir(os.path.join(workdir, name)) if f.endswith('.bin')])
+            if received != args.number:
+                print(f'*** {name} received {received} of {args.number} files')
+
+        print(f'{args.number} files of {args.size} B, session setup {setup:.2f} s (excluded)')
+        print(f'{"command":<8} {"time [s]":>10} {"files/s":>10}')
+        for name, duration in results.items():
+            duration = max(duration - setup, 1e-9)
+            print(f'{name:<8} {duration:>10.2f} {args.number / duration:>10.0f}')
+        print(f'Benchmark files were left in remote directory "{args.remote_dir}" (single_*.bin, batch_*.bin)')
+
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
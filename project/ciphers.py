@@ -0,0 +1,226 @@
+import base64
+import secrets
+import struct
+from typing import Iterable
+
+from Crypto.Cipher import AES
+
+
+class Encryptor:
+    """
+    Incremental encryption of one Data Channel stream. Each non-empty value returned by update/finish is sent as
+    a separate frame.
+    """
+
+    # Data is sent as is, so file may be sent straight from page cache
+    zero_copy = False
+
+    def update(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def finish(self) -> bytes:
+        raise NotImplementedError
+
+
+class Decryptor:
+    """
+    Incremental decryption of one Data Channel stream, fed with received frames.
+    """
+
+    def update(self, frame: bytes) -> bytes:
+        raise NotImplementedError
+
+    def finish(self) -> bytes:
+        raise NotImplementedError
+
+
+class CbcEncryptor(Encryptor):
+    """
+    Incremental AES-CBC encryption. Cipher state is carried across chunks,
+    padding is applied only to the last block of the stream. Frames are base64 encoded.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        self.remainder = b''
+
+    def update(self, data: bytes) -> bytes:
+        """
+        Encrypts all full blocks available so far and returns them as one frame payload.
+        """
+        if self.remainder:
+            data = self.remainder + data
+        full_length = len(data) - len(data) % AES.block_size
+        self.remainder = data[full_length:]
+        if not full_length:
+            return b''
+        return base64.b64encode(self.cipher.encrypt(data[:full_length]))
+
+    def finish(self) -> bytes:
+        """
+        Pads and encrypts what is left of the stream.
+        """
+        padding_length = AES.block_size - len(self.remainder)
+        data = self.remainder + bytes([padding_length]) * padding_length
+        self.remainder = b''
+        return base64.b64encode(self.cipher.encrypt(data))
+
+
+class CbcDecryptor(Decryptor):
+    """
+    Incremental AES-CBC decryption. Last block is held back until the end of stream, because it carries padding.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        self.tail = b''
+
+    def update(self, frame: bytes) -> bytes:
+        data = self.tail + self.cipher.decrypt(base64.b64decode(frame))
+        self.tail = data[-AES.block_size:]
+        return data[:-AES.block_size]
+
+    def finish(self) -> bytes:
+        if len(self.tail) != AES.block_size:
+            raise ValueError('Stream ended with incomplete block!')
+        padding_length = self.tail[-1]
+        if not 1 <= padding_length <= AES.block_size:
+            raise ValueError('Invalid padding!')
+        return self.tail[:-padding_length]
+
+
+class GcmEncryptor(Encryptor):
+    """
+    AES-GCM with a tag per frame. Raw binary frames: [nonce prefix (first frame only)][flag][ciphertext][tag].
+    Nonce is a random per-stream prefix followed by frame counter, so the session key may be reused across streams.
+    Flag marks the final frame and is authenticated, so a truncated stream is detected.
+    """
+
+    PREFIX_LENGTH = 8
+    TAG_LENGTH = 16
+    FLAG_DATA = b'\x00'
+    FLAG_FINAL = b'\x01'
+    COUNTER = struct.Struct('!I')
+
+    def __init__(self, key: bytes, iv: bytes = b''):
+        self.key = key
+        self.prefix = secrets.token_bytes(GcmEncryptor.PREFIX_LENGTH)
+        self.header = self.prefix
+        self.counter = 0
+
+    def seal(self, data: bytes, flag: bytes) -> bytes:
+        nonce = self.prefix + GcmEncryptor.COUNTER.pack(self.counter)
+        self.counter += 1
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=GcmEncryptor.TAG_LENGTH)
+        cipher.update(flag)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        frame = b''.join((self.header, flag, ciphertext, tag))
+        self.header = b''
+        return frame
+
+    def update(self, data: bytes) -> bytes:
+        if not data:
+            return b''
+        return self.seal(data, GcmEncryptor.FLAG_DATA)
+
+    def finish(self) -> bytes:
+        return self.seal(b'', GcmEncryptor.FLAG_FINAL)
+
+
+class GcmDecryptor(Decryptor):
+    """
+    Verifies and decrypts frames produced by GcmEncryptor.
+    """
+
+    def __init__(self, key: bytes, iv: bytes = b''):
+        self.key = key
+        self.prefix = None
+        self.counter = 0
+        self.finished = False
+
+    def update(self, frame: bytes) -> bytes:
+        view = memoryview(frame)
+        if self.prefix is None:
+            self.prefix = bytes(view[:GcmEncryptor.PREFIX_LENGTH])
+            view = view[GcmEncryptor.PREFIX_LENGTH:]
+        if self.finished:
+            raise ValueError('Frame received after the final frame!')
+        if len(view) < 1 + GcmEncryptor.TAG_LENGTH:
+            raise ValueError('Frame too short!')
+
+        flag = bytes(view[:1])
+        nonce = self.prefix + GcmEncryptor.COUNTER.pack(self.counter)
+        self.counter += 1
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=GcmEncryptor.TAG_LENGTH)
+        cipher.update(flag)
+        data = cipher.decrypt_and_verify(view[1:-GcmEncryptor.TAG_LENGTH], view[-GcmEncryptor.TAG_LENGTH:])
+        self.finished = flag == GcmEncryptor.FLAG_FINAL
+        return data
+
+    def finish(self) -> bytes:
+        if not self.finished:
+            raise ValueError('Stream ended without final frame!')
+        return b''
+
+
+class PlainEncryptor(Encryptor):
+    """
+    No payload encryption, for trusted networks. Frames carry raw file data.
+    """
+
+    zero_copy = True
+
+    def __init__(self, key: bytes = b'', iv: bytes = b''):
+        pass
+
+    def update(self, data: bytes) -> bytes:
+        return data
+
+    def finish(self) -> bytes:
+        return b''
+
+
+class PlainDecryptor(Decryptor):
+
+    def __init__(self, key: bytes = b'', iv: bytes = b''):
+        pass
+
+    def update(self, frame: bytes) -> bytes:
+        return frame
+
+    def finish(self) -> bytes:
+        return b''
+
+
+# Data Channel ciphers in order of preference
+CIPHERS = {
+    'gcm': (GcmEncryptor, GcmDecryptor),
+    'cbc': (CbcEncryptor, CbcDecryptor),
+    'none': (PlainEncryptor, PlainDecryptor),
+}
+
+# Cipher without payload encryption - used only if explicitly chosen by client and allowed by server
+PLAIN_CIPHER = 'none'
+ENCRYPTED_CIPHERS = [name for name in CIPHERS if name != PLAIN_CIPHER]
+
+# Cipher assumed when the other side does not negotiate one
+DEFAULT_CIPHER = 'cbc'
+
+
+def choose_cipher(offered: Iterable[str], supported: Iterable[str] = tuple(CIPHERS)) -> str:
+    """
+    Picks the first cipher offered by client which is supported by server.
+    """
+    offered, supported = list(offered), list(supported)
+    for name in offered:
+        if name in supported:
+            return name
+    raise ValueError(f'No common Data Channel cipher! Offered: {offered}')
+
+
+def make_encryptor(name: str, key: bytes, iv: bytes) -> Encryptor:
+    return CIPHERS[name][0](key, iv)
+
+
+def make_decryptor(name: str, key: bytes, iv: bytes) -> Decryptor:
+    return CIPHERS[name][1](key, iv)
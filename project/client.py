@@ -1,22 +1,32 @@
 import argparse
 import cmd
+import glob
 import hashlib
+import json
 import os
-import pickle
 import queue
 import random
 import socket
 import ssl
 import threading
+import time
+from concurrent.futures import Future
 from types import SimpleNamespace
-from typing import Optional
-
-from file_tree_maker import FileTreeMaker
-from Crypto.Cipher import AES
-import string
+from functools import partial
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from file_tree_maker import FileTreeMaker, hash_file
+from transfer import MAX_FRAME_LENGTH, plan_stripes, stripe_channels, send_file_striped, receive_file_striped, \
+    send_batch_striped, receive_batch_striped, open_partial, complete_partial, partial_size
+from mux import DataChannel, open_streams, close_streams, abandon_streams
+from delta import file_signature, send_delta, receive_delta
+from compression import parse_compression, is_file_compressible, make_compressor, make_decompressor
+from passive import HELLO
+from profiling import UNPROFILED, Profiler, SessionProfile, TransferProfile, Unprofiled
+from codec import encode_message, decode_message
+from framing import MAX_MESSAGE_LENGTH, send_frame, receive_frame
+from ciphers import CIPHERS, ENCRYPTED_CIPHERS, PLAIN_CIPHER, make_encryptor, make_decryptor
 import secrets
-import base64
-import platform
 
 
 class Client:
@@ -24,33 +34,57 @@ class Client:
     Multithread tcp client of simple FTP.
     """
 
-    HEADER_LENGTH = 10
+    # TLS context and sessions shared by clients of the process, so reconnecting client skips full TLS handshake
+    tls_context = None
+    tls_sessions: Dict[Tuple[str, int], ssl.SSLSession] = dict()
 
-    def __init__(self):
-        args = Client.get_args()
+    def __init__(self, args: Optional[argparse.Namespace] = None):
+        args = args or Client.get_args()
         self.server_host = args.host
         self.server_port = args.port
         self.mode = args.mode
+        self.offered_ciphers = [args.cipher] if args.cipher else list(ENCRYPTED_CIPHERS)
+        self.connections = args.connections
+        # File with tickets of sessions next run of client resumes instead of logging in and exchanging keys again
+        self.session_file = args.session_file
+        self.username = b''
+        self.hashed_pass = ''
+        self.resumed = False
 
         # Thread-safe buffer for communicating between threads
         # responsible for handling user input and sending commands
         self.command_buffer = queue.Queue()
-        # Responsible for communication between Data Channel and Command Channel
-        self.command_data_communication_buffer = queue.Queue()
 
         self.command_thread_event = threading.Event()
         self.input_thread_event = threading.Event()
-        self.data_thread_event = threading.Event()
         self.exit = False
 
+        # Data Channel connections shared by concurrent transfers, each running in its own thread on its own stream
+        self.data_channels = list()
+        self.last_stream_id = 0  # Used only by command thread
+        self.transfers = list()
+        # Local paths of running downloads, so concurrent downloads never write the same file
+        self.files_in_transfer = set()
+        self.files_in_transfer_mutex = threading.Lock()
+
         self.input_handler = None
         self.is_text_mode = False
 
         self.key = None
         self.iv = None
+        self.cipher = None
+
+        # Opt-in profiling of transfers of the session
+        self.profile: Optional[SessionProfile] = None
+        if args.profile:
+            self.profile = Profiler(args.profile, args.profile_cpu, args.profile_memory).session(
+                f'client-{self.server_host}-{self.server_port}')
 
     @staticmethod
-    def get_args() -> argparse.Namespace:
+    def get_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+        """
+        Parses options given in argv, command line by default.
+        """
         parser = argparse.ArgumentParser(description='Run simple FTP client.')
         parser.add_argument('-H', '--host', type=str, default='127.0.0.1', metavar='',
                             help='Address of server e.g. "127.0.0.1"')
@@ -58,7 +92,23 @@ class Client:
                             help='Port number of server Command Channel e.g. "65000"')
         parser.add_argument('-m', '--mode', type=str, default='p', choices=['a', 'p'], metavar='',
                             help='Mode of establishing connection with server')
-        return parser.parse_args()
+        parser.add_argument('-c', '--cipher', type=str, default=None, choices=list(CIPHERS), metavar='',
+                            help=f'Data Channel cipher e.g. "gcm" (default: best supported by server); '
+                                 f'"{PLAIN_CIPHER}" disables payload encryption if server allows it')
+        parser.add_argument('-n', '--connections', type=int, default=1, metavar='',
+                            help='Number of Data Channel connections large files are split across (default: 1)')
+        parser.add_argument('-s', '--session-file', type=str, default=None, metavar='',
+                            help='File session tickets are kept in, so the next run resumes the session without key '
+                                 'exchange (default: tickets are not kept)')
+        parser.add_argument('--profile', type=str, default=None, metavar='',
+                            help='Directory profiles of transfers are written to, with time spent in each of their '
+                                 'stages (default: profiling disabled)')
+        parser.add_argument('--profile-cpu', action='store_true',
+                            help='Write cProfile of transfer threads to profile directory when session ends')
+        parser.add_argument('--profile-memory', action='store_true',
+                            help='Trace allocations with tracemalloc and write top allocation sites to profile '
+                                 'directory when session ends')
+        return parser.parse_args(argv)
 
     @staticmethod
     def send_object_message(s: socket.socket, message: object) -> None:
@@ -66,9 +116,7 @@ class Client:
         Serializes and sends 1 object message.
         Sends header with message length.
         """
-        message = pickle.dumps(message)
-        message_header = bytes(f'{len(message):<{Client.HEADER_LENGTH}}', 'utf-8')
-        s.sendall(message_header + message)
+        send_frame(s, encode_message(message))
 
     @staticmethod
     def receive_object_message(s: socket.socket) -> Optional[dict]:
@@ -76,89 +124,165 @@ class Client:
         Receives 1 object message and deserialize it.
         """
         try:
-            message_header = s.recv(Client.HEADER_LENGTH)
-            if not message_header:
-                print('Failed to receive message header!')
-                return None
+            message = receive_frame(s, MAX_MESSAGE_LENGTH)
+            return decode_message(message)
 
-            message_length = int(message_header.decode('utf-8').strip())
-            message = s.recv(message_length)
-            if not message:
-                print('Failed to receive message!')
-                return None
-
-            message = pickle.loads(message)
-            return message
+        except ConnectionError:
+            print('Failed to receive message!')
+            return None
 
         except Exception as e:
             print(f'Exception occurred during receiving a message!\n{e}')
             return None
 
     def run(self) -> None:
+        # Credentials are asked for before connecting, server expects them right after TLS handshake
+        self.ask_credentials()
+
+        s = self.connect()
+        if not s:
+            quit(1)
+
+        with s:
+            print(f'Connection successful using {s.version()}, Data Channel cipher: {self.cipher}, '
+                  f'connections: {len(self.data_channels)}{", session resumed" if self.resumed else ""}')
+
+            # Start Command Thread
+            t = threading.Thread(target=self.handle_commands, args=(s,))
+            t.start()
 
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        context.load_verify_locations('cert.pem')
+            # Listen for user commands
+            self.handle_user_input()
+
+            # Command thread closes the connection once running transfers are finished
+            t.join()
+
+    def connect(self) -> Optional[ssl.SSLSocket]:
+        """
+        Connects to server, logs in with credentials of client and establishes Data Channel, whose threads are
+        started. Returns Command Channel socket, None if any step failed.
+        """
+        if Client.tls_context is None:
+            Client.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            Client.tls_context.load_verify_locations('cert.pem')
 
         # Establish connection with command channel
         try:
             sock = socket.create_connection((self.server_host, self.server_port))
         except socket.error as e:
             print(f'Connection failed!\n{e}')
-            quit(1)
-
-        with context.wrap_socket(sock, server_side=False, server_hostname="projekt.psi") as s:
-            s.settimeout(5)
+            return None
 
-            # Authenticate user
-            if not Client.authenticate_user(s):
-                print('Authentication failed!')
-                quit(1)
+        address = (self.server_host, self.server_port)
+        s = Client.tls_context.wrap_socket(sock, server_side=False, server_hostname="projekt.psi",
+                                           session=Client.tls_sessions.get(address))
+        s.settimeout(5)
 
-            # Successful authentication - agree on Data Channel
-            data_s = self.agree_on_data_channel(s)
-            if not data_s:
-                print('Could not agree on Data Channel!')
-                quit(1)
+        # Authenticate user
+        if not self.authenticate_user(s):
+            print('Authentication failed!')
+            s.close()
+            return None
 
-            print(f'Connection successful using {s.version()}')
+        # Successful authentication - agree on Data Channel
+        data_conns = self.agree_on_data_channel(s)
+        if not data_conns:
+            print('Could not agree on Data Channel!')
+            s.close()
+            return None
 
-            # Start Data Channel Thread
-            td = threading.Thread(target=self.handle_data_channel, args=(data_s,))
+        # Ticket lets next connection resume the session
+        try:
+            self.save_ticket(Client.receive_object_message(s)['ticket'])
+        except (OSError, TypeError, KeyError) as e:
+            print(f'Could not save session ticket!\n{e}')
+        Client.tls_sessions[address] = s.session
+
+        # Start Data Channel Threads receiving frames of all transfers, one per connection
+        self.data_channels = [DataChannel(data_conn, MAX_FRAME_LENGTH) for data_conn in data_conns]
+        for channel in self.data_channels:
+            td = threading.Thread(target=channel.run)
             td.start()
+        return s
 
-            # Start Command Thread
-            t = threading.Thread(target=self.handle_commands, args=(s,))
-            t.start()
+    def ask_credentials(self) -> None:
+        username = input('Insert username: ')
+        password = input('Insert password: ')
+        self.set_credentials(username, password)
 
-            # Listen for user commands
-            self.handle_user_input()
-
-    @staticmethod
-    def authenticate_user(s: socket.socket) -> bool:
-        """
-        Handles authentication of user with server.
-        """
-        username = input('Insert username: ').encode('utf-8')
-        password = input('Insert password: ').encode('utf-8')
+    def set_credentials(self, username: str, password: str) -> None:
+        self.username = username.encode('utf-8')
 
         hasher = hashlib.sha512()
-        hasher.update(password)
-        hashed_pass = hasher.hexdigest()
+        hasher.update(password.encode('utf-8'))
+        self.hashed_pass = hasher.hexdigest()
 
-        user_credentials = {'name': username, 'pass': hashed_pass}
+    def authenticate_user(self, s: socket.socket) -> bool:
+        """
+        Handles authentication of user with server. Saved session of the user is resumed if server accepts its ticket.
+        """
+        user_credentials = {'name': self.username, 'pass': self.hashed_pass}
+        saved = self.load_ticket()
+        if saved:
+            user_credentials['ticket'] = bytes.fromhex(saved['ticket'])
         Client.send_object_message(s, user_credentials)
 
         status_message = Client.receive_object_message(s)
         try:
+            if status_message['status'] == 'RESUMED':
+                self.cipher = saved['cipher']
+                self.key, self.iv = bytes.fromhex(saved['key']), bytes.fromhex(saved['iv'])
+                self.resumed = True
+                return True
             if status_message['status'] == 'OK':
                 return True
+            if status_message['status'] == 'BUSY':
+                print('Server is busy, try again later.')
             return False
 
         except Exception as e:
             print(f'Exception occurred during authentication!\n{e}')
             return False
 
-    def agree_on_data_channel(self, s: socket.socket) -> Optional[socket.socket]:
+    def session_key(self) -> str:
+        return f'{self.server_host}:{self.server_port}:{self.username.decode("utf-8")}'
+
+    def load_ticket(self) -> Optional[dict]:
+        """
+        Returns saved session of user on server, if its cipher is one client offers.
+        """
+        if not self.session_file:
+            return None
+        try:
+            with open(self.session_file, 'r', encoding='utf-8') as f:
+                saved = json.load(f).get(self.session_key())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f'Could not load session tickets!\n{e}')
+            return None
+        return saved if saved and saved['cipher'] in self.offered_ciphers else None
+
+    def save_ticket(self, ticket: bytes) -> None:
+        """
+        Saves ticket with cipher and keys of the session. File holds secrets, so only its owner may read it.
+        """
+        if not self.session_file:
+            return
+        try:
+            with open(self.session_file, 'r', encoding='utf-8') as f:
+                tickets = json.load(f)
+        except (OSError, ValueError):
+            tickets = dict()
+        tickets[self.session_key()] = {'ticket': ticket.hex(), 'cipher': self.cipher, 'key': self.key.hex(),
+                                       'iv': self.iv.hex()}
+
+        tmp_path = f'{self.session_file}.tmp'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+            json.dump(tickets, f)
+        os.replace(tmp_path, self.session_file)
+
+    def agree_on_data_channel(self, s: socket.socket) -> Optional[List[socket.socket]]:
         """
         Negotiates Data Channel
         """
@@ -167,7 +291,22 @@ class Client:
         else:
             return self.connect_data_channel_active(s)
 
-    def connect_data_channel_passive(self, s: socket.socket) -> Optional[socket.socket]:
+    def accept_cipher(self, cipher_message: dict) -> bool:
+        """
+        Takes Data Channel cipher chosen by server. Server which accepts none of offered ciphers tells which it does.
+        """
+        if 'cipher' in cipher_message:
+            self.cipher = cipher_message['cipher']
+            return True
+        accepted = ', '.join(cipher_message.get('ciphers', [])) or 'unknown'
+        if self.offered_ciphers == [PLAIN_CIPHER]:
+            print(f'Server does not allow unencrypted transfers! Ciphers offered by server: {accepted}')
+        else:
+            print(f'Server accepts none of ciphers {", ".join(self.offered_ciphers)}! Ciphers offered by server: '
+                  f'{accepted}')
+        return False
+
+    def connect_data_channel_passive(self, s: socket.socket) -> Optional[List[socket.socket]]:
         """
         Performs connection with server Data Channel in passive mode.
         """
@@ -177,83 +316,106 @@ class Client:
             if not message['mode'] == 'ready':
                 return None
 
-            Client.send_object_message(s, {'mode': 'p'})
-            port_number_message = Client.receive_object_message(s)
-            port_number = int(port_number_message['port'])
-
-            key_message = Client.receive_object_message(s)
-            self.key = key_message
-
-            iv_message = Client.receive_object_message(s)
-            self.iv = iv_message
-
-            # Connect to specified server port
-            data_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            data_s.settimeout(5)
-            data_s.connect((self.server_host, port_number))
-
-            return data_s
+            Client.send_object_message(s, {'mode': 'p', 'ciphers': self.offered_ciphers,
+                                           'connections': self.connections})
+            if not self.accept_cipher(Client.receive_object_message(s)):
+                return None
+            port_numbers_message = Client.receive_object_message(s)
+            port_numbers = [int(port) for port in port_numbers_message['ports']]
+            # Server with passive port pool tells connections of sessions apart by token
+            token = port_numbers_message.get('token')
+
+            # Resumed session keeps its keys
+            if not self.resumed:
+                key_message = Client.receive_object_message(s)
+                self.key = key_message
+
+                iv_message = Client.receive_object_message(s)
+                self.iv = iv_message
+
+            # Connect to specified server ports
+            data_conns = []
+            for index, port_number in enumerate(port_numbers):
+                data_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                data_s.settimeout(5)
+                data_s.connect((self.server_host, port_number))
+                if token:
+                    data_s.sendall(HELLO.pack(token, index))
+                data_s.settimeout(None)  # Data Channel may stay idle between transfers
+                data_conns.append(data_s)
+
+            return data_conns
 
         except Exception as e:
             print(f'Exception occurred during attempt to establish connection with Data Channel in passive mode!\n{e}')
             return None
 
-    def connect_data_channel_active(self, s: socket.socket) -> Optional[socket.socket]:
+    def connect_data_channel_active(self, s: socket.socket) -> Optional[List[socket.socket]]:
         """
-        Performs connection with server Data Channel in active mode.
+        Performs connection with server Data Channel in active mode. Each connection gets its own port.
         """
+        data_channels = []
         try:
             message = Client.receive_object_message(s)
             if not message['mode'] == 'ready':
                 return None
 
-            Client.send_object_message(s, {'mode': 'a'})
+            Client.send_object_message(s, {'mode': 'a', 'ciphers': self.offered_ciphers,
+                                           'connections': self.connections})
+            cipher_message = Client.receive_object_message(s)
+            if not self.accept_cipher(cipher_message):
+                return None
 
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as data_channel:
+            for _ in range(cipher_message.get('connections', 1)):
+                data_channel = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                data_channels.append(data_channel)
                 data_channel.bind((s.getsockname()[0], 0))  # Get random unused port
                 data_channel.listen(1)
 
-                port = int(data_channel.getsockname()[1])
-                Client.send_object_message(s, {'port': port})
+            ports = [int(data_channel.getsockname()[1]) for data_channel in data_channels]
+            Client.send_object_message(s, {'ports': ports})
 
-                key = ''.join(secrets.choice(string.ascii_letters + string.digits) for x in range(32))
-                self.key = key.encode("utf8")
+            # Resumed session keeps its keys
+            if not self.resumed:
+                self.key = secrets.token_bytes(32)
                 Client.send_object_message(s, self.key)
 
-                iv = ''.join(secrets.choice(string.ascii_letters + string.digits) for x in range(16))
-                self.iv = iv.encode("utf8")
+                self.iv = secrets.token_bytes(16)
                 Client.send_object_message(s, self.iv)
 
-                connected = False
-
-                while not connected:
-                    data_conn, address = data_channel.accept()
-                    connected = True
-
-                return data_conn
+            return [data_channel.accept()[0] for data_channel in data_channels]
 
         except Exception as e:
             print(f'Exception occurred during attempt to establish connection with Data Channel in active mode!\n{e}')
             return None
 
-    def decrypt(self, message):
-        """
-        Decrypts received message
-        """
-        message = base64.b64decode(message)
-        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-        decrypted_text = cipher.decrypt(message)
-        return (decrypted_text[:-ord(decrypted_text[len(decrypted_text) - 1:])])
+        finally:
+            for data_channel in data_channels:
+                data_channel.close()
 
-    def encrypt(self, message):
+    @staticmethod
+    def parse_transfer_args(args: List[str]) -> Tuple[Optional[str], dict]:
         """
-        Encrypts passed message that is going to be sent
+        Parses arguments of "get" or "put" command. Returns path, None if missing, and options of the transfer.
+        Raises ValueError for invalid compression.
         """
-        message = message + (AES.block_size - len(message) % AES.block_size) * str.encode(
-            chr(AES.block_size - len(message) % AES.block_size))
-        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-        encrypted_text = cipher.encrypt(message)
-        return base64.b64encode(encrypted_text)
+        options = {'is_text_mode': False, 'resume': False, 'skip_same': False, 'delta': False, 'compression': None}
+        for arg in args:
+            if arg == '-t' or arg == '-T':
+                options['is_text_mode'] = True
+            elif arg == '-r' or arg == '-R':
+                options['resume'] = True
+            elif arg == '-s' or arg == '-S':
+                options['skip_same'] = True
+            elif arg == '-d' or arg == '-D':
+                options['delta'] = True
+            elif arg[:2] == '-z' or arg[:2] == '-Z':
+                options['compression'] = parse_compression(arg[3:])
+
+        i = 0
+        while i < len(args) and len(args[i]) and args[i][0] == '-':
+            i += 1
+        return (args[i] if i < len(args) else None), options
 
     def handle_user_input(self) -> None:
         """
@@ -327,26 +489,22 @@ class Client:
                 """
                 Downloads file from specified path. Default mode = binary.
                 Syntax:
-                get <path> <mode>
+                get <path> <mode> <-r> <-d> <-z[=algorithm[:level]]>
                 mode = -b | -t
+                -r = resume interrupted binary download from where it stopped
+                -d = update existing local copy with changes of binary file only
+                -z = compress data sent, algorithm = zlib | lzma (default = zlib), level = 0-9
                 """
-                args = args.split()
-                client.is_text_mode = False
                 try:
-                    for arg in args:
-                        if arg == '-t' or arg == '-T':
-                            client.is_text_mode = True
-
-                    i = 0
-                    while i < len(args) and len(args[i]) and args[i][0] == '-':
-                        i += 1
-                    if i == len(args):
+                    path, options = Client.parse_transfer_args(args.split())
+                    client.is_text_mode = options['is_text_mode']
+                    if path is None:
                         print('*** No file specified')
                         return
-                    path = args[i]
 
                     # Add command to command buffer and wait for response
-                    client.command_buffer.put({'get': path})
+                    client.command_buffer.put({'get': path, 'resume': options['resume'], 'delta': options['delta'],
+                                               'compression': options['compression']})
                     client.command_thread_event.set()
                     client.input_thread_event.wait()  # Wait for command thread response
                     client.input_thread_event.clear()
@@ -358,6 +516,8 @@ class Client:
                         print('Closing app...')
                     else:
                         print('*** Invalid file path.')
+                except ValueError as e:
+                    print(f'*** {e}')
                 except Exception as e:
                     print(f'Exception occurred during handling "get" command\n{e}')
 
@@ -365,35 +525,33 @@ class Client:
                 """
                 Uploads file from specified path to current remote directory. Default mode = binary.
                 Syntax:
-                put <path> <mode>
+                put <path> <mode> <-r> <-s> <-d> <-z[=algorithm[:level]]>
                 mode = -b | -t
+                -r = resume interrupted binary upload from where it stopped
+                -s = skip binary upload if server already has file with the same content
+                -d = update existing remote copy with changes of binary file only
+                -z = compress data sent, algorithm = zlib | lzma (default = zlib), level = 0-9
                 """
                 try:
-                    args = args.split()
-
-                    for arg in args:
-                        if arg == '-t' or arg == '-T':
-                            client.is_text_mode = True
-
-                    i = 0
-                    while i < len(args) and len(args[i]) and args[i][0] == '-':
-                        i += 1
-                    if i == len(args):
+                    path, options = Client.parse_transfer_args(args.split())
+                    client.is_text_mode = client.is_text_mode or options['is_text_mode']
+                    if path is None:
                         print('*** No file specified')
                         return
-                    path = args[i]
 
                     # Check if specified file exists
                     if not os.path.isfile(path):
                         print('*** Invalid file path.')
                         return
                     # Add command to command buffer and wait for response
-                    client.command_buffer.put({'put': path, 'is_text_mode': client.is_text_mode})
+                    client.command_buffer.put({**options, 'put': path, 'is_text_mode': client.is_text_mode})
                     client.command_thread_event.set()
                     client.input_thread_event.wait()  # Wait for command thread response
                     client.input_thread_event.clear()
                     command = client.command_buffer.get()
-                    if 'put' in command.keys() and command['put'] != 'ERR':
+                    if 'put' in command.keys() and command['put'] == 'DONE':  # Nothing had to be uploaded
+                        pass
+                    elif 'put' in command.keys() and command['put'] != 'ERR':
                         print('Uploading...')
                     elif 'ERR' in command.keys():  # No connection
                         self.emergency_exit = True
@@ -401,9 +559,82 @@ class Client:
                     else:
                         print('*** Invalid file path.')
 
+                except ValueError as e:
+                    print(f'*** {e}')
                 except Exception as e:
                     print(f'Exception occurred during handling "put" command\n{e}')
 
+            def do_mget(self, args) -> None:
+                """
+                Downloads many files with one command. Files are sent back to back without a round trip per file
+                and saved in current local directory. Default mode = binary.
+                Syntax:
+                mget <path/pattern> [<path/pattern> ...] <mode>
+                mode = -b | -t
+                pattern = glob pattern matched on server e.g. "logs/*.txt"
+                """
+                args = args.split()
+                try:
+                    is_text_mode = '-t' in args or '-T' in args
+                    patterns = [arg for arg in args if arg[0] != '-']
+                    if not patterns:
+                        print('*** No file specified')
+                        return
+
+                    # Add command to command buffer and wait for response
+                    client.command_buffer.put({'mget': patterns, 'is_text_mode': is_text_mode})
+                    client.command_thread_event.set()
+                    client.input_thread_event.wait()  # Wait for command thread response
+                    client.input_thread_event.clear()
+                    command = client.command_buffer.get()
+                    if 'mget' in command.keys() and command['mget'] != 'ERR':
+                        print(f'Downloading {len(command["mget"])} file(s)...')
+                    elif 'ERR' in command.keys():  # No connection
+                        self.emergency_exit = True
+                        print('Closing app...')
+                    else:
+                        print('*** No matching files.')
+                except Exception as e:
+                    print(f'Exception occurred during handling "mget" command\n{e}')
+
+            def do_mput(self, args) -> None:
+                """
+                Uploads many files with one command to current remote directory. Files are sent back to back without
+                a round trip per file. Default mode = binary.
+                Syntax:
+                mput <path/pattern> [<path/pattern> ...] <mode>
+                mode = -b | -t
+                pattern = glob pattern matched on local machine e.g. "logs/*.txt"
+                """
+                args = args.split()
+                try:
+                    is_text_mode = '-t' in args or '-T' in args
+                    filepaths = dict()
+                    for pattern in (arg for arg in args if arg[0] != '-'):
+                        for filepath in sorted(glob.glob(pattern)):
+                            if os.path.isfile(filepath):
+                                filepaths[filepath] = None
+                    if not filepaths:
+                        print('*** No matching files.')
+                        return
+
+                    # Add command to command buffer and wait for response
+                    client.command_buffer.put({'mput': list(filepaths), 'is_text_mode': is_text_mode})
+                    client.command_thread_event.set()
+                    client.input_thread_event.wait()  # Wait for command thread response
+                    client.input_thread_event.clear()
+                    command = client.command_buffer.get()
+                    if 'mput' in command.keys() and command['mput'] != 'ERR':
+                        print(f'Uploading {len(filepaths)} file(s)...')
+                    elif 'ERR' in command.keys():  # No connection
+                        self.emergency_exit = True
+                        print('Closing app...')
+                    else:
+                        print('*** Server refused the upload.')
+
+                except Exception as e:
+                    print(f'Exception occurred during handling "mput" command\n{e}')
+
             def do_fl(self, args) -> None:
                 """
                 Flip prompt from local to remote or vice versa.
@@ -461,21 +692,60 @@ class Client:
                 - recursion_level: default = '1' (prints all from current directory);
                                    if equals to -1 - prints all levels
                 """
-                # Add command to command buffer and wait for response
+                # Add command to command buffer and wait for response. Output comes in pages, each is printed
+                # as soon as it arrives and the next one is requested with cursor of the previous one.
+                try:
+                    request = {'ls': args}
+                    while request:
+                        client.command_buffer.put(request)
+                        client.command_thread_event.set()
+                        client.input_thread_event.wait()  # Wait for command thread response
+                        client.input_thread_event.clear()
+                        command = client.command_buffer.get()
+                        request = None
+                        if 'ls' in command.keys() and command['ls'] != 'ERR':
+                            if command['ls']:
+                                print(command['ls'])
+                            if 'cursor' in command.keys():
+                                request = {'ls': args, 'cursor': command['cursor']}
+                        elif 'ERR' in command.keys():
+                            self.do_exit(args)
+                        else:
+                            print('*** Invalid arguments for command "ls".')
+                except Exception as e:
+                    print(f'Exception occurred during handling "ls" command\n{e}')
+
+            def do_mlsd(self, args) -> None:
+                """
+                List remote directory as records of type, size, modification time and name, optionally with SHA-256
+                of files. Whole directory comes in one reply, so nothing else needs to be asked to compare it.
+                Syntax:
+                mlsd <dir/path_to_dir> <-h>
+                - dir: default = current remote directory
+                -h = include SHA-256 of files
+                """
+                args = args.split()
                 try:
-                    client.command_buffer.put({'ls': args})
+                    with_hash = '-h' in args or '-H' in args
+                    paths = [arg for arg in args if arg[0] != '-']
+                    client.command_buffer.put({'mlsd': paths[0] if paths else '', 'hashes': with_hash})
                     client.command_thread_event.set()
                     client.input_thread_event.wait()  # Wait for command thread response
                     client.input_thread_event.clear()
                     command = client.command_buffer.get()
-                    if 'ls' in command.keys() and command['ls'] != 'ERR':
-                        print(command['ls'])
+                    if 'mlsd' in command.keys() and command['mlsd'] != 'ERR':
+                        for name, entry_type, size, mtime, *digest in command['mlsd']:
+                            modified = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime / 1e9))
+                            line = f'{entry_type:<4} {size:>14} {modified} {name}'
+                            if digest and digest[0]:
+                                line += f' {digest[0]}'
+                            print(line)
                     elif 'ERR' in command.keys():
                         self.do_exit(args)
                     else:
-                        print('*** Invalid arguments for command "ls".')
+                        print('*** Invalid path to directory.')
                 except Exception as e:
-                    print(f'Exception occurred during handling "ls" command\n{e}')
+                    print(f'Exception occurred during handling "mlsd" command\n{e}')
 
             def do_exit(self, args) -> bool:
                 """
@@ -510,152 +780,406 @@ class Client:
             self.command_thread_event.clear()  # Reset flag
             command = self.command_buffer.get()
 
-            if 'cd' in command.keys() or 'ls' in command.keys():
-                try:
-                    self.send_object_message(s, command)
-                    message = self.receive_object_message(s)
-                    self.command_buffer.put(message)
-                    self.input_thread_event.set()
-                except Exception as e:
-                    print(f'Exception occurred in Command Channel while handling "cd" or "ls" command\n{e}')
-                    self.exit = True
-                    self.command_buffer.put({'ERR': ''})
-                    self.input_thread_event.set()
+            try:
+                if 'cd' in command.keys() or 'ls' in command.keys() or 'mlsd' in command.keys():
+                    reply = self.exchange(s, command)
+                elif 'get' in command.keys():
+                    reply, _ = self.request_get(s, command)
+                elif 'put' in command.keys():
+                    reply, _ = self.request_put(s, command)
+                elif 'mget' in command.keys():
+                    reply, _ = self.request_mget(s, command)
+                elif 'mput' in command.keys():
+                    reply, _ = self.request_mput(s, command)
+                elif 'exit' in command.keys():
+                    self.close_session(s)
+                    quit(0)
+                else:
+                    print(f'*** Received invalid command: {command}')
+                    continue
 
-            elif 'get' in command.keys():
-                try:
-                    new_filename = ''
-                    # Check if file with specific name exists locally
-                    if os.path.isfile(os.path.join(os.getcwd(), command['get'])):
-                        print('File with such path already exists on local machine')
-                        # Add random extension to filename in such case
-                        path, filename = os.path.split(command['get'])
-                        filename, file_type = os.path.splitext(filename)
-                        extension = ''.join([str(random.randint(0, 9)) for _ in range(10)])
-                        new_filename = f'{filename}_{extension}{file_type}'
-                        print(f'File will be saved as: {new_filename}')
-
-                    self.send_object_message(s, command)
-                    message = self.receive_object_message(s)
-                    self.command_buffer.put(message)
-                    self.input_thread_event.set()
-                    if message['get'] == 'OK':
-                        # Initialize download
-                        self.command_data_communication_buffer.put({'get': [command['get'], new_filename]})
-                        self.data_thread_event.set()
-                        self.command_thread_event.wait()
-                        self.command_thread_event.clear()
-                        self.send_object_message(s, {'get': 'ready'})
-                except Exception as e:
-                    print(f'Exception occurred in Command Channel while handling "get" command\n{e}')
-                    self.exit = True
-                    self.command_buffer.put({'ERR': ''})
-                    self.input_thread_event.set()
+            except Exception as e:
+                print(f'Exception occurred in Command Channel while handling "{next(iter(command))}" command\n{e}')
+                self.exit = True
+                reply = {'ERR': ''}
 
-            elif 'put' in command.keys():
-                try:
-                    self.send_object_message(s, command)
-                    message = self.receive_object_message(s)
-                    if message['put'][0] == 'OK':
-                        if message['put'][1] != '':
-                            print(message['put'][1])
+            self.command_buffer.put(reply)
+            self.input_thread_event.set()
 
-                        self.command_buffer.put({'put': 'OK'})
-                        self.input_thread_event.set()
+        # Exit app
+        quit(0)
 
-                        self.command_data_communication_buffer.put(command)
-                        message = self.receive_object_message(s)
-                        if message['put'] == 'ready':
-                            # Inform Data Channel
-                            self.data_thread_event.set()
+    def exchange(self, s: socket.socket, command: dict) -> dict:
+        """
+        Sends command answered with one message and returns the answer, e.g. "cd", "ls" or "mlsd".
+        """
+        self.send_object_message(s, command)
+        message = self.receive_object_message(s)
+        if message is None:
+            raise ConnectionError('Server closed Command Channel!')
+        return message
 
-                except Exception as e:
-                    print(f'Exception occurred in Command Channel while handling "put" command\n{e}')
-                    self.exit = True
-                    self.command_buffer.put({'ERR': ''})
-                    self.input_thread_event.set()
+    def request_get(self, s: socket.socket, command: dict) -> Tuple[dict, Optional[Future]]:
+        """
+        Asks server for file of "get" command and starts its download. Returns answer of server and future of
+        the download, which is started only if server accepted the command.
+        """
+        is_text_mode = command.get('is_text_mode', self.is_text_mode)
+        request = {'get': command['get'], 'is_text_mode': is_text_mode, 'offset': 0}
+
+        # Existing local copy is updated with changes only - server is sent signature of the copy
+        if command.get('delta') and not is_text_mode and self.reserve_update(command['get']):
+            f_name = command['get']
+            try:
+                request['signature'], request['block'] = file_signature(f_name)
+            except OSError:
+                self.release_downloads([f_name])
+                raise
+        else:
+            # Check if file with specific name exists locally or is being downloaded
+            f_name, = self.reserve_downloads([command['get']])
+
+            # Offsets of text mode transfers do not match file sizes, so they are never resumed
+            if command.get('resume') and not is_text_mode and f_name == command['get']:
+                request['offset'] = partial_size(f_name)
+                if request['offset']:
+                    print(f'Resuming download of {f_name} from byte {request["offset"]}')
+
+            # Server decides if data is worth compressing
+            if command.get('compression'):
+                request['compression'], request['level'] = command['compression']
+
+        # Streams are open before server starts sending. Server decides how many of them it uses.
+        stream_id = self.new_stream_id()
+        streams = open_streams(self.data_channels, stream_id)
+        try:
+            message = self.exchange(s, {**request, 'stream': stream_id})
+        except Exception:
+            close_streams(self.data_channels, stream_id)
+            self.release_downloads([f_name])
+            raise
+        if message['get'] != 'OK':
+            close_streams(self.data_channels, stream_id)
+            self.release_downloads([f_name])
+            return message, None
+
+        used = stripe_channels(range(len(self.data_channels)), stream_id, message['stripes'])
+        close_streams([channel for i, channel in enumerate(self.data_channels) if i not in used], stream_id)
+
+        # Initialize download
+        if message.get('delta', False):
+            return message, self.start_transfer(self.download_delta, streams[used[0]], f_name, message['size'],
+                                                request['block'])
+        if 'compression' in request and 'compression' not in message:
+            print(f'{command["get"]} does not compress, it is sent uncompressed.')
+        return message, self.start_transfer(self.download_file, [streams[i] for i in used], f_name, message['size'],
+                                            request['offset'], is_text_mode, message.get('compression'))
+
+    def request_put(self, s: socket.socket, command: dict) -> Tuple[dict, Optional[Future]]:
+        """
+        Offers file of "put" command to server and starts its upload. Returns {"put": "OK"} and future of the upload
+        if server accepted it, {"put": "DONE"} if nothing had to be uploaded, answer of server otherwise.
+        """
+        command = dict(command)
+        stream_id = self.new_stream_id()
+        size = os.path.getsize(command['put'])
+        stripes = plan_stripes(size, len(self.data_channels), command['is_text_mode'])
+        # Server skips upload of content it already has, if it knows its hash
+        if command.pop('skip_same', False) and not command['is_text_mode']:
+            command['hash'] = hash_file(command['put'])
+        # Data which does not compress is sent as it is
+        compression = command.pop('compression', None)
+        if compression and is_file_compressible(command['put']):
+            command['compression'], command['level'] = compression
+        elif compression:
+            print(f'{command["put"]} does not compress, it is sent uncompressed.')
+        message = self.exchange(s, {**command, 'stream': stream_id, 'size': size, 'stripes': stripes})
+        if message['put'][0] in ('SKIP', 'LINK'):
+            print(message['put'][1])
+            return {'put': 'DONE'}, None
+        if message['put'][0] != 'OK':
+            return message, None
+
+        if message['put'][1] != '':
+            print(message['put'][1])
+        # Server opened the stream before answering. It sends signature of its copy if the file is updated with
+        # changes only.
+        if 'signature' in message:
+            return {'put': 'OK'}, self.start_transfer(self.upload_delta, stream_id, command['put'], size,
+                                                      message['signature'], message['block'])
+        return {'put': 'OK'}, self.start_transfer(self.upload_file, stream_id, command['put'], size, stripes,
+                                                  message.get('offset', 0),
+                                                  compression if 'compression' in message else None)
+
+    def request_mget(self, s: socket.socket, command: dict) -> Tuple[dict, Optional[Future]]:
+        """
+        Asks server for files of "mget" command and starts their download.
+        """
+        # Streams are open before server starts sending. Server decides how many of them it uses.
+        stream_id = self.new_stream_id()
+        streams = open_streams(self.data_channels, stream_id)
+        try:
+            message = self.exchange(s, {**command, 'stream': stream_id})
+        except Exception:
+            close_streams(self.data_channels, stream_id)
+            raise
+        if message['mget'] == 'ERR':
+            close_streams(self.data_channels, stream_id)
+            return message, None
+
+        used = stripe_channels(range(len(self.data_channels)), stream_id, message['stripes'])
+        close_streams([channel for i, channel in enumerate(self.data_channels) if i not in used], stream_id)
+
+        # Files are saved in current local directory under their remote names
+        f_names = self.reserve_downloads([os.path.basename(filename) for filename, _ in message['mget']])
+        files = [(f_name, size) for f_name, (_, size) in zip(f_names, message['mget'])]
+        return message, self.start_transfer(self.download_files, [streams[i] for i in used], files,
+                                            command['is_text_mode'])
+
+    def request_mput(self, s: socket.socket, command: dict) -> Tuple[dict, Optional[Future]]:
+        """
+        Offers files of "mput" command to server and starts their upload.
+        """
+        stream_id = self.new_stream_id()
+        files = [(filepath, os.path.getsize(filepath)) for filepath in command['mput']]
+        stripes = min(len(self.data_channels), len(files))
+        message = self.exchange(s, {'mput': [[filepath, size] for filepath, size in files],
+                                    'is_text_mode': command['is_text_mode'], 'stream': stream_id, 'stripes': stripes})
+        if message['mput'] == 'ERR':
+            return message, None
+
+        for info in message['mput']:
+            if info != '':
+                print(info)
+        # Server opened the streams before answering
+        return message, self.start_transfer(self.upload_files, stream_id, files, stripes)
+
+    def close_session(self, s: socket.socket) -> None:
+        """
+        Lets running transfers finish, then closes Data Channel and Command Channel.
+        """
+        self.exit = True
+        if any(t.is_alive() for t in self.transfers):
+            print('Waiting for transfers to finish...')
+        for t in self.transfers:
+            t.join()
+        for channel in self.data_channels:
+            channel.close()
+        print('Data Channel closed.')
 
-            elif 'exit' in command.keys():
-                # First close Data Channel
-                self.exit = True
-                self.data_thread_event.set()
-                self.command_thread_event.wait()  # Sleep until Data Channel is not closed
-                self.command_thread_event.clear()  # Reset flag
+        s.close()
+        print('Command Channel closed.')
+        if self.profile:
+            self.profile.close()
+
+    @staticmethod
+    def choose_local_path(filepath: str, taken: Iterable[str] = ()) -> str:
+        """
+        Returns path downloaded file is saved under. Existing files and taken paths are not overwritten.
+        """
+        if not os.path.isfile(os.path.join(os.getcwd(), filepath)) and filepath not in taken:
+            return filepath
+
+        print('File with such path already exists on local machine')
+        # Add random extension to filename in such case
+        path, filename = os.path.split(filepath)
+        filename, file_type = os.path.splitext(filename)
+        extension = ''.join([str(random.randint(0, 9)) for _ in range(10)])
+        new_filename = f'{filename}_{extension}{file_type}'
+        print(f'File will be saved as: {new_filename}')
+        return new_filename
+
+    def reserve_downloads(self, filepaths: List[str]) -> List[str]:
+        """
+        Chooses local path of each downloaded file and marks it as being downloaded until release_downloads.
+        """
+        f_names = []
+        with self.files_in_transfer_mutex:
+            for filepath in filepaths:
+                f_name = Client.choose_local_path(filepath, self.files_in_transfer)
+                self.files_in_transfer.add(f_name)
+                f_names.append(f_name)
+        return f_names
+
+    def reserve_update(self, f_name: str) -> bool:
+        """
+        Marks existing local file updated by delta download as being downloaded until release_downloads.
+        Returns False if there is no such file or it is being downloaded.
+        """
+        with self.files_in_transfer_mutex:
+            if not os.path.isfile(f_name) or f_name in self.files_in_transfer:
+                return False
+            self.files_in_transfer.add(f_name)
+        return True
 
-                # Then close Command Channel
-                s.close()
-                print('Command Channel closed.')
+    def release_downloads(self, f_names: Iterable[str]) -> None:
+        with self.files_in_transfer_mutex:
+            self.files_in_transfer.difference_update(f_names)
 
-                # Finally, quit the app
-                quit(0)
+    def new_stream_id(self) -> int:
+        self.last_stream_id += 1
+        return self.last_stream_id
 
-            else:
-                print(f'*** Received invalid command: {command}')
+    def profile_transfer(self, kind: str, target: str, size: int) -> Union[TransferProfile, Unprofiled]:
+        """
+        Returns profile transfer records its stages in, which does nothing unless the session is profiled.
+        """
+        return self.profile.transfer(kind, target, size) if self.profile else UNPROFILED
 
-        # Exit app
-        self.data_thread_event.set()
-        self.command_thread_event.wait()  # Sleep until Data Channel is not closed
-        self.command_thread_event.clear()  # Reset flag
-        s.close()
-        print('Command Channel closed.')
-        quit(0)
+    def start_transfer(self, target, *args) -> Future:
+        """
+        Runs transfer in its own thread, so it does not block following commands. Returned future is done when the
+        transfer ends and holds its exception, if it failed.
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def run() -> None:
+            try:
+                future.set_result(target(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.transfers = [t for t in self.transfers if t.is_alive()]
+        t = threading.Thread(target=run)
+        self.transfers.append(t)
+        t.start()
+        return future
+
+    def download_file(self, streams: List[Iterator[bytes]], f_name: str, size: int, offset: int,
+                      is_text_mode: bool, compression: Optional[str] = None) -> None:
+        """
+        Receives file requested with "get" command from its Data Channel streams into partial file, which is renamed
+        to f_name once complete. Partial file of failed download is kept, so "get -r" can resume it.
+        """
+        profile = self.profile_transfer('get', f_name, size - offset)
+        new_decryptor = profile.timed_decryptors(partial(make_decryptor, self.cipher, self.key, self.iv))
+        try:
+            with profile.timed('get'):
+                with profile.timed_file(open_partial(f_name, offset)) as f:
+                    receive_file_striped(profile.timed_frames(streams), f, size, new_decryptor, is_text_mode, offset,
+                                         partial(make_decompressor, compression) if compression else None)
+                complete_partial(f_name, None if is_text_mode else size)
+            print(f'Download of {f_name} finished.')
 
-    def handle_data_channel(self, data_s: socket.socket) -> None:
-        """
-        Handles data transfer between user and server
-        """
-        while True:
-            self.data_thread_event.wait()
-            self.data_thread_event.clear()
-            if self.exit:
-                # App is about to shut down - disconnect
-                data_s.close()
-                self.command_thread_event.set()
-                print('Data Channel closed.')
-                break
-
-            command = self.command_data_communication_buffer.get()
-            if 'get' in command.keys():
-                f_name = command['get'][0] if command['get'][1] == '' else command['get'][1]
-                with open(f_name, 'wb') as f:
-                    self.command_thread_event.set()  # Inform Command Channel about readiness
-                    try:
-                        data_header = data_s.recv(Client.HEADER_LENGTH)
-                        if not data_header:
-                            print('Failed to receive data header!')
-                            break
-
-                        data_length = int(data_header.decode('utf-8').strip())
-                        data = data_s.recv(data_length)
-
-                        if not data:
-                            print('Failed to receive data!')
-                            break
-
-                        data = Client.decrypt(self, data)
-
-                        if self.is_text_mode:
-                            data = data.replace(b"/n/r", b"/n")
-                            if platform.system() == "Windows":
-                                data = data.replace(b"/n", b"/n/r")
-                            elif platform.system() != "Linux":
-                                print(f'detected an unsupported system: {platform.system()}, '
-                                      f'assuming Linux-like behavior')
-
-                        f.write(data)
-
-                    except Exception as e:
-                        print(f'Exception occurred during receiving data!\n{e}')
-                        return None
-
-            elif 'put' in command.keys():
-                with open(command['put'], 'rb') as f:
-
-                    data = f.read()
-                    data = Client.encrypt(self, data)
-                    filesize = len(data)
-                    data_header = bytes(f'{filesize:<{Client.HEADER_LENGTH}}', 'utf-8')
-                    data_s.sendall(data_header + data)
+        except Exception as e:
+            print(f'Exception occurred during receiving data!\n{e}')
+            raise
+
+        finally:
+            abandon_streams(streams)
+            self.release_downloads([f_name])
+
+    def upload_file(self, stream_id: int, f_name: str, size: int, stripes: int, offset: int,
+                    compression: Optional[Tuple[str, int]] = None) -> None:
+        """
+        Sends file of "put" command on its Data Channel streams, starting from offset already received by server.
+        Data is compressed with (algorithm, level) of compression, if given.
+        """
+        channels = stripe_channels(self.data_channels, stream_id, stripes)
+        profile = self.profile_transfer('put', f_name, size - offset)
+        try:
+            f = profile.timed_file(open(f_name, 'rb'))
+        except OSError as e:
+            for channel in channels:
+                channel.send(stream_id, b'')  # Release server waiting for the stream
+            print(f'Exception occurred during sending data!\n{e}')
+            raise
+
+        try:
+            with f, profile.timed('put'):
+                send_file_striped(profile.timed_channels(channels), stream_id, f, size,
+                                  profile.timed_encryptors(partial(make_encryptor, self.cipher, self.key, self.iv)),
+                                  offset, partial(make_compressor, *compression) if compression else None)
+            print(f'Upload of {f_name} finished.')
+
+        except Exception as e:
+            print(f'Exception occurred during sending data!\n{e}')
+            raise
+
+    def download_delta(self, frames: Iterator[bytes], f_name: str, size: int, block_size: int) -> None:
+        """
+        Rebuilds file requested with "get -d" from its local copy and received changes into partial file, which
+        replaces the copy once complete.
+        """
+        profile = self.profile_transfer('get_delta', f_name, size)
+        try:
+            with profile.timed('get_delta'):
+                with profile.timed_file(open_partial(f_name, 0)) as f, profile.timed_file(open(f_name, 'rb')) as basis:
+                    receive_delta(profile.timed_frames([frames])[0], basis, f, block_size,
+                                  profile.timed_decryptors(partial(make_decryptor, self.cipher, self.key, self.iv))())
+                complete_partial(f_name, size)
+            print(f'Download of {f_name} finished.')
+
+        except Exception as e:
+            print(f'Exception occurred during receiving data!\n{e}')
+            raise
+
+        finally:
+            abandon_streams([frames])
+            self.release_downloads([f_name])
+
+    def upload_delta(self, stream_id: int, f_name: str, size: int, signature: bytes, block_size: int) -> None:
+        """
+        Sends changes of file of "put -d" command against signature of server's copy.
+        """
+        channel = stripe_channels(self.data_channels, stream_id, 1)[0]
+        profile = self.profile_transfer('put_delta', f_name, size)
+        try:
+            f = profile.timed_file(open(f_name, 'rb'))
+        except OSError as e:
+            channel.send(stream_id, b'')  # Release server waiting for the stream
+            print(f'Exception occurred during sending data!\n{e}')
+            raise
+
+        try:
+            with f, profile.timed('put_delta'):
+                send_delta(profile.timed_channels([channel])[0], stream_id, f, size, signature, block_size,
+                           profile.timed_encryptors(partial(make_encryptor, self.cipher, self.key, self.iv))())
+            print(f'Upload of {f_name} finished.')
+
+        except Exception as e:
+            print(f'Exception occurred during sending data!\n{e}')
+            raise
+
+    def download_files(self, streams: List[Iterator[bytes]], files: List[Tuple[str, int]],
+                       is_text_mode: bool) -> None:
+        """
+        Receives batch of files requested with "mget" command from its Data Channel streams.
+        """
+        profile = self.profile_transfer('mget', ' '.join(f_name for f_name, _ in files),
+                                        sum(size for _, size in files))
+        try:
+            with profile.timed('mget'):
+                receive_batch_striped(profile.timed_frames(streams), files,
+                                      profile.timed_decryptors(partial(make_decryptor, self.cipher, self.key, self.iv)),
+                                      is_text_mode)
+            print(f'Download of {len(files)} file(s) finished.')
+
+        except Exception as e:
+            print(f'Exception occurred during receiving data!\n{e}')
+            raise
+
+        finally:
+            abandon_streams(streams)
+            self.release_downloads([f_name for f_name, _ in files])
+
+    def upload_files(self, stream_id: int, files: List[Tuple[str, int]], stripes: int) -> None:
+        """
+        Sends batch of files of "mput" command on its Data Channel streams.
+        """
+        channels = stripe_channels(self.data_channels, stream_id, stripes)
+        profile = self.profile_transfer('mput', ' '.join(f_name for f_name, _ in files),
+                                        sum(size for _, size in files))
+        try:
+            with profile.timed('mput'):
+                send_batch_striped(profile.timed_channels(channels), stream_id, files,
+                                   profile.timed_encryptors(partial(make_encryptor, self.cipher, self.key, self.iv)))
+            print(f'Upload of {len(files)} file(s) finished.')
+
+        except Exception as e:
+            print(f'Exception occurred during sending data!\n{e}')
+            raise
 
 
 def main() -> None:
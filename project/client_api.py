@@ -0,0 +1,293 @@
+"""
+Client API for scripts and tools - commands are called directly on the Command Channel instead of going through
+the interactive prompt and its command thread. Transfers run in background threads and are returned as futures.
+
+    with Session(['-H', '127.0.0.1', '-n', '4']) as session:
+        session.connect('john', 'pass')
+        session.cd('docs')
+        print(session.ls())
+        session.get('report.pdf').result()
+
+Run as a script, it executes a command file in batch mode:
+
+    python client_api.py -u john -f commands.txt [client options]
+"""
+import argparse
+import getpass
+import glob
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+from client import Client
+
+
+class CommandError(Exception):
+    """
+    Server refused command, e.g. path does not exist.
+    """
+
+
+class Session:
+    """
+    Logged in connection of one client. Commands of concurrent threads are sent one at a time, transfers run
+    concurrently.
+    """
+
+    def __init__(self, argv: Optional[List[str]] = None):
+        """
+        argv are options of client command line, e.g. ["-H", "127.0.0.1", "-n", "4"].
+        """
+        self.client = Client(Client.get_args(argv or []))
+        self.s = None
+        self.transfers: List[Future] = list()
+        self.mutex = threading.Lock()
+
+    def __enter__(self) -> 'Session':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def connect(self, username: str, password: str) -> None:
+        """
+        Connects, logs in and establishes Data Channel. Server expects credentials right after TLS handshake,
+        so logging in is part of connecting.
+        """
+        self.client.set_credentials(username, password)
+        self.s = self.client.connect()
+        if not self.s:
+            raise ConnectionError(f'Could not connect to {self.client.server_host}:{self.client.server_port}!')
+
+    def command(self, request: dict) -> dict:
+        """
+        Sends command answered with one message and returns the answer.
+        """
+        with self.mutex:
+            return self.client.exchange(self.connection(), request)
+
+    def connection(self) -> socket.socket:
+        if not self.s:
+            raise ConnectionError('Session is not connected!')
+        return self.s
+
+    def cd(self, path: str) -> str:
+        """
+        Changes remote working directory, returns the new one.
+        """
+        reply = self.command({'cd': path})
+        if reply['cd'] == 'ERR':
+            raise CommandError(f'Invalid path to directory: {path}')
+        return reply['cd']
+
+    def ls(self, args: str = '') -> str:
+        """
+        Returns listing of remote directory, args as of "ls" command. All pages are joined.
+        """
+        pages = []
+        request = {'ls': args}
+        while request:
+            reply = self.command(request)
+            if reply['ls'] == 'ERR':
+                raise CommandError(f'Invalid arguments for command "ls": {args}')
+            if reply['ls']:
+                pages.append(reply['ls'])
+            request = {'ls': args, 'cursor': reply['cursor']} if 'cursor' in reply else None
+        return '\n'.join(pages)
+
+    def mlsd(self, path: str = '', hashes: bool = False) -> List[list]:
+        """
+        Returns records [name, type, size, modification time in ns, (SHA-256)] of remote directory.
+        """
+        reply = self.command({'mlsd': path, 'hashes': hashes})
+        if reply['mlsd'] == 'ERR':
+            raise CommandError(f'Invalid path to directory: {path}')
+        return reply['mlsd']
+
+    def get(self, path: str, is_text_mode: bool = False, resume: bool = False, delta: bool = False,
+            compression: Optional[Tuple[str, int]] = None) -> Future:
+        """
+        Starts download of remote file into current local directory, options as of "get" command. Compression is
+        (algorithm, level), see compression.parse_compression.
+        """
+        with self.mutex:
+            reply, future = self.client.request_get(self.connection(), {'get': path, 'is_text_mode': is_text_mode,
+                                                                        'resume': resume, 'delta': delta,
+                                                                        'compression': compression})
+        if future is None:
+            raise CommandError(f'Invalid file path: {path}')
+        return self.track(future)
+
+    def put(self, path: str, is_text_mode: bool = False, resume: bool = False, skip_same: bool = False,
+            delta: bool = False, compression: Optional[Tuple[str, int]] = None) -> Future:
+        """
+        Starts upload of local file into current remote directory, options as of "put" command. Future of upload
+        server skipped is already done.
+        """
+        if not os.path.isfile(path):
+            raise CommandError(f'Invalid file path: {path}')
+        with self.mutex:
+            reply, future = self.client.request_put(self.connection(), {
+                'put': path, 'is_text_mode': is_text_mode, 'resume': resume, 'skip_same': skip_same, 'delta': delta,
+                'compression': compression})
+        if reply['put'] == 'DONE':
+            future = Future()
+            future.set_result(None)
+        elif future is None:
+            raise CommandError(f'Server refused upload of {path}')
+        return self.track(future)
+
+    def mget(self, patterns: List[str], is_text_mode: bool = False) -> Future:
+        """
+        Starts download of remote files matching glob patterns into current local directory.
+        """
+        with self.mutex:
+            reply, future = self.client.request_mget(self.connection(), {'mget': list(patterns),
+                                                                         'is_text_mode': is_text_mode})
+        if future is None:
+            raise CommandError(f'No matching files: {" ".join(patterns)}')
+        return self.track(future)
+
+    def mput(self, patterns: List[str], is_text_mode: bool = False) -> Future:
+        """
+        Starts upload of local files matching glob patterns into current remote directory.
+        """
+        filepaths = dict()
+        for pattern in patterns:
+            for filepath in sorted(glob.glob(pattern)):
+                if os.path.isfile(filepath):
+                    filepaths[filepath] = None
+        if not filepaths:
+            raise CommandError(f'No matching files: {" ".join(patterns)}')
+        with self.mutex:
+            reply, future = self.client.request_mput(self.connection(), {'mput': list(filepaths),
+                                                                         'is_text_mode': is_text_mode})
+        if future is None:
+            raise CommandError('Server refused the upload.')
+        return self.track(future)
+
+    def track(self, future: Future) -> Future:
+        with self.mutex:
+            self.transfers = [transfer for transfer in self.transfers if not transfer.done()]
+            self.transfers.append(future)
+        return future
+
+    def wait(self) -> List[Exception]:
+        """
+        Waits for all started transfers, returns exceptions of the failed ones.
+        """
+        with self.mutex:
+            transfers, self.transfers = self.transfers, list()
+        return [transfer.exception() for transfer in transfers if transfer.exception()]
+
+    def close(self) -> None:
+        """
+        Lets running transfers finish and closes connection.
+        """
+        if self.s:
+            with self.mutex:
+                self.client.close_session(self.s)
+                self.s = None
+
+
+def run_batch(session: Session, lines: List[str], keep_going: bool) -> int:
+    """
+    Runs commands of command file, one per line, with syntax of interactive prompt. Transfers run concurrently
+    until "wait", "cld" or the end of file. Returns number of failed commands and transfers.
+    """
+    failures = 0
+    for number, line in enumerate(lines, 1):
+        args = line.split()
+        if not args or args[0].startswith('#'):
+            continue
+        name, args = args[0].lower(), args[1:]
+        try:
+            if name == 'cd':
+                print(session.cd(args[0] if args else '.'))
+            elif name == 'ls':
+                print(session.ls(' '.join(args)))
+            elif name == 'mlsd':
+                paths = [arg for arg in args if arg[0] != '-']
+                for record_name, entry_type, size, mtime, *digest in session.mlsd(paths[0] if paths else '',
+                                                                                  '-h' in args or '-H' in args):
+                    modified = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime / 1e9))
+                    print(f'{entry_type:<4} {size:>14} {modified} {record_name}'
+                          f'{" " + digest[0] if digest and digest[0] else ""}')
+            elif name in ('get', 'put'):
+                path, options = Client.parse_transfer_args(args)
+                if path is None:
+                    raise CommandError('No file specified')
+                if name == 'get':
+                    del options['skip_same']
+                    session.get(path, **options)
+                else:
+                    session.put(path, **options)
+            elif name in ('mget', 'mput'):
+                patterns = [arg for arg in args if arg[0] != '-']
+                is_text_mode = '-t' in args or '-T' in args
+                if name == 'mget':
+                    session.mget(patterns, is_text_mode)
+                else:
+                    session.mput(patterns, is_text_mode)
+            elif name in ('cld', 'wait'):
+                # Relative local paths of running transfers must not change meaning
+                for e in session.wait():
+                    print(f'*** Transfer failed: {e}')
+                    failures += 1
+                if name == 'cld':
+                    os.chdir(args[0])
+            elif name == 'exit':
+                break
+            else:
+                raise CommandError(f'Unknown command: {name}')
+
+        except (CommandError, ValueError, OSError, IndexError) as e:
+            print(f'*** Line {number}: {line.strip()}: {e}')
+            failures += 1
+            if not keep_going or isinstance(e, ConnectionError):
+                break
+
+    for e in session.wait():
+        print(f'*** Transfer failed: {e}')
+        failures += 1
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run commands of a file with simple FTP client. Remaining options '
+                                                 'are options of client, e.g. "-H 127.0.0.1 -n 4".')
+    parser.add_argument('-f', '--file', type=str, default='-', metavar='',
+                        help='Command file (default: standard input)')
+    parser.add_argument('-u', '--user', type=str, required=True, metavar='', help='Username')
+    parser.add_argument('-P', '--password', type=str, default=None, metavar='',
+                        help='Password (default: asked for without echo)')
+    parser.add_argument('-k', '--keep-going', action='store_true', help='Continue after a failed command')
+    args, client_argv = parser.parse_known_args()
+    password = args.password if args.password is not None else getpass.getpass('Insert password: ')
+
+    if args.file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(args.file, encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError as e:
+            print(f'Could not read command file!\n{e}')
+            sys.exit(1)
+
+    with Session(client_argv) as session:
+        try:
+            session.connect(args.user, password)
+        except ConnectionError as e:
+            print(e)
+            sys.exit(1)
+        failures = run_batch(session, lines, args.keep_going)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Compact binary codec of Command Channel messages.
+
+Only None, bool, int, str, bytes, list and dict values are supported and dict keys must be one of known message
+fields, so decoding never constructs arbitrary objects (unlike pickle).
+
+Value = tag byte followed by:
+- None, False, True: nothing
+- int: zigzag varint
+- str, bytes: varint length and raw bytes (utf-8 for str)
+- list: varint item count and items
+- dict: varint item count and pairs of field id byte and value
+"""
+from typing import Tuple
+
+# Known message fields and types of their values. Field id is its position - append new fields at the end only.
+FIELDS = {
+    'status': (str,),
+    'name': (bytes,),
+    'pass': (str,),
+    'mode': (str,),
+    'ciphers': (list,),
+    'cipher': (str,),
+    'port': (int,),
+    'cd': (str,),
+    'ls': (str,),
+    'get': (str,),
+    'put': (str, list),
+    'is_text_mode': (bool,),
+    'ERR': (str,),
+    'stream': (int,),
+    'connections': (int,),
+    'ports': (list,),
+    'size': (int,),
+    'stripes': (int,),
+    'resume': (bool,),
+    'offset': (int,),
+    'mget': (list, str),
+    'mput': (list, str),
+    'cursor': (int,),
+    'mlsd': (str, list),
+    'hashes': (bool,),
+    'hash': (str,),
+    'delta': (bool,),
+    'signature': (bytes,),
+    'block': (int,),
+    'compression': (str,),
+    'level': (int,),
+    'ticket': (bytes,),
+    'key': (bytes,),
+    'iv': (bytes,),
+    'expires': (int,),
+    'token': (bytes,),
+    'credential': (bytes,),
+}
+FIELD_IDS = {name: i for i, name in enumerate(FIELDS)}
+FIELD_NAMES = list(FIELDS)
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_STR = 4
+TAG_BYTES = 5
+TAG_LIST = 6
+TAG_DICT = 7
+
+MAX_DEPTH = 16
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    if value < 0x80:
+        out.append(value)
+        return
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _encode(out: bytearray, value: object, depth: int) -> None:
+    if depth > MAX_DEPTH:
+        raise CodecError('Message nested too deeply!')
+
+    value_type = type(value)
+    if value_type is str:
+        data = value.encode('utf-8')
+        out.append(TAG_STR)
+        _write_varint(out, len(data))
+        out += data
+    elif value is None:
+        out.append(TAG_NONE)
+    elif value_type is bool:
+        out.append(TAG_TRUE if value else TAG_FALSE)
+    elif value_type is int:
+        out.append(TAG_INT)
+        _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+    elif value_type in (bytes, bytearray):
+        out.append(TAG_BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif value_type in (list, tuple):
+        out.append(TAG_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _encode(out, item, depth + 1)
+    elif value_type is dict:
+        out.append(TAG_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            field_id = FIELD_IDS.get(key)
+            if field_id is None:
+                raise CodecError(f'Unknown message field: {key}')
+            if type(item) not in FIELDS[key]:
+                raise CodecError(f'Invalid type of message field {key}: {type(item).__name__}')
+            out.append(field_id)
+            _encode(out, item, depth + 1)
+    else:
+        raise CodecError(f'Unsupported type: {value_type.__name__}')
+
+
+def encode_message(message: object) -> bytes:
+    out = bytearray()
+    _encode(out, message, 0)
+    return bytes(out)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise CodecError('Message truncated!')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise CodecError('Varint too long!')
+
+
+def _read_raw(data: bytes, pos: int) -> Tuple[bytes, int]:
+    # Lengths of Command Channel strings almost always fit in one byte
+    length = data[pos] if pos < len(data) else 0x80
+    if length < 0x80:
+        pos += 1
+    else:
+        length, pos = _read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise CodecError('Message truncated!')
+    return data[pos:end], end
+
+
+def _decode(data: bytes, pos: int, depth: int) -> Tuple[object, int]:
+    if depth > MAX_DEPTH:
+        raise CodecError('Message nested too deeply!')
+    if pos >= len(data):
+        raise CodecError('Message truncated!')
+
+    tag = data[pos]
+    pos += 1
+    if tag == TAG_STR:
+        value, pos = _read_raw(data, pos)
+        return value.decode('utf-8'), pos
+    elif tag == TAG_DICT:
+        count, pos = _read_varint(data, pos)
+        message = {}
+        for _ in range(count):
+            if pos >= len(data):
+                raise CodecError('Message truncated!')
+            field_id = data[pos]
+            if field_id >= len(FIELD_NAMES):
+                raise CodecError(f'Unknown message field id: {field_id}')
+            key = FIELD_NAMES[field_id]
+            value, pos = _decode(data, pos + 1, depth + 1)
+            if type(value) not in FIELDS[key]:
+                raise CodecError(f'Invalid type of message field {key}: {type(value).__name__}')
+            message[key] = value
+        return message, pos
+    elif tag == TAG_INT:
+        value, pos = _read_varint(data, pos)
+        return ((value >> 1) if not value & 1 else -((value + 1) >> 1)), pos
+    elif tag == TAG_BYTES:
+        return _read_raw(data, pos)
+    elif tag == TAG_LIST:
+        count, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = _decode(data, pos, depth + 1)
+            items.append(item)
+        return items, pos
+    elif tag == TAG_NONE:
+        return None, pos
+    elif tag == TAG_FALSE:
+        return False, pos
+    elif tag == TAG_TRUE:
+        return True, pos
+    raise CodecError(f'Unknown tag: {tag}')
+
+
+def decode_message(data: bytes) -> object:
+    data = bytes(data)
+    message, pos = _decode(data, 0, 0)
+    if pos != len(data):
+        raise CodecError('Trailing data after message!')
+    return message
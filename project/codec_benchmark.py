@@ -0,0 +1,47 @@
+import argparse
+import pickle
+import timeit
+
+from codec import encode_message, decode_message
+
+# Typical Command Channel messages
+MESSAGES = {
+    'auth': {'name': b'user', 'pass': 'a' * 128},
+    'mode': {'mode': 'p', 'ciphers': ['gcm', 'cbc']},
+    'port': {'port': 54321},
+    'cd': {'cd': '/home/user/projects/ftp'},
+    'ls': {'ls': '. 2'},
+    'get': {'get': 'data/archive.tar.gz'},
+    'put': {'put': ['OK', '']},
+    'status': {'status': 'OK'},
+}
+
+
+def measure(number: int, encode, decode, message: object) -> tuple:
+    """
+    Returns mean encode and decode time of message in microseconds and size of encoded message.
+    """
+    data = encode(message)
+    encode_time = timeit.timeit(lambda: encode(message), number=number) / number * 1e6
+    decode_time = timeit.timeit(lambda: decode(data), number=number) / number * 1e6
+    return encode_time, decode_time, len(data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare per-message cost of codec and pickle.')
+    parser.add_argument('-n', '--number', type=int, default=100000, metavar='',
+                        help='Number of encode/decode calls per message (default: 100000)')
+    args = parser.parse_args()
+
+    print(f'{"message":<8} {"codec enc":>10} {"codec dec":>10} {"size":>5}   '
+          f'{"pickle enc":>10} {"pickle dec":>10} {"size":>5}  (times in us)')
+    for name, message in MESSAGES.items():
+        assert decode_message(encode_message(message)) == message
+        codec_result = measure(args.number, encode_message, decode_message, message)
+        pickle_result = measure(args.number, pickle.dumps, pickle.loads, message)
+        print(f'{name:<8} {codec_result[0]:>10.2f} {codec_result[1]:>10.2f} {codec_result[2]:>5}   '
+              f'{pickle_result[0]:>10.2f} {pickle_result[1]:>10.2f} {pickle_result[2]:>5}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Streaming compression of Data Channel transfers, negotiated per transfer. Data is compressed before encryption.
+Compression is skipped for data whose sample does not compress, e.g. archives, media or encrypted files.
+"""
+import lzma
+import zlib
+from typing import Iterator, Tuple
+
+# Supported algorithms and their default levels, levels go from 0 (fastest) to 9 (smallest)
+COMPRESSIONS = {
+    'zlib': 6,
+    'lzma': 6,
+}
+DEFAULT_COMPRESSION = 'zlib'
+MAX_LEVEL = 9
+
+# Data is sent uncompressed if the first SAMPLE_SIZE bytes do not shrink below MIN_RATIO of their size
+SAMPLE_SIZE = 64 * 1024
+MIN_RATIO = 0.9
+
+
+def parse_compression(spec: str) -> Tuple[str, int]:
+    """
+    Parses "<algorithm>[:<level>]" given by user, empty spec chooses default algorithm.
+    """
+    name, _, level = spec.partition(':')
+    name = name.lower() or DEFAULT_COMPRESSION
+    level = int(level) if level else COMPRESSIONS.get(name, 0)
+    check_compression(name, level)
+    return name, level
+
+
+def check_compression(name: str, level: int) -> None:
+    if name not in COMPRESSIONS:
+        raise ValueError(f'Unsupported compression: {name}. Supported: {", ".join(COMPRESSIONS)}')
+    if not 0 <= level <= MAX_LEVEL:
+        raise ValueError(f'Invalid compression level: {level}')
+
+
+def is_compressible(sample: bytes) -> bool:
+    """
+    Checks if sample compresses well enough to be worth compressing. Fastest zlib level is enough to tell.
+    """
+    return bool(sample) and len(zlib.compress(sample, 1)) < MIN_RATIO * len(sample)
+
+
+def is_file_compressible(filepath: str, offset: int = 0) -> bool:
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        return is_compressible(f.read(SAMPLE_SIZE))
+
+
+def make_compressor(name: str, level: int):
+    """
+    Returns compressor with compress(data) and flush() - compressobj of zlib or LZMACompressor.
+    """
+    if name == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    return zlib.compressobj(level)
+
+
+class Decompressor:
+    """
+    Incremental decompression of one stream. Output of every call is bounded, so a small frame which decompresses
+    to a lot of data does not exhaust memory.
+    """
+
+    def update(self, data: bytes, max_length: int) -> Iterator[bytes]:
+        """
+        Yields decompressed data of received data in pieces of up to max_length bytes.
+        """
+        raise NotImplementedError
+
+    def finish(self) -> None:
+        """
+        Checks that the whole compressed stream was received.
+        """
+        raise NotImplementedError
+
+
+class ZlibDecompressor(Decompressor):
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    def update(self, data: bytes, max_length: int) -> Iterator[bytes]:
+        while True:
+            out = self.decompressor.decompress(data, max_length)
+            if out:
+                yield out
+            if self.decompressor.unused_data:
+                raise ValueError('Data received after the end of compressed stream!')
+            data = self.decompressor.unconsumed_tail
+            if not data and len(out) < max_length:
+                return
+
+    def finish(self) -> None:
+        if not self.decompressor.eof:
+            raise ValueError('Compressed stream ended prematurely!')
+
+
+class LzmaDecompressor(Decompressor):
+
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor()
+
+    def update(self, data: bytes, max_length: int) -> Iterator[bytes]:
+        while True:
+            out = self.decompressor.decompress(data, max_length)
+            data = b''
+            if out:
+                yield out
+            if self.decompressor.unused_data:
+                raise ValueError('Data received after the end of compressed stream!')
+            if self.decompressor.needs_input or self.decompressor.eof:
+                return
+
+    def finish(self) -> None:
+        if not self.decompressor.eof:
+            raise ValueError('Compressed stream ended prematurely!')
+
+
+def make_decompressor(name: str) -> Decompressor:
+    return LzmaDecompressor() if name == 'lzma' else ZlibDecompressor()
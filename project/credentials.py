@@ -0,0 +1,156 @@
+"""
+Credentials of users kept in memory and reloaded when authentication file changes, so logins do not read it.
+
+Client sends hex SHA-512 of its password. Authentication file maps user name to a PBKDF2 hash of it:
+"pbkdf2_sha256$<iterations>$<hex salt>$<hex hash>". Legacy entries holding the hex SHA-512 itself are still accepted,
+run this module to add users or convert legacy entries:
+    python credentials.py add <user> [-i <iterations>]
+    python credentials.py upgrade [-i <iterations>]
+"""
+import argparse
+import getpass
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+AUTH_FILE = 'auth.json'
+# Seconds between checks whether authentication file changed
+RELOAD_INTERVAL = 1.0
+
+KDF_NAME = 'pbkdf2_sha256'
+# Iterations of PBKDF2, each verification takes roughly ITERATIONS / 6.5 million seconds of one core
+ITERATIONS = 200_000
+SALT_LENGTH = 16
+
+
+def hash_password(password_hash: str, iterations: int = ITERATIONS) -> str:
+    """
+    Returns entry of authentication file for hex SHA-512 of password sent by client.
+    """
+    salt = secrets.token_bytes(SALT_LENGTH)
+    derived = hashlib.pbkdf2_hmac('sha256', password_hash.encode('utf-8'), salt, iterations)
+    return f'{KDF_NAME}${iterations}${salt.hex()}${derived.hex()}'
+
+
+def verify_password(entry: str, password_hash: str) -> bool:
+    """
+    Checks hex SHA-512 of password sent by client against entry of authentication file. Comparison takes the same
+    time wherever the hashes differ.
+    """
+    if not entry.startswith(f'{KDF_NAME}$'):
+        return hmac.compare_digest(entry.encode('utf-8'), password_hash.encode('utf-8'))
+    try:
+        _, iterations, salt, expected = entry.split('$')
+        salt, expected, iterations = bytes.fromhex(salt), bytes.fromhex(expected), int(iterations)
+    except ValueError:
+        print('Invalid entry in authentication file!')
+        return False
+    derived = hashlib.pbkdf2_hmac('sha256', password_hash.encode('utf-8'), salt, iterations)
+    return hmac.compare_digest(derived, expected)
+
+
+class CredentialStore:
+    """
+    Thread-safe in-memory copy of authentication file. The file is checked at most once per reload_interval and
+    loaded again when its mtime or size changes - the whole dictionary is swapped, so lookups never see it half
+    loaded. If reload fails, previous credentials are kept. Password hashes are verified without holding the lock.
+    """
+
+    def __init__(self, path: str = AUTH_FILE, reload_interval: float = RELOAD_INTERVAL):
+        self.path = os.path.abspath(path)
+        self.reload_interval = reload_interval
+        self.users: Dict[str, str] = dict()
+        self.stamp: Optional[Tuple[int, int]] = None
+        self.checked = 0.0
+        self.mutex = threading.Lock()
+        # Entry verified for unknown users, so they take as long to reject as wrong passwords
+        self.dummy_entry = hash_password('')
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self.checked < self.reload_interval:
+            return
+        with self.mutex:
+            if not force and now - self.checked < self.reload_interval:
+                return
+            self.checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError as e:
+                if self.stamp is not None or force:
+                    print(f'Could not read authentication file, previous credentials are kept!\n{e}')
+                self.stamp = None
+                return
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if stamp == self.stamp:
+                return
+            # Broken file is reported once, not on every check
+            self.stamp = stamp
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    users = json.load(f)
+                if not isinstance(users, dict) or not all(isinstance(entry, str) for entry in users.values()):
+                    raise ValueError('Authentication file must map user names to password hashes')
+            except (OSError, ValueError) as e:
+                print(f'Could not load authentication file, previous credentials are kept!\n{e}')
+                return
+            self.users = users
+
+    def lookup(self, name: str) -> Optional[str]:
+        self.refresh()
+        return self.users.get(name)
+
+    def verify(self, name: str, password_hash: str) -> bool:
+        entry = self.lookup(name)
+        if entry is None:
+            verify_password(self.dummy_entry, password_hash)
+            return False
+        return verify_password(entry, password_hash)
+
+
+def write_auth_file(path: str, users: Dict[str, str]) -> None:
+    """
+    Replaces authentication file atomically, so a running server never loads it half written.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(users, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage users of authentication file.')
+    parser.add_argument('action', choices=['add', 'upgrade'],
+                        help='"add" sets password of user, "upgrade" converts legacy SHA-512 entries to PBKDF2')
+    parser.add_argument('user', nargs='?', help='User name for "add"')
+    parser.add_argument('-f', '--file', type=str, default=AUTH_FILE, metavar='',
+                        help=f'Authentication file (default: {AUTH_FILE})')
+    parser.add_argument('-i', '--iterations', type=int, default=ITERATIONS, metavar='',
+                        help=f'PBKDF2 iterations (default: {ITERATIONS})')
+    args = parser.parse_args()
+
+    try:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            users = json.load(f)
+    except FileNotFoundError:
+        users = dict()
+
+    if args.action == 'add':
+        if not args.user:
+            parser.error('"add" needs user name')
+        password = getpass.getpass('Password: ')
+        users[args.user] = hash_password(hashlib.sha512(password.encode('utf-8')).hexdigest(), args.iterations)
+    else:
+        users = {name: entry if entry.startswith(f'{KDF_NAME}$') else hash_password(entry, args.iterations)
+                 for name, entry in users.items()}
+    write_auth_file(args.file, users)
+
+
+if __name__ == '__main__':
+    main()
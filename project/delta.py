@@ -0,0 +1,270 @@
+"""
+rsync-style delta transfer of a file the receiver already has an older copy of (basis).
+
+Receiver sends signature of its basis - weak rolling checksum (adler32) and strong hash of each block. Sender looks up
+blocks of the basis in the new file, also at shifted offsets, and sends only copy instructions for them plus literal
+data of changed parts. Receiver rebuilds the new file from its basis and the delta.
+
+Delta stream = sequence of ops:
+- copy: b'C', first block (u64), number of consecutive blocks (u32)
+- literal: b'L', length (u32), data
+"""
+import asyncio
+import hashlib
+import os
+import struct
+import zlib
+from typing import AsyncIterable, BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+from ciphers import Encryptor, Decryptor
+from mux import DataChannel, AsyncDataChannel
+from transfer import CHUNK_SIZE, read_at, read_range_chunks, send_stream, receive_stream, async_send_stream
+
+BLOCK_MIN = 2 * 1024
+# Bounds size of signature sent over Command Channel - 20 B per block
+MAX_BLOCKS = 16 * 1024
+# Rolling checksum is computed byte by byte in Python, so after a changed block blocks at shifted offsets are looked
+# for only once every RESYNC_INTERVAL changed blocks. Other changed blocks are compared at aligned offsets only.
+RESYNC_INTERVAL = 8
+
+SIGNATURE_ENTRY = struct.Struct('!I16s')
+COPY_OP = struct.Struct('!cQI')
+LITERAL_OP = struct.Struct('!cI')
+ADLER_MOD = 65521
+
+
+def block_size_for(size: int) -> int:
+    return max(BLOCK_MIN, -(-size // MAX_BLOCKS))
+
+
+def strong_hash(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def make_signature(f: BinaryIO, size: int, block_size: int) -> bytes:
+    signature = bytearray()
+    for offset in range(0, size, block_size):
+        block = read_at(f, block_size, offset)
+        signature += SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(signature)
+
+
+def file_signature(filepath: str) -> Tuple[bytes, int]:
+    """
+    Returns signature of basis file and its block size.
+    """
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        block_size = block_size_for(size)
+        return make_signature(f, size, block_size), block_size
+
+
+def index_signature(signature: bytes, block_size: int) -> Dict[int, Dict[bytes, int]]:
+    """
+    Returns blocks of signature by their weak and strong checksums. Signature is checked, since it comes from peer.
+    """
+    if block_size < BLOCK_MIN or len(signature) % SIGNATURE_ENTRY.size or \
+            len(signature) > MAX_BLOCKS * SIGNATURE_ENTRY.size:
+        raise ValueError('Invalid signature!')
+    blocks = dict()
+    for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(signature)):
+        blocks.setdefault(weak, dict()).setdefault(strong, index)
+    return blocks
+
+
+class DeltaEncoder:
+    """
+    Packs ops of delta into chunks of chunk_size. Consecutive copied blocks are merged into one op.
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.out = bytearray()
+        self.literal = bytearray()
+        self.run_start = 0
+        self.run_length = 0
+
+    def add_literal(self, data: bytes) -> None:
+        self.flush_copy()
+        self.literal += data
+        while len(self.literal) >= self.chunk_size:
+            self.flush_literal(self.chunk_size)
+
+    def add_copy(self, index: int) -> None:
+        self.flush_literal()
+        if self.run_length and index == self.run_start + self.run_length:
+            self.run_length += 1
+            return
+        self.flush_copy()
+        self.run_start, self.run_length = index, 1
+
+    def flush_literal(self, length: Optional[int] = None) -> None:
+        length = len(self.literal) if length is None else length
+        if length:
+            self.out += LITERAL_OP.pack(b'L', length)
+            self.out += self.literal[:length]
+            del self.literal[:length]
+
+    def flush_copy(self) -> None:
+        if self.run_length:
+            self.out += COPY_OP.pack(b'C', self.run_start, self.run_length)
+            self.run_length = 0
+
+    def chunks(self) -> Iterator[bytes]:
+        while len(self.out) >= self.chunk_size:
+            yield bytes(self.out[:self.chunk_size])
+            del self.out[:self.chunk_size]
+
+    def finish(self) -> Iterator[bytes]:
+        self.flush_literal()
+        self.flush_copy()
+        if self.out:
+            yield bytes(self.out)
+            self.out.clear()
+
+
+def make_delta(f: BinaryIO, size: int, signature: bytes, block_size: int,
+               chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yields delta of first size bytes of file against basis of signature in chunks of up to chunk_size.
+    """
+    blocks = index_signature(signature, block_size)
+    encoder = DeltaEncoder(chunk_size)
+    read_size = max(16 * CHUNK_SIZE, 2 * block_size)
+    buffer = b''
+    pos = 0  # Start of current window in buffer
+    offset = 0  # Offset of file the buffer ends at
+    misses = 0  # Changed blocks since the last block found in basis
+
+    while True:
+        # Window may roll by up to a block, so two blocks are kept in buffer unless file ends
+        if len(buffer) - pos < 2 * block_size and offset < size:
+            data = read_at(f, min(read_size, size - offset), offset)
+            if not data:
+                raise ValueError('File was truncated during transfer!')
+            buffer = buffer[pos:] + data
+            pos = 0
+            offset += len(data)
+            continue
+        if pos == len(buffer):
+            break
+
+        end = min(pos + block_size, len(buffer))
+        block = buffer[pos:end]
+        weak = zlib.adler32(block)
+        index = blocks.get(weak, {}).get(strong_hash(block)) if weak in blocks else None
+        if index is not None:
+            encoder.add_copy(index)
+            pos = end
+            misses = 0
+        elif misses % RESYNC_INTERVAL or end == len(buffer):
+            encoder.add_literal(block)
+            pos = end
+            misses += 1
+        else:
+            # Roll window byte by byte to find data of basis shifted by insertion or deletion
+            start, length = pos, end - pos
+            a, b = weak & 0xffff, weak >> 16
+            for _ in range(min(block_size, len(buffer) - end)):
+                out_byte, in_byte = buffer[pos], buffer[end]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - length * out_byte + a - 1) % ADLER_MOD
+                pos += 1
+                end += 1
+                candidates = blocks.get(b << 16 | a)
+                if candidates is not None:
+                    index = candidates.get(strong_hash(buffer[pos:end]))
+                    if index is not None:
+                        break
+            encoder.add_literal(buffer[start:pos])
+            if index is not None:
+                encoder.add_copy(index)
+                pos = end
+                misses = 0
+            else:
+                misses += 1
+        yield from encoder.chunks()
+
+    yield from encoder.finish()
+
+
+class DeltaWriter:
+    """
+    Rebuilds file from delta stream - copied blocks are read from basis, literal data is taken from the stream.
+    Ops may be split between chunks of the stream.
+    """
+
+    def __init__(self, basis: BinaryIO, f: BinaryIO, block_size: int):
+        self.basis = basis
+        self.basis_size = os.fstat(basis.fileno()).st_size
+        self.f = f
+        self.block_size = block_size
+        self.pending = bytearray()
+        self.literal_left = 0
+
+    def update(self, data: bytes) -> None:
+        self.pending += data
+        while self.pending:
+            if self.literal_left:
+                piece = self.pending[:self.literal_left]
+                self.f.write(piece)
+                del self.pending[:len(piece)]
+                self.literal_left -= len(piece)
+            elif self.pending[:1] == b'L':
+                if len(self.pending) < LITERAL_OP.size:
+                    return
+                _, self.literal_left = LITERAL_OP.unpack_from(self.pending)
+                del self.pending[:LITERAL_OP.size]
+            elif self.pending[:1] == b'C':
+                if len(self.pending) < COPY_OP.size:
+                    return
+                _, first, count = COPY_OP.unpack_from(self.pending)
+                del self.pending[:COPY_OP.size]
+                self.copy(first, count)
+            else:
+                raise ValueError('Invalid delta!')
+
+    def copy(self, first: int, count: int) -> None:
+        offset = first * self.block_size
+        if not count or offset >= self.basis_size:
+            raise ValueError('Delta refers to block outside of basis!')
+        for chunk in read_range_chunks(self.basis, offset, count * self.block_size):
+            self.f.write(chunk)
+
+    def finish(self) -> None:
+        if self.pending or self.literal_left:
+            raise ValueError('Delta stream ended in the middle of an op!')
+
+
+def send_delta(channel: DataChannel, stream_id: int, f: BinaryIO, size: int, signature: bytes, block_size: int,
+               encryptor: Encryptor) -> None:
+    send_stream(channel, stream_id, make_delta(f, size, signature, block_size), encryptor)
+
+
+def receive_delta(frames: Iterable[bytes], basis: BinaryIO, f: BinaryIO, block_size: int,
+                  decryptor: Decryptor) -> None:
+    writer = DeltaWriter(basis, f, block_size)
+    for data in receive_stream(frames, decryptor):
+        writer.update(data)
+    writer.finish()
+
+
+async def async_send_delta(channel: AsyncDataChannel, stream_id: int, f: BinaryIO, size: int, signature: bytes,
+                           block_size: int, encryptor: Encryptor) -> None:
+    """
+    Event loop version of send_delta. Delta is computed in default executor.
+    """
+    await async_send_stream(channel, stream_id, make_delta(f, size, signature, block_size), encryptor)
+
+
+async def async_receive_delta(frames: AsyncIterable[bytes], basis: BinaryIO, f: BinaryIO, block_size: int,
+                              decryptor: Decryptor) -> None:
+    loop = asyncio.get_running_loop()
+    writer = DeltaWriter(basis, f, block_size)
+    async for frame in frames:
+        data = decryptor.update(frame) if frame else decryptor.finish()
+        if data:
+            await loop.run_in_executor(None, writer.update, data)
+        if not frame:
+            break
+    writer.finish()
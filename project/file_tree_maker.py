@@ -1,36 +1,145 @@
 import os
 import argparse
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from types import SimpleNamespace
+from typing import Callable, List, NamedTuple, Optional
+
+# Directory modified less than this many seconds before it was scanned may change again without changing its mtime,
+# so its listing is not cached
+MTIME_GRANULARITY = 2
+
+
+class Entry(NamedTuple):
+    name: str
+    is_dir: bool
+    is_file: bool
+
+
+def scan_directory(path: str) -> List[Entry]:
+    """
+    Lists directory with one scandir pass, directories first. Types come from directory entries, so on most
+    systems no entry is stat-ed.
+    """
+    with os.scandir(path) as it:
+        entries = [Entry(entry.name, entry.is_dir(), entry.is_file()) for entry in it]
+    entries.sort(key=lambda entry: (entry.is_file, entry.name))
+    return entries
+
+
+class Record(NamedTuple):
+    name: str
+    type: str  # "dir" or "file"
+    size: int
+    mtime: int  # Nanoseconds since epoch
+    hash: Optional[str] = None
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Returns hex SHA-256 of file contents.
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def scan_records(path: str, with_hash: bool = False, hasher: Callable[[str], str] = hash_file) -> List[Record]:
+    """
+    Lists directory with sizes and modification times from one scandir pass, directories first. Sizes and mtimes
+    of entries change without changing mtime of their directory, so unlike scan_directory results, records are
+    never cached. Hashes of files are computed with hasher, e.g. one caching them.
+    """
+    records = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                entry_type = 'dir'
+            elif entry.is_file():
+                entry_type = 'file'
+            else:
+                continue
+            stat = entry.stat()
+            digest = hasher(entry.path) if with_hash and entry_type == 'file' else None
+            records.append(Record(entry.name, entry_type, stat.st_size, stat.st_mtime_ns, digest))
+    records.sort(key=lambda record: (record.type == 'file', record.name))
+    return records
+
+
+class DirectoryCache:
+    """
+    Thread-safe cache of directory listings, least recently used directories are evicted. Cached listing is
+    revalidated with a single stat of its directory and kept while mtime of the directory does not change.
+    """
+
+    def __init__(self, max_directories: int = 4096):
+        self.max_directories = max_directories
+        self.listings = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def list(self, path: str) -> List[Entry]:
+        """
+        Returns listing of directory. Returned list is shared and must not be modified.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        with self.mutex:
+            cached = self.listings.get(path)
+            if cached is not None and cached[0] == mtime:
+                self.listings.move_to_end(path)
+                return cached[1]
+
+        entries = scan_directory(path)
+        if time.time_ns() - mtime > MTIME_GRANULARITY * 10 ** 9:
+            with self.mutex:
+                self.listings[path] = (mtime, entries)
+                self.listings.move_to_end(path)
+                while len(self.listings) > self.max_directories:
+                    self.listings.popitem(last=False)
+        return entries
 
 
 class FileTreeMaker:
 
-    def _recurse(self, parent_path, file_list, prefix, output_buf, level):
-        if len(file_list) == 0 \
+    def __init__(self, cache: DirectoryCache = None):
+        self.cache = cache
+
+    def _list(self, path):
+        if self.cache is not None:
+            return self.cache.list(path)
+        return scan_directory(path)
+
+    def _recurse(self, parent_path, entries, prefix, level):
+        if len(entries) == 0 \
                 or (self.max_level != -1 and self.max_level <= level):
             return
         else:
-            file_list.sort(key=lambda f: os.path.isfile(os.path.join(parent_path, f)))
-            for idx, sub_path in enumerate(file_list):
-                if any(exclude_name in sub_path for exclude_name in self.exn):
+            for idx, entry in enumerate(entries):
+                if any(exclude_name in entry.name for exclude_name in self.exn):
                     continue
 
-                full_path = os.path.join(parent_path, sub_path)
+                full_path = os.path.join(parent_path, entry.name)
                 idc = "┣━"
-                if idx == len(file_list) - 1:
+                if idx == len(entries) - 1:
                     idc = "┗━"
 
-                if os.path.isdir(full_path) and sub_path not in self.exf:
-                    output_buf.append("%s%s[%s]" % (prefix, idc, sub_path))
-                    if len(file_list) > 1 and idx != len(file_list) - 1:
+                if entry.is_dir and entry.name not in self.exf:
+                    yield "%s%s[%s]" % (prefix, idc, entry.name)
+                    if len(entries) > 1 and idx != len(entries) - 1:
                         tmp_prefix = prefix + "┃  "
                     else:
                         tmp_prefix = prefix + "    "
-                    self._recurse(full_path, os.listdir(full_path), tmp_prefix, output_buf, level + 1)
-                elif os.path.isfile(full_path):
-                    output_buf.append("%s%s%s" % (prefix, idc, sub_path))
+                    yield from self._recurse(full_path, self._list(full_path), tmp_prefix, level + 1)
+                elif entry.is_file:
+                    yield "%s%s%s" % (prefix, idc, entry.name)
 
-    def make(self, args):
+    def iterate(self, args):
+        """
+        Yields lines of the tree one by one, directories are listed only when the tree gets to them.
+        """
         self.root = args.root
         self.exf = args.exclude_folder
         self.exn = args.exclude_name
@@ -38,12 +147,12 @@ class FileTreeMaker:
 
         print("root:%s" % self.root)
 
-        buf = []
         path_parts = self.root.rsplit(os.path.sep, 1)
-        buf.append("[%s]" % (path_parts[-1],))
-        self._recurse(self.root, os.listdir(self.root), "", buf, 0)
+        yield "[%s]" % (path_parts[-1],)
+        yield from self._recurse(self.root, self._list(self.root), "", 0)
 
-        output_str = "\n".join(buf)
+    def make(self, args):
+        output_str = "\n".join(self.iterate(args))
         if len(args.output) != 0:
             with open(args.output, 'w') as of:
                 of.write(output_str)
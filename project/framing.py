@@ -0,0 +1,162 @@
+import asyncio
+import os
+import socket
+import ssl
+import struct
+from typing import BinaryIO, Optional, Tuple
+
+# Every frame starts with payload length packed as unsigned 64-bit big-endian integer
+HEADER = struct.Struct('!Q')
+HEADER_LENGTH = HEADER.size
+
+# Largest Command Channel message accepted. Length prefix is checked before the payload buffer is allocated, so a peer
+# cannot make the other side allocate whatever it declares. The largest messages are delta signatures (up to
+# delta.MAX_BLOCKS * 20 B = 320 KiB), "ls" pages (LS_PAGE_LINES lines) and "mlsd"/"mget"/"mput" lists of files, which
+# grow with the directory - 16 MiB holds ~100 000 records with hashes.
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
+
+# Data Channel frames are additionally prefixed with id of the transfer stream they belong to
+STREAM_HEADER = struct.Struct('!IQ')
+STREAM_HEADER_LENGTH = STREAM_HEADER.size
+
+# Payloads smaller than this are copied together with the header and sent with one call
+COALESCE_LIMIT = 16 * 1024
+
+
+def receive_exact_into(s: socket.socket, view: memoryview) -> None:
+    """
+    Fills whole buffer with data from socket. Raises ConnectionError if connection was closed before.
+    """
+    received = 0
+    length = len(view)
+    while received < length:
+        n = s.recv_into(view[received:])
+        if not n:
+            raise ConnectionError('Connection closed in the middle of a frame!')
+        received += n
+
+
+def receive_exact(s: socket.socket, length: int) -> bytearray:
+    """
+    Receives exactly length bytes into preallocated buffer.
+    """
+    buf = bytearray(length)
+    receive_exact_into(s, memoryview(buf))
+    return buf
+
+
+def receive_frame(s: socket.socket, max_length: Optional[int] = None) -> bytearray:
+    """
+    Receives 1 length-prefixed frame and returns its payload.
+    """
+    length, = HEADER.unpack(receive_exact(s, HEADER_LENGTH))
+    if max_length is not None and length > max_length:
+        raise ValueError(f'Frame of {length} bytes exceeds limit of {max_length} bytes!')
+    return receive_exact(s, length)
+
+
+def check_message_length(payload: bytes) -> None:
+    """
+    Refuses to send Command Channel message the other side would drop the connection for.
+    """
+    if len(payload) > MAX_MESSAGE_LENGTH:
+        raise ValueError(f'Message of {len(payload)} bytes exceeds limit of {MAX_MESSAGE_LENGTH} bytes!')
+
+
+def send_frame(s: socket.socket, payload: bytes) -> None:
+    """
+    Sends 1 length-prefixed Command Channel message.
+    """
+    check_message_length(payload)
+    send_with_header(s, HEADER.pack(len(payload)), payload)
+
+
+def send_stream_frame(s: socket.socket, stream_id: int, payload: bytes) -> None:
+    """
+    Sends 1 length-prefixed frame of given stream.
+    """
+    send_with_header(s, STREAM_HEADER.pack(stream_id, len(payload)), payload)
+
+
+def receive_stream_frame(s: socket.socket, max_length: Optional[int] = None) -> Tuple[int, bytearray]:
+    """
+    Receives 1 frame sent with send_stream_frame and returns its stream id and payload.
+    """
+    stream_id, length = STREAM_HEADER.unpack(receive_exact(s, STREAM_HEADER_LENGTH))
+    if max_length is not None and length > max_length:
+        raise ValueError(f'Frame of {length} bytes exceeds limit of {max_length} bytes!')
+    return stream_id, receive_exact(s, length)
+
+
+def send_file_frame(s: socket.socket, stream_id: int, f: BinaryIO, offset: int, count: int) -> None:
+    """
+    Sends range of file as 1 frame of given stream with os.sendfile, so file data is not copied through Python.
+    """
+    s.sendall(STREAM_HEADER.pack(stream_id, count))
+    end = offset + count
+    while offset < end:
+        sent = os.sendfile(s.fileno(), f.fileno(), offset, end - offset)
+        if not sent:
+            # Header promised more data than there is - the connection cannot be used anymore
+            raise ConnectionError('File ended in the middle of a frame!')
+        offset += sent
+
+
+def send_with_header(s: socket.socket, header: bytes, payload: bytes) -> None:
+    """
+    Large payloads are not copied - plain sockets get header and payload with one scatter-gather call,
+    TLS sockets with two calls.
+    """
+    if len(payload) < COALESCE_LIMIT:
+        s.sendall(header + payload)
+
+    elif isinstance(s, ssl.SSLSocket) or not hasattr(s, 'sendmsg'):
+        s.sendall(header)
+        s.sendall(payload)
+
+    else:
+        sent = s.sendmsg([header, payload])
+        if sent < len(header):
+            s.sendall(header[sent:])
+            s.sendall(payload)
+        elif sent < len(header) + len(payload):
+            s.sendall(memoryview(payload)[sent - len(header):])
+
+
+async def async_receive_frame(reader: asyncio.StreamReader, max_length: Optional[int] = None) -> bytes:
+    length, = HEADER.unpack(await reader.readexactly(HEADER_LENGTH))
+    if max_length is not None and length > max_length:
+        raise ValueError(f'Frame of {length} bytes exceeds limit of {max_length} bytes!')
+    return await reader.readexactly(length)
+
+
+def write_with_header(writer: asyncio.StreamWriter, header: bytes, payload: bytes) -> None:
+    """
+    Event loop version of send_with_header. Small payload written separately from its header is sent as a second TLS
+    record, which waits for delayed ACK of the first one.
+    """
+    if len(payload) < COALESCE_LIMIT:
+        writer.write(header + payload)
+    else:
+        writer.write(header)
+        writer.write(payload)
+
+
+async def async_send_frame(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    check_message_length(payload)
+    write_with_header(writer, HEADER.pack(len(payload)), payload)
+    await writer.drain()
+
+
+async def async_receive_stream_frame(reader: asyncio.StreamReader, max_length: Optional[int] = None) -> \
+        Tuple[int, bytes]:
+    stream_id, length = STREAM_HEADER.unpack(await reader.readexactly(STREAM_HEADER_LENGTH))
+    if max_length is not None and length > max_length:
+        raise ValueError(f'Frame of {length} bytes exceeds limit of {max_length} bytes!')
+    return stream_id, await reader.readexactly(length)
+
+
+async def async_send_stream_frame(writer: asyncio.StreamWriter, stream_id: int, payload: bytes) -> None:
+    # Header and payload are written without yielding to the loop, so frames of concurrent streams do not interleave
+    write_with_header(writer, STREAM_HEADER.pack(stream_id, len(payload)), payload)
+    await writer.drain()
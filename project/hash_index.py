@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows runs only threaded engine, a single process saves the index
+    fcntl = None
+
+from file_tree_maker import hash_file
+from transfer import read_range_chunks, write_at
+
+# Index is kept in working directory of server
+INDEX_FILE = '.hash_index.json'
+# Seconds between saves of changed index
+SAVE_INTERVAL = 5.0
+
+
+class HashIndex:
+    """
+    Persistent index of contents of files kept by server: path -> (size, mtime in ns, hex SHA-256). Entry is valid
+    while size and mtime of its file do not change, stale entries are dropped or recomputed on demand, so the index
+    never has to be rebuilt. Thread-safe.
+
+    Changes are saved every SAVE_INTERVAL seconds by start_saving, those of the last interval are lost if server is
+    killed. Worker processes of asyncio engine share the file, each merges entries saved by others into its own.
+    """
+
+    def __init__(self, index_path: str = INDEX_FILE):
+        self.index_path = os.path.abspath(index_path)
+        self.entries: Dict[str, Tuple[int, int, str]] = dict()
+        self.paths_by_hash: Dict[str, Set[str]] = dict()
+        self.mutex = threading.Lock()
+        self.dirty = False
+        # Paths dropped since last save, so their entries saved before are not merged back
+        self.removed: Set[str] = set()
+        # Serializes saves of the process, lock of lock_path serializes saves of worker processes
+        self.save_mutex = threading.Lock()
+        self.lock_path = f'{self.index_path}.lock'
+        self.load()
+
+    @staticmethod
+    def read_entries(path: str) -> Dict[str, Tuple[int, int, str]]:
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        return {path: (size, mtime, digest) for path, (size, mtime, digest) in entries.items()}
+
+    def load(self) -> None:
+        try:
+            for path, entry in HashIndex.read_entries(self.index_path).items():
+                self.set(path, *entry)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            print(f'Could not load hash index, it will be built again!\n{e}')
+            self.entries, self.paths_by_hash = dict(), dict()
+        self.dirty = False
+        self.removed.clear()
+
+    def save(self) -> None:
+        """
+        Writes index to disk if it changed. Entries saved by other processes are merged in first, the newer entry of
+        a path wins. File is replaced atomically under file lock, so a crash never leaves it half written and
+        processes never drop entries of each other. Changes of failed save are written by the next one.
+        """
+        with self.save_mutex:
+            with self.mutex:
+                if not self.dirty:
+                    return
+                self.dirty = False
+            removed = set()
+            try:
+                with self.file_lock():
+                    try:
+                        saved = HashIndex.read_entries(self.index_path)
+                    except FileNotFoundError:
+                        saved = dict()
+                    except (ValueError, TypeError, AttributeError) as e:
+                        print(f'Could not load saved hash index, it will be replaced!\n{e}')
+                        saved = dict()
+                    with self.mutex:
+                        self.merge(saved)
+                        data = json.dumps(self.entries)
+                        removed = set(self.removed)
+                    tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        f.write(data)
+                    os.replace(tmp_path, self.index_path)
+                with self.mutex:
+                    self.removed -= removed
+            except Exception as e:
+                print(f'Could not save hash index!\n{e}')
+                with self.mutex:
+                    self.dirty = True
+
+    def merge(self, saved: Dict[str, Tuple[int, int, str]]) -> None:
+        """
+        Takes entries of saved index which are newer than own ones, mutex must be held.
+        """
+        dirty = self.dirty
+        for path, entry in saved.items():
+            if path not in self.removed and (path not in self.entries or self.entries[path][1] < entry[1]):
+                self.replace_entry(path, entry)
+        self.dirty = dirty
+
+    @contextmanager
+    def file_lock(self) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def start_saving(self, interval: float = SAVE_INTERVAL) -> None:
+        """
+        Saves changed index every interval seconds in daemon thread, so uploads and listings do not write the whole
+        file each. Worker processes of asyncio engine start their own, forked processes do not inherit threads.
+        """
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                self.save()
+
+        threading.Thread(target=run, name='hash-index', daemon=True).start()
+
+    def set(self, path: str, size: int, mtime: int, digest: str) -> None:
+        with self.mutex:
+            self.replace_entry(path, (size, mtime, digest))
+            self.dirty = True
+
+    def replace_entry(self, path: str, entry: Tuple[int, int, str]) -> None:
+        """
+        Stores entry of path in place of previous one, mutex must be held.
+        """
+        self.remove_entry(path)
+        self.removed.discard(path)
+        self.entries[path] = entry
+        self.paths_by_hash.setdefault(entry[2], set()).add(path)
+
+    def remove_entry(self, path: str) -> None:
+        """
+        Drops entry of path, mutex must be held.
+        """
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        paths = self.paths_by_hash[entry[2]]
+        paths.discard(path)
+        if not paths:
+            del self.paths_by_hash[entry[2]]
+        self.removed.add(path)
+        self.dirty = True
+
+    def digest(self, path: str) -> str:
+        """
+        Returns hex SHA-256 of file, computed only if file changed since it was indexed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.mutex:
+            entry = self.entries.get(path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+
+        digest = hash_file(path)
+        # File modified while it was hashed is not indexed
+        if os.stat(path).st_mtime_ns == stat.st_mtime_ns:
+            self.set(path, stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def add(self, path: str, digest: str) -> None:
+        """
+        Indexes file whose hash was computed while it was written, without reading it again.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.set(path, stat.st_size, stat.st_mtime_ns, digest)
+
+    def add_link(self, source: str, path: str) -> None:
+        """
+        Indexes hard link of indexed file without hashing it again - both share size and mtime.
+        """
+        with self.mutex:
+            entry = self.entries.get(os.path.abspath(source))
+        if entry is not None:
+            self.set(os.path.abspath(path), *entry)
+
+    def find(self, digest: str, size: int) -> Optional[str]:
+        """
+        Returns path of an indexed file with given content or None if there is none.
+        """
+        with self.mutex:
+            paths = list(self.paths_by_hash.get(digest, ()))
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            with self.mutex:
+                entry = self.entries.get(path)
+                if entry is None:
+                    continue
+                if stat is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns) and entry[0] == size:
+                    return path
+                if stat is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+                    self.remove_entry(path)
+        return None
+
+
+class HashingFile:
+    """
+    Partial file of upload whose SHA-256 is computed while it is written. Data written in order is hashed right away,
+    content kept from interrupted upload and ranges of other stripes, written ahead of it, are read back by hexdigest.
+    Positional writes of transfer.write_at go through write_at, everything else is passed to the file.
+    """
+
+    def __init__(self, f: BinaryIO, start: int = 0):
+        self.f = f
+        self.start = start
+        self.position = start
+        self.hashed = 0
+        self.hasher = hashlib.sha256()
+        self.mutex = threading.Lock()
+
+    def write(self, data: bytes) -> int:
+        self.update(data, self.position)
+        self.position += len(data)
+        return self.f.write(data)
+
+    def write_at(self, data: bytes, offset: int) -> None:
+        write_at(self.f, data, offset)
+        self.update(data, offset)
+
+    def update(self, data: bytes, offset: int) -> None:
+        with self.mutex:
+            if offset == self.start and self.hashed < self.start:
+                self.read_back(self.start)
+            if offset == self.hashed:
+                self.hasher.update(data)
+                self.hashed += len(data)
+
+    def read_back(self, end: int) -> None:
+        """
+        Hashes content of file up to end which was not hashed as it was written, mutex must be held.
+        """
+        for chunk in read_range_chunks(self.f, self.hashed, end - self.hashed):
+            self.hasher.update(chunk)
+            self.hashed += len(chunk)
+
+    def hexdigest(self, size: int) -> str:
+        """
+        Returns hex SHA-256 of the first size bytes of file, once all of them are written.
+        """
+        with self.mutex:
+            self.read_back(size)
+            return self.hasher.hexdigest()
+
+    def __getattr__(self, name: str):
+        return getattr(self.f, name)
+
+    def __enter__(self) -> 'HashingFile':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.f.close()
@@ -0,0 +1,307 @@
+"""
+Load generator - starts a local server and measures it with concurrent sessions of the real client, each in its own
+process. Every session starts each phase at the same time:
+- login: connection, TLS handshake, authentication and Data Channel setup
+- ls: latency of "ls" of server directory
+- put_small, get_small: "put" and then "get" of many small files
+- put_large, get_large: "put" and then "get" of one large file per session
+Results are printed as JSON, so runs of different versions and options can be compared.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from admission import MAX_SESSIONS
+from client_api import Session
+from credentials import hash_password
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(PROJECT_DIR, 'server.py')
+USER = 'bench'
+PASSWORD = 'bench'
+# Seconds to wait for server to start listening
+START_TIMEOUT = 10
+PHASES = ['login', 'ls', 'put_small', 'get_small', 'put_large', 'get_large']
+
+
+def wait_uploaded(session: Session, names: List[str], size: int) -> None:
+    """
+    Waits until server lists uploaded files - it moves them into place only once they are written completely.
+    """
+    pending = set(names)
+    while pending:
+        pending.difference_update(name for name, _, file_size, *_ in session.mlsd() if file_size == size)
+        if pending:
+            time.sleep(0.01)
+
+
+def check_files(filepaths: List[str], size: int) -> None:
+    received = [filepath for filepath in filepaths if os.path.isfile(filepath) and os.path.getsize(filepath) == size]
+    if len(received) != len(filepaths):
+        raise Exception(f'Received {len(received)} of {len(filepaths)} files')
+
+
+def run_session(index: int, args: argparse.Namespace, port: int, directory: str, barrier: multiprocessing.Barrier,
+                results: multiprocessing.Queue) -> None:
+    """
+    Runs all phases in one session and sends its timings to parent. Failed session still waits at every barrier,
+    so other sessions are not stuck.
+    """
+    os.chdir(directory)
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    small = [os.path.join('up', f'{index}_small_{i:05}.bin') for i in range(args.small_files)]
+    large = os.path.join('up', f'{index}_large.bin')
+    session = Session(['-H', '127.0.0.1', '-p', str(port), *args.client_args.split()])
+    ls_latencies = []
+
+    def login() -> None:
+        session.connect(USER, PASSWORD)
+
+    def ls() -> None:
+        for _ in range(args.ls_count):
+            start = time.monotonic()
+            session.ls()
+            ls_latencies.append(time.monotonic() - start)
+
+    def transfer(filepaths: List[str], size: int, upload: bool) -> None:
+        for filepath in filepaths:
+            if upload:
+                session.put(filepath)
+            else:
+                session.get(os.path.basename(filepath))
+        failed = session.wait()
+        if failed:
+            raise failed[0]
+        if upload:
+            wait_uploaded(session, [os.path.basename(filepath) for filepath in filepaths], size)
+        else:
+            check_files([os.path.basename(filepath) for filepath in filepaths], size)
+
+    actions = {
+        'login': login,
+        'ls': ls,
+        'put_small': lambda: transfer(small, args.small_size, True),
+        'get_small': lambda: transfer(small, args.small_size, False),
+        'put_large': lambda: transfer([large], args.large_size, True),
+        'get_large': lambda: transfer([large], args.large_size, False),
+    }
+    phases = dict()
+    error = None
+    for name in PHASES:
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            error = error or 'Another session crashed'
+            break
+        if error:
+            continue
+        start = time.monotonic()
+        try:
+            actions[name]()
+            phases[name] = (start, time.monotonic())
+        except Exception as e:
+            error = f'{name}: {e}'
+    session.close()
+    results.put({'error': error, 'phases': phases, 'ls': ls_latencies})
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    Returns percentiles of latencies in seconds as milliseconds.
+    """
+    if not samples:
+        return dict()
+    samples = sorted(samples)
+    return {name: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+            for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))}
+
+
+def summarize(args: argparse.Namespace, sessions: List[dict]) -> dict:
+    """
+    Returns results of phases. Phase lasts from the first session starting it to the last one finishing it.
+    """
+    def duration(name: str) -> Optional[float]:
+        spans = [session['phases'][name] for session in sessions if name in session['phases']]
+        if not spans:
+            return None
+        return max(max(end for _, end in spans) - min(start for start, _ in spans), 1e-9)
+
+    def count(name: str) -> int:
+        return len([session for session in sessions if name in session['phases']])
+
+    def rate(name: str, operations: int) -> dict:
+        seconds = duration(name)
+        return {'operations': operations, 'seconds': round(seconds, 4) if seconds else None,
+                'per_second': round(operations / seconds, 2) if seconds else None}
+
+    def throughput(name: str) -> dict:
+        seconds = duration(name)
+        size = count(name) * args.large_size
+        return {'bytes': size, 'seconds': round(seconds, 4) if seconds else None,
+                'mb_per_second': round(size / seconds / 1e6, 2) if seconds else None}
+
+    login_latencies = [end - start for start, end in
+                       (session['phases']['login'] for session in sessions if 'login' in session['phases'])]
+    ls_latencies = [latency for session in sessions for latency in session['ls']]
+    return {
+        'login': {**rate('login', count('login')), 'latency_ms': percentiles(login_latencies)},
+        'ls': {**rate('ls', len(ls_latencies)), 'latency_ms': percentiles(ls_latencies)},
+        'small_files': {'put': rate('put_small', count('put_small') * args.small_files),
+                        'get': rate('get_small', count('get_small') * args.small_files)},
+        'large_files': {'put': throughput('put_large'), 'get': throughput('get_large')},
+        'errors': [session['error'] for session in sessions if session['error']],
+    }
+
+
+def prepare_session(directory: str, index: int, args: argparse.Namespace, large: str) -> None:
+    os.makedirs(os.path.join(directory, 'up'))
+    shutil.copy(args.cert, directory)
+    for i in range(args.small_files):
+        with open(os.path.join(directory, 'up', f'{index}_small_{i:05}.bin'), 'wb') as f:
+            f.write(os.urandom(args.small_size))
+    try:
+        os.link(large, os.path.join(directory, 'up', f'{index}_large.bin'))
+    except OSError:
+        shutil.copy(large, os.path.join(directory, 'up', f'{index}_large.bin'))
+
+
+def start_server(args: argparse.Namespace, directory: str) -> subprocess.Popen:
+    """
+    Starts server in directory with benchmark user and no per-address or per-user limits on a free port, waits
+    until it listens.
+    """
+    os.makedirs(directory)
+    shutil.copy(args.cert, directory)
+    shutil.copy(args.key, directory)
+    with open(os.path.join(directory, 'auth.json'), 'w', encoding='utf-8') as f:
+        json.dump({USER: hash_password(hashlib.sha512(PASSWORD.encode('utf-8')).hexdigest())}, f)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        args.port = sock.getsockname()[1]
+    log = open(os.path.join(directory, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, SERVER, '-H', '127.0.0.1', '-p', str(args.port),
+                               '--max-sessions', str(max(args.sessions, MAX_SESSIONS)), '--max-per-address', '0',
+                               '--max-per-user', '0', *args.server_args.split()],
+                              cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError(f'Server did not start, see {os.path.join(directory, "server.log")}')
+            time.sleep(0.1)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure local server with concurrent client sessions and print '
+                                                 'results as JSON.')
+    parser.add_argument('-c', '--sessions', type=int, default=8, metavar='',
+                        help='Number of concurrent sessions (default: 8)')
+    parser.add_argument('--ls-count', type=int, default=50, metavar='',
+                        help='Number of "ls" commands per session (default: 50)')
+    parser.add_argument('--small-files', type=int, default=100, metavar='',
+                        help='Number of small files per session (default: 100)')
+    parser.add_argument('--small-size', type=int, default=4096, metavar='',
+                        help='Size of small file in bytes (default: 4096)')
+    parser.add_argument('--large-size', type=int, default=32 * 1024 * 1024, metavar='',
+                        help='Size of large file in bytes (default: 32 MiB)')
+    parser.add_argument('--server-args', type=str, default='', metavar='',
+                        help='Additional server options e.g. "-e asyncio -w 4 --plain"')
+    parser.add_argument('--client-args', type=str, default='', metavar='',
+                        help='Additional client options e.g. "-n 4 -c none"')
+    parser.add_argument('--cert', type=str, default=os.path.join(PROJECT_DIR, 'cert.pem'), metavar='',
+                        help='Server certificate (default: cert.pem of project)')
+    parser.add_argument('--key', type=str, default=os.path.join(PROJECT_DIR, 'key.pem'), metavar='',
+                        help='Server private key (default: key.pem of project)')
+    parser.add_argument('-o', '--output', type=str, default=None, metavar='',
+                        help='File results are written to (default: standard output)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show output of clients')
+    args = parser.parse_args()
+    args.cert, args.key = os.path.abspath(args.cert), os.path.abspath(args.key)
+
+    workdir = tempfile.mkdtemp(prefix='load_benchmark_')
+    server = None
+    try:
+        large = os.path.join(workdir, 'large.bin')
+        with open(large, 'wb') as f:
+            for offset in range(0, args.large_size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, args.large_size - offset)))
+        directories = [os.path.join(workdir, f'session_{i}') for i in range(args.sessions)]
+        for i, directory in enumerate(directories):
+            prepare_session(directory, i, args, large)
+        server = start_server(args, os.path.join(workdir, 'server'))
+
+        barrier = multiprocessing.Barrier(args.sessions)
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_session, args=(i, args, args.port, directory, barrier, queue))
+                     for i, directory in enumerate(directories)]
+        for process in processes:
+            process.start()
+        sessions = []
+        while len(sessions) < len(processes):
+            try:
+                sessions.append(queue.get(timeout=1))
+            except Empty:
+                # Session which crashed never reaches the next phase, the others are released
+                if any(not process.is_alive() and process.exitcode for process in processes):
+                    barrier.abort()
+                if not any(process.is_alive() for process in processes) and queue.empty():
+                    break
+        for process in processes:
+            process.join()
+        if len(sessions) < len(processes):
+            sessions.append({'error': f'{len(processes) - len(sessions)} session(s) crashed', 'phases': {},
+                             'ls': []})
+
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'config': {'sessions': args.sessions, 'ls_count': args.ls_count, 'small_files': args.small_files,
+                       'small_size': args.small_size, 'large_size': args.large_size,
+                       'server_args': args.server_args, 'client_args': args.client_args},
+            **summarize(args, sessions),
+        }
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
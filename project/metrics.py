@@ -0,0 +1,374 @@
+"""
+Counters and latency histograms of server - bytes moved on Data Channel, transfer durations, time spent encrypting,
+decrypting and waiting for disk, latency of commands by verb. Each session keeps its own, they are added to totals
+of server when the session ends. Stats are served as JSON by a local HTTP endpoint and/or dumped to a file
+periodically. Each worker process of asyncio engine has its own stats.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from ciphers import Encryptor, Decryptor
+from transfer import read_at, write_at
+
+# Seconds between dumps of stats file
+STATS_INTERVAL = 10.0
+# Stats endpoint listens only on local interface
+STATS_HOST = '127.0.0.1'
+# Histogram buckets are powers of 2 microseconds, the last one holds everything above ~2 minutes
+BUCKETS = 28
+
+
+class Histogram:
+    """
+    Durations counted in buckets of powers of 2 microseconds. Percentiles are upper bounds of their buckets.
+    Not thread-safe, guarded by its Metrics.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: 'Histogram') -> None:
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram()
+        histogram.merge(self)
+        return histogram
+
+    def percentile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'total_s': round(self.total, 6),
+                **{f'{name}_ms': round(self.percentile(q) * 1000, 3)
+                   for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+                'max_ms': round(self.max * 1000, 3)}
+
+
+class Metrics:
+    """
+    Named counters and histograms. Thread-safe.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms: Dict[str, Histogram] = dict()
+        self.mutex = threading.Lock()
+
+    def add(self, name: str, value: int = 1) -> None:
+        with self.mutex:
+            self.counters[name] += value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.mutex:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """
+        Observes duration of block as name, a block which raised is counted as "<name>.failed" instead.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.add(f'{name}.failed')
+            raise
+        self.observe(name, time.perf_counter() - start)
+
+    def timed_file(self, f: BinaryIO) -> 'TimedFile':
+        return TimedFile(f, self)
+
+    def timed_encryptors(self, new_encryptor: Callable[[], Encryptor]) -> Callable[[], Encryptor]:
+        return partial(timed_encryptor, self, new_encryptor)
+
+    def timed_decryptors(self, new_decryptor: Callable[[], Decryptor]) -> Callable[[], Decryptor]:
+        return partial(timed_decryptor, self, new_decryptor)
+
+    def timed_channels(self, channels: list) -> list:
+        """
+        Data Channel connections of a transfer. Sending and receiving frames is timed only by transfer profiles,
+        see profiling.
+        """
+        return channels
+
+    def timed_frames(self, streams: list) -> list:
+        return streams
+
+    def copy(self) -> Tuple[Counter, Dict[str, Histogram]]:
+        with self.mutex:
+            return Counter(self.counters), {name: histogram.copy() for name, histogram in self.histograms.items()}
+
+    def merge(self, other: 'Metrics') -> None:
+        counters, histograms = other.copy()
+        with self.mutex:
+            self.counters.update(counters)
+            for name, histogram in histograms.items():
+                if name in self.histograms:
+                    self.histograms[name].merge(histogram)
+                else:
+                    self.histograms[name] = histogram
+
+    def snapshot(self) -> dict:
+        counters, histograms = self.copy()
+        return {'counters': dict(sorted(counters.items())),
+                'histograms': {name: histograms[name].snapshot() for name in sorted(histograms)}}
+
+
+class SessionMetrics(Metrics):
+    """
+    Metrics of one session. Bytes of its Data Channel connections are read from their counters, so sending and
+    receiving frames takes no lock.
+    """
+
+    def __init__(self, address: Tuple[str, int], user: str):
+        super().__init__()
+        self.address = address
+        self.user = user
+        self.started = time.time()
+        # DataChannel or AsyncDataChannel connections of the session, counted in once it ends
+        self.channels: list = []
+        # SessionProfile of the session if it is profiled, see profiling
+        self.profile = None
+
+    def transfer(self, kind: str, target: str, size: int) -> Metrics:
+        """
+        Returns metrics to record one transfer in - the session's own, or profile of the transfer which passes them
+        on if the session is profiled.
+        """
+        return self.profile.transfer(kind, target, size, self) if self.profile else self
+
+    def copy(self) -> Tuple[Counter, Dict[str, Histogram]]:
+        counters, histograms = super().copy()
+        for channel in self.channels:
+            counters['bytes_in'] += channel.bytes_received
+            counters['bytes_out'] += channel.bytes_sent
+        return counters, histograms
+
+    def finish(self) -> None:
+        channels, self.channels = self.channels, []
+        self.add('bytes_in', sum(channel.bytes_received for channel in channels))
+        self.add('bytes_out', sum(channel.bytes_sent for channel in channels))
+
+    def snapshot(self) -> dict:
+        return {'address': f'{self.address[0]}:{self.address[1]}', 'user': self.user,
+                'seconds': round(time.time() - self.started, 3), 'data_channels': len(self.channels),
+                **super().snapshot()}
+
+
+class MetricsRegistry:
+    """
+    Metrics of running sessions and totals of the ended ones.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.ended = Metrics()
+        self.sessions: List[SessionMetrics] = []
+        self.mutex = threading.Lock()
+
+    def open_session(self, address: Tuple[str, int], user: str) -> SessionMetrics:
+        session = SessionMetrics(address, user)
+        with self.mutex:
+            self.sessions.append(session)
+        return session
+
+    def close_session(self, session: SessionMetrics) -> None:
+        session.finish()
+        with self.mutex:
+            self.sessions.remove(session)
+            self.ended.add('sessions_ended')
+            self.ended.merge(session)
+
+    def snapshot(self) -> dict:
+        """
+        Returns totals of all sessions so far, including running ones, and stats of each running session.
+        """
+        total = Metrics()
+        with self.mutex:
+            sessions = list(self.sessions)
+            total.merge(self.ended)
+        for session in sessions:
+            total.merge(session)
+        return {'time': time.time(), 'uptime_s': round(time.time() - self.started, 3), 'pid': os.getpid(),
+                'active_sessions': len(sessions),
+                'data_channels': sum(len(session.channels) for session in sessions),
+                'total': total.snapshot(), 'sessions': [session.snapshot() for session in sessions]}
+
+
+class TimedEncryptor(Encryptor):
+
+    def __init__(self, encryptor: Encryptor, metrics: Metrics):
+        self.encryptor = encryptor
+        self.metrics = metrics
+        self.zero_copy = encryptor.zero_copy
+
+    def update(self, data: bytes) -> bytes:
+        start = time.perf_counter()
+        frame = self.encryptor.update(data)
+        self.metrics.observe('encrypt', time.perf_counter() - start)
+        return frame
+
+    def finish(self) -> bytes:
+        start = time.perf_counter()
+        frame = self.encryptor.finish()
+        self.metrics.observe('encrypt', time.perf_counter() - start)
+        return frame
+
+
+class TimedDecryptor(Decryptor):
+
+    def __init__(self, decryptor: Decryptor, metrics: Metrics):
+        self.decryptor = decryptor
+        self.metrics = metrics
+
+    def update(self, frame: bytes) -> bytes:
+        start = time.perf_counter()
+        data = self.decryptor.update(frame)
+        self.metrics.observe('decrypt', time.perf_counter() - start)
+        return data
+
+    def finish(self) -> bytes:
+        start = time.perf_counter()
+        data = self.decryptor.finish()
+        self.metrics.observe('decrypt', time.perf_counter() - start)
+        return data
+
+
+def timed_encryptor(metrics: Metrics, new_encryptor: Callable[[], Encryptor]) -> Encryptor:
+    return TimedEncryptor(new_encryptor(), metrics)
+
+
+def timed_decryptor(metrics: Metrics, new_decryptor: Callable[[], Decryptor]) -> Decryptor:
+    return TimedDecryptor(new_decryptor(), metrics)
+
+
+class TimedFile:
+    """
+    Binary file whose reads and writes are timed. Positional I/O of transfer.read_at and transfer.write_at goes
+    through read_at and write_at, everything else is passed to the file.
+    """
+
+    def __init__(self, f: BinaryIO, metrics: Metrics):
+        self.f = f
+        self.metrics = metrics
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self.f.read(size)
+        self.metrics.observe('disk_read', time.perf_counter() - start)
+        return data
+
+    def write(self, data: bytes) -> int:
+        start = time.perf_counter()
+        written = self.f.write(data)
+        self.metrics.observe('disk_write', time.perf_counter() - start)
+        return written
+
+    def read_at(self, length: int, offset: int) -> bytes:
+        start = time.perf_counter()
+        data = read_at(self.f, length, offset)
+        self.metrics.observe('disk_read', time.perf_counter() - start)
+        return data
+
+    def write_at(self, data: bytes, offset: int) -> None:
+        start = time.perf_counter()
+        write_at(self.f, data, offset)
+        self.metrics.observe('disk_write', time.perf_counter() - start)
+
+    def __getattr__(self, name: str):
+        return getattr(self.f, name)
+
+    def __enter__(self) -> 'TimedFile':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.f.close()
+
+
+def write_stats(path: str, stats: dict) -> None:
+    """
+    Replaces stats file at once, so its readers never see it half written.
+    """
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(stats, f, indent=2)
+    os.replace(temporary, path)
+
+
+def start_reporting(stats: Callable[[], dict], port: int, path: Optional[str], interval: float = STATS_INTERVAL
+                    ) -> None:
+    """
+    Serves stats on http://127.0.0.1:<port>/ if port is given and dumps them to path every interval seconds if path
+    is given. Both run in daemon threads.
+    """
+    if port:
+        class StatsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:
+                body = json.dumps(stats(), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        endpoint = ThreadingHTTPServer((STATS_HOST, port), StatsHandler)
+        endpoint.daemon_threads = True
+        threading.Thread(target=endpoint.serve_forever, name='stats-endpoint', daemon=True).start()
+        print(f'Stats served on http://{STATS_HOST}:{port}/')
+
+    if path:
+        def dump() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    write_stats(path, stats())
+                except OSError as e:
+                    print(f'Could not write stats to {path}!\n{e}')
+
+        threading.Thread(target=dump, name='stats-dump', daemon=True).start()
+
+
+def worker_targets(port: int, path: Optional[str], index: int, workers: int) -> Tuple[int, Optional[str]]:
+    """
+    Returns stats port and file of one of asyncio engine workers - port is increased by index of worker, index is
+    added to name of file.
+    """
+    if workers == 1:
+        return port, path
+    if path:
+        root, extension = os.path.splitext(path)
+        path = f'{root}.{index}{extension}'
+    return (port + index if port else 0), path
@@ -0,0 +1,312 @@
+import asyncio
+import os
+import queue
+import socket
+import ssl
+import threading
+from typing import AsyncIterator, BinaryIO, Dict, Iterable, Iterator, Optional, Sequence
+
+from framing import STREAM_HEADER, send_stream_frame, receive_stream_frame, send_file_frame, \
+    async_send_stream_frame, async_receive_stream_frame
+from throttle import Throttle
+
+# Frames buffered per stream before reader of Data Channel waits for the stream consumer
+STREAM_BUFFER_FRAMES = 16
+# Size of frames sent straight from file
+SENDFILE_FRAME_LENGTH = 128 * 1024
+
+
+def drain(frames) -> None:
+    """
+    Discards frames buffered in queue.Queue or asyncio.Queue.
+    """
+    try:
+        while True:
+            frames.get_nowait()
+    except (queue.Empty, asyncio.QueueEmpty):
+        pass
+
+
+class Stream:
+    """
+    Frames of incoming stream, iterated until the end of stream. Closing it unregisters the stream even if it was
+    never iterated, so reader of Data Channel does not wait for space in its queue.
+    """
+
+    def __init__(self, channel: 'DataChannel', stream_id: int, frames: queue.Queue):
+        self.channel = channel
+        self.stream_id = stream_id
+        self.frames = channel.iterate_stream(stream_id, frames)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self.frames)
+
+    def close(self) -> None:
+        self.channel.close_stream(self.stream_id)
+
+
+class AsyncStream:
+    """
+    Event loop version of Stream.
+    """
+
+    def __init__(self, channel: 'AsyncDataChannel', stream_id: int, frames: asyncio.Queue):
+        self.channel = channel
+        self.stream_id = stream_id
+        self.frames = channel.iterate_stream(stream_id, frames)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self.frames.__anext__()
+
+    def close(self) -> None:
+        self.channel.close_stream(self.stream_id)
+
+
+class DataChannel:
+    """
+    Multiplexes concurrent transfers of one session over a single Data Channel connection. Every frame carries id
+    of its stream, frames of different streams may interleave. Frames are sent under a lock, received frames are
+    dispatched by reader thread (run) to bounded queues of their streams. Stream ends with an empty frame.
+    """
+
+    def __init__(self, s: socket.socket, max_frame_length: int, throttle: Optional[Throttle] = None):
+        self.s = s
+        self.max_frame_length = max_frame_length
+        # Bandwidth limits of the session, frames are sent and received unthrottled without them
+        self.throttle = throttle
+        self.send_lock = threading.Lock()
+        self.streams: Dict[int, queue.Queue] = dict()
+        self.streams_mutex = threading.Lock()
+        # Bytes of frames with their headers, read by metrics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def open_stream(self, stream_id: int) -> Stream:
+        """
+        Registers incoming stream. Returns iterator over its frames, which stops at the end of stream.
+        """
+        frames = queue.Queue(STREAM_BUFFER_FRAMES)
+        with self.streams_mutex:
+            if stream_id in self.streams:
+                raise ValueError(f'Stream {stream_id} is already open!')
+            self.streams[stream_id] = frames
+        return Stream(self, stream_id, frames)
+
+    def close_stream(self, stream_id: int) -> None:
+        with self.streams_mutex:
+            frames = self.streams.pop(stream_id, None)
+        if frames is not None:
+            # Unblock reader thread if it waits for space in queue of abandoned stream. Consumer still waiting for
+            # its frames gets None, as if Data Channel was closed.
+            drain(frames)
+            frames.put_nowait(None)
+
+    def iterate_stream(self, stream_id: int, frames: queue.Queue) -> Iterator[bytes]:
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    raise ConnectionError('Data Channel closed in the middle of a stream!')
+                yield frame
+                if not frame:
+                    return
+        finally:
+            self.close_stream(stream_id)
+
+    def send(self, stream_id: int, payload: bytes) -> None:
+        if self.throttle:
+            self.throttle.wait(STREAM_HEADER.size + len(payload))
+        with self.send_lock:
+            send_stream_frame(self.s, stream_id, payload)
+            self.bytes_sent += STREAM_HEADER.size + len(payload)
+
+    def can_send_file(self) -> bool:
+        return hasattr(os, 'sendfile') and not isinstance(self.s, ssl.SSLSocket)
+
+    def send_file(self, stream_id: int, f: BinaryIO, offset: int, length: int) -> None:
+        """
+        Sends range of file unencrypted, without copying it into Python memory.
+        """
+        end = offset + length
+        while offset < end:
+            count = min(SENDFILE_FRAME_LENGTH, end - offset)
+            if self.throttle:
+                self.throttle.wait(STREAM_HEADER.size + count)
+            with self.send_lock:
+                try:
+                    send_file_frame(self.s, stream_id, f, offset, count)
+                except ConnectionError:
+                    self.close()
+                    raise
+                self.bytes_sent += STREAM_HEADER.size + count
+            offset += count
+
+    def run(self) -> None:
+        """
+        Receives frames until the connection is closed.
+        """
+        try:
+            while True:
+                stream_id, frame = receive_stream_frame(self.s, self.max_frame_length)
+                self.bytes_received += STREAM_HEADER.size + len(frame)
+                if self.throttle:
+                    # Next frame is read later, so TCP flow control slows down the sender
+                    self.throttle.wait(STREAM_HEADER.size + len(frame))
+                with self.streams_mutex:
+                    frames = self.streams.get(stream_id)
+                if frames is None:
+                    continue  # Stream was abandoned by its consumer
+                frames.put(frame)
+
+        except (ConnectionError, OSError):
+            pass
+
+        except Exception as e:
+            print(f'Exception occurred on Data Channel!\n{e}')
+
+        finally:
+            # Consumers of unfinished streams get frames received before the connection was closed, then None.
+            # Queues of abandoned streams are drained by close_stream, so waiting for space in them does not block.
+            with self.streams_mutex:
+                streams = list(self.streams.values())
+            for frames in streams:
+                frames.put(None)
+
+    def close(self) -> None:
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.s.close()
+
+
+class AsyncDataChannel:
+    """
+    Event loop version of DataChannel.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_frame_length: int,
+                 throttle: Optional[Throttle] = None):
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_length = max_frame_length
+        self.throttle = throttle
+        self.streams: Dict[int, asyncio.Queue] = dict()
+        # Needed only by send_file, which yields to the loop between header and payload
+        self.send_lock = asyncio.Lock()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def open_stream(self, stream_id: int) -> AsyncStream:
+        if stream_id in self.streams:
+            raise ValueError(f'Stream {stream_id} is already open!')
+        frames = asyncio.Queue(STREAM_BUFFER_FRAMES)
+        self.streams[stream_id] = frames
+        return AsyncStream(self, stream_id, frames)
+
+    def close_stream(self, stream_id: int) -> None:
+        frames = self.streams.pop(stream_id, None)
+        if frames is not None:
+            drain(frames)
+            frames.put_nowait(None)
+
+    async def iterate_stream(self, stream_id: int, frames: asyncio.Queue) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                frame = await frames.get()
+                if frame is None:
+                    raise ConnectionError('Data Channel closed in the middle of a stream!')
+                yield frame
+                if not frame:
+                    return
+        finally:
+            self.close_stream(stream_id)
+
+    async def send(self, stream_id: int, payload: bytes) -> None:
+        if self.throttle:
+            await self.throttle.async_wait(STREAM_HEADER.size + len(payload))
+        async with self.send_lock:
+            await async_send_stream_frame(self.writer, stream_id, payload)
+            self.bytes_sent += STREAM_HEADER.size + len(payload)
+
+    def can_send_file(self) -> bool:
+        return hasattr(os, 'sendfile') and self.writer.get_extra_info('sslcontext') is None
+
+    async def send_file(self, stream_id: int, f: BinaryIO, offset: int, length: int) -> None:
+        """
+        Sends range of file unencrypted with loop.sendfile, which uses os.sendfile on plain sockets.
+        """
+        loop = asyncio.get_running_loop()
+        end = offset + length
+        while offset < end:
+            count = min(SENDFILE_FRAME_LENGTH, end - offset)
+            if self.throttle:
+                await self.throttle.async_wait(STREAM_HEADER.size + count)
+            async with self.send_lock:
+                self.writer.write(STREAM_HEADER.pack(stream_id, count))
+                # No fallback - it would read file with seek+read, racing with other stripes of the file
+                sent = await loop.sendfile(self.writer.transport, f, offset, count, fallback=False)
+                if sent != count:
+                    self.close()
+                    raise ConnectionError('File ended in the middle of a frame!')
+                self.bytes_sent += STREAM_HEADER.size + count
+            offset += count
+
+    async def run(self) -> None:
+        try:
+            while True:
+                stream_id, frame = await async_receive_stream_frame(self.reader, self.max_frame_length)
+                self.bytes_received += STREAM_HEADER.size + len(frame)
+                if self.throttle:
+                    await self.throttle.async_wait(STREAM_HEADER.size + len(frame))
+                frames = self.streams.get(stream_id)
+                if frames is None:
+                    continue  # Stream was abandoned by its consumer
+                await frames.put(frame)
+
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+
+        except Exception as e:
+            print(f'Exception occurred on Data Channel!\n{e}')
+
+        finally:
+            for frames in list(self.streams.values()):
+                await frames.put(None)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def open_streams(channels: Sequence, stream_id: int) -> list:
+    """
+    Opens stream with the same id on each of channels, e.g. for stripes of one transfer.
+    """
+    streams = []
+    try:
+        for channel in channels:
+            streams.append(channel.open_stream(stream_id))
+    except Exception:
+        close_streams(channels[:len(streams)], stream_id)
+        raise
+    return streams
+
+
+def close_streams(channels: Sequence, stream_id: int) -> None:
+    for channel in channels:
+        channel.close_stream(stream_id)
+
+
+def abandon_streams(streams: Iterable) -> None:
+    """
+    Unregisters streams of transfer which ended, also those it failed before reading. Streams received to their end
+    are already unregistered.
+    """
+    for frames in streams:
+        frames.close()
@@ -0,0 +1,215 @@
+"""
+Pool of pre-bound listening sockets accepting passive mode Data Channel connections of all sessions.
+
+Server sends each session a random token along with ports of the pool. Client sends the token and index of the
+connection as the first bytes of every Data Channel connection, so connections are matched to their session whichever
+port they arrive on. Connections which do not send a known token in time and sessions whose connections do not arrive
+in time are dropped.
+"""
+import asyncio
+import itertools
+import secrets
+import selectors
+import socket
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+TOKEN_LENGTH = 16
+# Token and index of connection sent by client before any Data Channel frame
+HELLO = struct.Struct(f'!{TOKEN_LENGTH}sB')
+# Listeners on ports chosen by system if no port range is configured
+DEFAULT_LISTENERS = 4
+# Seconds client has to open all Data Channel connections of a session
+CONNECT_TIMEOUT = 10
+# Seconds a connection has to send its token
+HELLO_TIMEOUT = 5
+
+
+def parse_port_range(spec: str) -> List[int]:
+    """
+    Parses "<first>-<last>" or a single port given by user.
+    """
+    first, _, last = spec.partition('-')
+    first, last = int(first), int(last or first)
+    if not 0 < first <= last < 65536:
+        raise ValueError(f'Invalid port range: {spec}')
+    return list(range(first, last + 1))
+
+
+def split_ports(ports: Sequence[int], workers: int, index: int) -> List[int]:
+    """
+    Returns ports of one of workers, each worker process must accept connections of its own sessions.
+    """
+    if ports and len(ports) < workers:
+        raise ValueError(f'Passive port range must have at least one port per worker ({workers})')
+    return list(ports[index::workers])
+
+
+class PassivePorts:
+    """
+    Listeners of threaded engine. One thread accepts connections on all of them and reads their tokens without
+    blocking, sessions wait until all their connections are matched.
+    """
+
+    def __init__(self, host: str, ports: Sequence[int], backlog: int):
+        self.listeners = []
+        for port in ports or [0] * DEFAULT_LISTENERS:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, port))
+            listener.listen(backlog)
+            listener.setblocking(False)
+            self.listeners.append(listener)
+        self.ports = [listener.getsockname()[1] for listener in self.listeners]
+        self.next_port = itertools.count()
+
+        # Token -> Data Channel connections of session by index, None until connected
+        self.pending: Dict[bytes, List[Optional[socket.socket]]] = dict()
+        self.mutex = threading.Lock()
+        self.arrived = threading.Condition(self.mutex)
+        self.selector = selectors.DefaultSelector()
+
+    def start(self) -> None:
+        for listener in self.listeners:
+            self.selector.register(listener, selectors.EVENT_READ)
+        threading.Thread(target=self.run, name='passive-ports', daemon=True).start()
+
+    def expect(self, connections: int) -> Tuple[bytes, List[int]]:
+        """
+        Registers session expecting Data Channel connections. Returns its token and ports for client.
+        """
+        token = secrets.token_bytes(TOKEN_LENGTH)
+        with self.mutex:
+            self.pending[token] = [None] * connections
+        return token, [self.ports[next(self.next_port) % len(self.ports)] for _ in range(connections)]
+
+    def wait(self, token: bytes, timeout: float = CONNECT_TIMEOUT) -> List[socket.socket]:
+        """
+        Returns connections of session in order of their indices, raises TimeoutError if some did not arrive.
+        Registration of session which timed out is dropped by cancel.
+        """
+        with self.arrived:
+            conns = self.pending[token]
+            if not self.arrived.wait_for(lambda: all(conns), timeout):
+                raise TimeoutError('Client did not open Data Channel connections in time!')
+            del self.pending[token]
+        for conn in conns:
+            conn.setblocking(True)
+        return conns
+
+    def cancel(self, token: bytes) -> None:
+        """
+        Drops registration of session and closes its connections which arrived, if it is still pending.
+        """
+        with self.mutex:
+            conns = self.pending.pop(token, [])
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+
+    def run(self) -> None:
+        hellos: Dict[socket.socket, Tuple[bytearray, float]] = dict()
+        while True:
+            for key, _ in self.selector.select(timeout=1):
+                if key.fileobj in self.listeners:
+                    try:
+                        conn, _ = key.fileobj.accept()
+                    except OSError:
+                        continue
+                    conn.setblocking(False)
+                    hellos[conn] = (bytearray(), time.monotonic() + HELLO_TIMEOUT)
+                    self.selector.register(conn, selectors.EVENT_READ)
+                    continue
+
+                conn = key.fileobj
+                hello, deadline = hellos[conn]
+                try:
+                    data = conn.recv(HELLO.size - len(hello))
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+                hello += data
+                if data and len(hello) < HELLO.size:
+                    continue
+                self.selector.unregister(conn)
+                del hellos[conn]
+                if not data or not self.deliver(conn, *HELLO.unpack(hello)):
+                    conn.close()
+
+            # Drop connections which did not send their token in time
+            now = time.monotonic()
+            for conn in [conn for conn, (_, deadline) in hellos.items() if deadline < now]:
+                self.selector.unregister(conn)
+                del hellos[conn]
+                conn.close()
+
+    def deliver(self, conn: socket.socket, token: bytes, index: int) -> bool:
+        with self.arrived:
+            conns = self.pending.get(token)
+            if conns is None or index >= len(conns) or conns[index] is not None:
+                return False
+            conns[index] = conn
+            self.arrived.notify_all()
+            return True
+
+
+class AsyncPassivePorts:
+    """
+    Listeners of one worker process of asyncio engine.
+    """
+
+    def __init__(self, host: str, ports: Sequence[int], backlog: int):
+        self.host = host
+        self.requested_ports = list(ports) or [0] * DEFAULT_LISTENERS
+        self.backlog = backlog
+        self.ports: List[int] = []
+        self.next_port = itertools.count()
+        self.listeners = []
+        # Token -> futures of Data Channel connections of session by index
+        self.pending: Dict[bytes, List[asyncio.Future]] = dict()
+
+    async def start(self) -> None:
+        for port in self.requested_ports:
+            listener = await asyncio.start_server(self.on_connection, self.host, port, backlog=self.backlog,
+                                                  reuse_address=True)
+            self.listeners.append(listener)
+            self.ports.append(listener.sockets[0].getsockname()[1])
+
+    def expect(self, connections: int) -> Tuple[bytes, List[int]]:
+        """
+        Registers session expecting Data Channel connections. Returns its token and ports for client.
+        """
+        loop = asyncio.get_running_loop()
+        token = secrets.token_bytes(TOKEN_LENGTH)
+        self.pending[token] = [loop.create_future() for _ in range(connections)]
+        return token, [self.ports[next(self.next_port) % len(self.ports)] for _ in range(connections)]
+
+    async def wait(self, token: bytes, timeout: float = CONNECT_TIMEOUT) -> \
+            List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        try:
+            conns = list(await asyncio.wait_for(asyncio.gather(*self.pending[token]), timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError('Client did not open Data Channel connections in time!')
+        del self.pending[token]
+        return conns
+
+    def cancel(self, token: bytes) -> None:
+        for connected in self.pending.pop(token, []):
+            if connected.done() and not connected.cancelled():
+                connected.result()[1].close()
+            connected.cancel()
+
+    async def on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            token, index = HELLO.unpack(await asyncio.wait_for(reader.readexactly(HELLO.size), HELLO_TIMEOUT))
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            writer.close()
+            return
+        futures = self.pending.get(token)
+        if futures is None or index >= len(futures) or futures[index].done():
+            writer.close()
+            return
+        futures[index].set_result((reader, writer))
@@ -0,0 +1,302 @@
+"""
+Opt-in profiling of transfers, enabled with --profile <directory> of server and client. Each transfer records time
+spent in its stages - reading and writing disk, encrypting, decrypting (CBC includes base64), sending frames and
+waiting for received ones - and its profile is appended to transfers-<pid>.jsonl in the directory. CPU time of
+sessions may be captured with cProfile (<session>.prof, read it with pstats) - it covers their command and transfer
+threads, not threads of stripes of split transfers - and allocations with tracemalloc (<session>.memory.txt).
+Nothing is wrapped or recorded while profiling is disabled.
+"""
+import cProfile
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import AsyncIterator, BinaryIO, Callable, ContextManager, Iterable, Iterator, List, Optional
+
+from ciphers import Encryptor, Decryptor
+from metrics import Metrics
+from mux import AsyncDataChannel
+
+# Frames of stack kept per allocation and allocation sites written per session by memory profiling
+MEMORY_FRAMES = 8
+MEMORY_TOP = 25
+
+
+class TimedChannel:
+    """
+    DataChannel of one transfer whose sending is timed. Frames of other transfers sharing the connection are not.
+    """
+
+    def __init__(self, channel, metrics: Metrics):
+        self.channel = channel
+        self.metrics = metrics
+
+    def send(self, stream_id: int, payload: bytes) -> None:
+        start = time.perf_counter()
+        self.channel.send(stream_id, payload)
+        self.metrics.observe('send', time.perf_counter() - start)
+
+    def send_file(self, stream_id: int, f: BinaryIO, offset: int, length: int) -> None:
+        start = time.perf_counter()
+        self.channel.send_file(stream_id, f, offset, length)
+        self.metrics.observe('send', time.perf_counter() - start)
+
+    def __getattr__(self, name: str):
+        return getattr(self.channel, name)
+
+
+class AsyncTimedChannel(TimedChannel):
+
+    async def send(self, stream_id: int, payload: bytes) -> None:
+        start = time.perf_counter()
+        await self.channel.send(stream_id, payload)
+        self.metrics.observe('send', time.perf_counter() - start)
+
+    async def send_file(self, stream_id: int, f: BinaryIO, offset: int, length: int) -> None:
+        start = time.perf_counter()
+        await self.channel.send_file(stream_id, f, offset, length)
+        self.metrics.observe('send', time.perf_counter() - start)
+
+
+class TimedFrames:
+    """
+    Frames of stream, time spent waiting for each is observed as "receive". Closing it closes the stream.
+    """
+
+    def __init__(self, frames: Iterable[bytes], metrics: Metrics):
+        self.frames = iter(frames)
+        self.metrics = metrics
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        start = time.perf_counter()
+        frame = next(self.frames)
+        self.metrics.observe('receive', time.perf_counter() - start)
+        return frame
+
+    def close(self) -> None:
+        if hasattr(self.frames, 'close'):
+            self.frames.close()
+
+
+class AsyncTimedFrames:
+
+    def __init__(self, frames: AsyncIterator[bytes], metrics: Metrics):
+        self.frames = frames
+        self.metrics = metrics
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self
+
+    async def __anext__(self) -> bytes:
+        start = time.perf_counter()
+        frame = await self.frames.__anext__()
+        self.metrics.observe('receive', time.perf_counter() - start)
+        return frame
+
+    def close(self) -> None:
+        if hasattr(self.frames, 'close'):
+            self.frames.close()
+
+
+class TransferProfile(Metrics):
+    """
+    Time one transfer spends in each stage. Stripes of the transfer add up, so stages may take longer than the
+    transfer itself. Everything recorded is passed on to metrics of the session, if given.
+    """
+
+    def __init__(self, session: 'SessionProfile', kind: str, target: str, size: int, parent: Optional[Metrics]):
+        super().__init__()
+        self.session = session
+        self.kind = kind
+        self.target = target
+        self.size = size
+        self.parent = parent
+
+    def add(self, name: str, value: int = 1) -> None:
+        super().add(name, value)
+        if self.parent:
+            self.parent.add(name, value)
+
+    def observe(self, name: str, seconds: float) -> None:
+        super().observe(name, seconds)
+        if self.parent:
+            self.parent.observe(name, seconds)
+
+    def timed_channels(self, channels: list) -> list:
+        return [(AsyncTimedChannel if isinstance(channel, AsyncDataChannel) else TimedChannel)(channel, self)
+                for channel in channels]
+
+    def timed_frames(self, streams: list) -> list:
+        return [AsyncTimedFrames(frames, self) if hasattr(frames, '__anext__') else TimedFrames(frames, self)
+                for frames in streams]
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """
+        Runs transfer, under cProfile of its thread if CPU is profiled, and writes its profile once it ends.
+        """
+        start = time.perf_counter()
+        failed = True
+        try:
+            with self.session.thread_cpu(), super().timed(name):
+                yield
+            failed = False
+        finally:
+            self.session.profiler.write_transfer(self.report(name, time.perf_counter() - start, failed))
+
+    def report(self, name: str, seconds: float, failed: bool) -> dict:
+        _, histograms = self.copy()
+        return {'session': self.session.name, 'transfer': self.kind, 'file': self.target, 'size': self.size,
+                'seconds': round(seconds, 6), 'failed': failed,
+                'stages': {stage: {'seconds': round(histogram.total, 6), 'calls': histogram.count,
+                                   'max_ms': round(histogram.max * 1000, 3)}
+                           for stage, histogram in sorted(histograms.items()) if stage != name}}
+
+
+class Unprofiled:
+    """
+    Stands in for TransferProfile of transfer which is not profiled - nothing is wrapped or recorded.
+    """
+
+    @staticmethod
+    def timed_file(f: BinaryIO) -> BinaryIO:
+        return f
+
+    @staticmethod
+    def timed_encryptors(new_encryptor: Callable[[], Encryptor]) -> Callable[[], Encryptor]:
+        return new_encryptor
+
+    @staticmethod
+    def timed_decryptors(new_decryptor: Callable[[], Decryptor]) -> Callable[[], Decryptor]:
+        return new_decryptor
+
+    @staticmethod
+    def timed_channels(channels: list) -> list:
+        return channels
+
+    @staticmethod
+    def timed_frames(streams: list) -> list:
+        return streams
+
+    @staticmethod
+    def timed(name: str) -> ContextManager[None]:
+        return nullcontext()
+
+
+UNPROFILED = Unprofiled()
+
+
+class SessionProfile:
+    """
+    Profiles of transfers of one session and cProfile of its threads.
+    """
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+        self.cpu_profiles: List[cProfile.Profile] = []
+        self.mutex = threading.Lock()
+
+    def transfer(self, kind: str, target: str, size: int, parent: Optional[Metrics] = None) -> TransferProfile:
+        return TransferProfile(self, kind, target, size, parent)
+
+    @contextmanager
+    def thread_cpu(self) -> Iterator[None]:
+        """
+        Captures CPU profile of block in current thread for the session. Event loop engine profiles whole worker
+        process instead, sessions share its event loop thread.
+        """
+        if not self.profiler.cpu or self.profiler.process_cpu:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active, e.g. on Python which allows one per process
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.mutex:
+                self.cpu_profiles.append(profile)
+
+    def close(self) -> None:
+        """
+        Writes CPU and memory profiles of the session.
+        """
+        path = os.path.join(self.profiler.directory, re.sub(r'[^\w.-]', '_', self.name))
+        try:
+            if self.profiler.process_cpu:
+                self.profiler.dump_process_cpu()
+            elif self.cpu_profiles:
+                with self.mutex:
+                    profiles, self.cpu_profiles = self.cpu_profiles, []
+                pstats.Stats(*profiles).dump_stats(f'{path}.prof')
+            if self.profiler.memory:
+                Profiler.write_memory(f'{path}.memory.txt')
+        except OSError as e:
+            print(f'Could not write profile of session {self.name}!\n{e}')
+
+
+class Profiler:
+    """
+    Profiling of one process, configured by --profile options.
+    """
+
+    def __init__(self, directory: str, cpu: bool = False, memory: bool = False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.cpu = cpu
+        self.memory = memory
+        # cProfile of whole process of asyncio engine worker, started by profile_process
+        self.process_cpu: Optional[cProfile.Profile] = None
+        self.mutex = threading.Lock()
+        if memory:
+            tracemalloc.start(MEMORY_FRAMES)
+
+    def session(self, name: str) -> SessionProfile:
+        return SessionProfile(self, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}')
+
+    def profile_process(self) -> None:
+        """
+        Starts cProfile of calling thread, which runs event loop of all sessions of the process.
+        """
+        if self.cpu:
+            self.process_cpu = cProfile.Profile()
+            self.process_cpu.enable()
+
+    def dump_process_cpu(self) -> None:
+        with self.mutex:
+            stats = pstats.Stats(self.process_cpu)  # Stops the profile
+            self.process_cpu.enable()
+            stats.dump_stats(os.path.join(self.directory, f'worker-{os.getpid()}.prof'))
+
+    def write_transfer(self, report: dict) -> None:
+        stages = ', '.join(f'{stage} {stats["seconds"]:.3f} s' for stage, stats in report['stages'].items())
+        print(f'Profile of {report["transfer"]} {report["file"]}: {report["seconds"]:.3f} s'
+              f'{" (failed)" if report["failed"] else ""}{", " + stages if stages else ""}')
+        try:
+            with self.mutex, open(os.path.join(self.directory, f'transfers-{os.getpid()}.jsonl'), 'a',
+                                  encoding='utf-8') as f:
+                f.write(json.dumps(report) + '\n')
+        except OSError as e:
+            print(f'Could not write profile of transfer!\n{e}')
+
+    @staticmethod
+    def write_memory(path: str) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'Traced memory of process: current {current} B, peak {peak} B\n')
+            f.write(f'Top {MEMORY_TOP} allocation sites:\n')
+            for statistic in statistics[:MEMORY_TOP]:
+                f.write(f'{statistic}\n')
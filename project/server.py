@@ -2,19 +2,64 @@ import socket
 import ssl
 import threading
 import argparse
-import queue
-from typing import Tuple, Optional
-import pickle
-import platform
-import json
+from functools import partial
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple, Optional
 import os
 import random
 from types import SimpleNamespace
-from file_tree_maker import FileTreeMaker
-from Crypto.Cipher import AES
-import string
+import glob
+import itertools
+import time
+from contextlib import nullcontext
+from file_tree_maker import FileTreeMaker, DirectoryCache, scan_records, hash_file
+from hash_index import HashIndex, HashingFile
+from credentials import CredentialStore
+from admission import MAX_SESSIONS, SESSION_QUEUE, LISTEN_BACKLOG, MAX_PER_ADDRESS, MAX_PER_USER, LOGIN_TIMEOUT, \
+    REJECT_WORKERS, REJECT_QUEUE, BUSY, WorkerPool, SessionLimits
+from delta import file_signature, index_signature, send_delta, receive_delta
+from passive import PassivePorts, parse_port_range
+from sessions import TICKET_LIFETIME, Session, SessionTickets
+from metrics import STATS_INTERVAL, Metrics, MetricsRegistry, SessionMetrics, start_reporting
+from profiling import Profiler
+from throttle import Throttles, parse_rate
+from compression import Decompressor, check_compression, is_file_compressible, make_compressor, make_decompressor
+from transfer import MAX_FRAME_LENGTH, plan_stripes, stripe_channels, send_file_striped, receive_file_striped, \
+    send_batch_striped, receive_batch_striped, open_partial, complete_partial, partial_size, lock_partial, \
+    unlock_partial
+from mux import DataChannel, open_streams, abandon_streams
+from codec import encode_message, decode_message
+from framing import MAX_MESSAGE_LENGTH, send_frame, receive_frame
+from ciphers import CIPHERS, DEFAULT_CIPHER, ENCRYPTED_CIPHERS, PLAIN_CIPHER, Encryptor, Decryptor, choose_cipher, \
+    make_encryptor, make_decryptor
 import secrets
-import base64
+
+# TLS session tickets sent to client after handshake, so a reconnecting client may skip full TLS handshake
+TLS_TICKETS = 2
+# Largest number of Data Channel connections of one session
+MAX_DATA_CONNECTIONS = 8
+# Lines of "ls" output sent in one Command Channel message
+LS_PAGE_LINES = 1000
+
+# Verbs of Command Channel, latency of each is measured separately
+COMMANDS = ('cd', 'ls', 'mlsd', 'get', 'put', 'mget', 'mput')
+# Verbs which start transfers on Data Channel
+TRANSFER_COMMANDS = ('get', 'put', 'mget', 'mput')
+
+# Directory, "ls" arguments, iterator over remaining lines and number of lines sent of "ls" being paged
+Listing = Tuple[str, str, Iterator[str], int]
+
+
+class Transfer(NamedTuple):
+    """
+    Answer to "get", "put", "mget" or "mput" command prepared by Server.prepare_transfer. Engine sends reply to client
+    and runs its method of given name with args, if any. Streams of received transfer are opened by open_streams
+    right before reply and passed to method first. Release undoes preparation of transfer which is not started.
+    """
+    reply: dict
+    method: Optional[str] = None
+    args: tuple = ()
+    open_streams: Optional[Callable[[], list]] = None
+    release: Optional[Callable[[], None]] = None
 
 
 class Server:
@@ -22,16 +67,52 @@ class Server:
     Multithread tcp socket server for managing simple FTP.
     """
 
-    HEADER_LENGTH = 10
-
     def __init__(self):
         args = Server.get_args()
         self.host = args.host
         self.port = args.port
+        self.engine = args.engine
+        self.workers = args.workers
+        self.backlog = args.backlog
+        # Sessions served at once and connections waiting for them, per worker process on asyncio engine
+        self.max_sessions = args.max_sessions
+        self.session_queue = args.session_queue
+        self.limits = SessionLimits(args.max_per_address, args.max_per_user)
+        # Threads of threaded engine, started by run()
+        self.session_pool: Optional[WorkerPool] = None
+        self.reject_pool: Optional[WorkerPool] = None
+        # Ports of passive mode Data Channel listeners, chosen by system if empty
+        self.passive_ports = args.passive_ports
+        self.passive: Optional[PassivePorts] = None
+        # Data Channel ciphers accepted by server
+        self.ciphers = list(CIPHERS) if args.plain else list(ENCRYPTED_CIPHERS)
+        # Tickets of sessions reconnecting clients may resume - created before asyncio workers are forked, so each
+        # of them accepts tickets issued by others
+        self.tickets = SessionTickets(args.ticket_lifetime)
+        # Credentials of users, reloaded when authentication file changes
+        self.credentials = CredentialStore()
 
         # Buffer for storing file paths of files currently being uploaded to the server
-        self.files_in_transfer_buffer = list()  # Not thread-safe -> critical section needed
+        self.files_in_transfer_buffer = set()  # Not thread-safe -> critical section needed
         self.files_in_transfer_mutex = threading.Lock()
+        # Descriptors holding OS locks of partial files of uploads, which tell worker processes of asyncio engine that
+        # another process is receiving the file
+        self.partial_locks: Dict[str, int] = dict()
+
+        # Listings of directories shared by all sessions, so "ls" of unchanged directories does not scan them again
+        self.listing_cache = DirectoryCache()
+        # Hashes of files, so uploads of content server already has can be skipped
+        self.hash_index = HashIndex()
+
+        # Counters and timings of sessions, served on local port and/or dumped to file
+        self.metrics = MetricsRegistry()
+        self.stats_port = args.stats_port
+        self.stats_file = args.stats_file
+        self.stats_interval = args.stats_interval
+        # Bandwidth limits of Data Channel, Command Channel is not limited
+        self.throttles = Throttles(args.rate_limit, args.user_rate_limit, args.total_rate)
+        # Opt-in profiling of transfers and sessions
+        self.profiler = Profiler(args.profile, args.profile_cpu, args.profile_memory) if args.profile else None
 
     @staticmethod
     def get_args() -> argparse.Namespace:
@@ -40,6 +121,58 @@ class Server:
                             help='Host address e.g. "127.0.0.1"')
         parser.add_argument('-p', '--port', type=int, default=65000, metavar='',
                             help='Port number of Command Channel e.g. "65000"')
+        parser.add_argument('-e', '--engine', type=str, default='threads', choices=['threads', 'asyncio'], metavar='',
+                            help='Server engine: thread per connection or asyncio event loops (default: threads)')
+        parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, metavar='',
+                            help='Number of event loop processes of asyncio engine (default: number of cores)')
+        parser.add_argument('--plain', action='store_true',
+                            help=f'Allow Data Channel without payload encryption (cipher "{PLAIN_CIPHER}") if client '
+                                 f'asks for it. Files are then sent with zero-copy sendfile. Trusted networks only!')
+        parser.add_argument('--ticket-lifetime', type=int, default=TICKET_LIFETIME, metavar='',
+                            help=f'Seconds a reconnecting client may resume its session for without logging in '
+                                 f'(default: {TICKET_LIFETIME})')
+        parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, metavar='',
+                            help=f'Listen backlog of Command Channel socket (default: {LISTEN_BACKLOG})')
+        parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS, metavar='',
+                            help=f'Sessions served at once, per worker of asyncio engine (default: {MAX_SESSIONS})')
+        parser.add_argument('--session-queue', type=int, default=SESSION_QUEUE, metavar='',
+                            help=f'Connections waiting for a session slot, further ones are rejected as busy '
+                                 f'(default: {SESSION_QUEUE})')
+        parser.add_argument('--max-per-address', type=int, default=MAX_PER_ADDRESS, metavar='',
+                            help=f'Sessions of one client address, per worker of asyncio engine, 0 for no limit '
+                                 f'(default: {MAX_PER_ADDRESS})')
+        parser.add_argument('--max-per-user', type=int, default=MAX_PER_USER, metavar='',
+                            help=f'Sessions of one user, per worker of asyncio engine, 0 for no limit '
+                                 f'(default: {MAX_PER_USER})')
+        parser.add_argument('--passive-ports', type=parse_port_range, default=[], metavar='',
+                            help='Port range of passive mode Data Channel e.g. "50000-50009" (default: a few ports '
+                                 'chosen by system). Asyncio engine needs at least one port per worker')
+        parser.add_argument('--stats-port', type=int, default=0, metavar='',
+                            help='Port of local HTTP endpoint serving stats as JSON, on 127.0.0.1 only (default: '
+                                 'disabled). Asyncio worker N listens on port + N')
+        parser.add_argument('--stats-file', type=str, default=None, metavar='',
+                            help='File stats are dumped to as JSON periodically (default: disabled). Asyncio worker '
+                                 'N writes to <name>.N<extension>')
+        parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL, metavar='',
+                            help=f'Seconds between dumps of stats file (default: {STATS_INTERVAL:g})')
+        parser.add_argument('--rate-limit', type=parse_rate, default=0, metavar='',
+                            help='Data Channel bandwidth of each session in bytes per second e.g. "10M" (default: '
+                                 'unlimited)')
+        parser.add_argument('--user-rate-limit', type=parse_rate, default=0, metavar='',
+                            help='Data Channel bandwidth shared by all sessions of a user e.g. "20M" (default: '
+                                 'unlimited)')
+        parser.add_argument('--total-rate', type=parse_rate, default=0, metavar='',
+                            help='Data Channel bandwidth of server, split equally among sessions moving data e.g. '
+                                 '"100M" (default: unlimited). Limits are enforced by each asyncio worker separately')
+        parser.add_argument('--profile', type=str, default=None, metavar='',
+                            help='Directory profiles of transfers are written to, with time spent in each of their '
+                                 'stages (default: profiling disabled)')
+        parser.add_argument('--profile-cpu', action='store_true',
+                            help='Write cProfile of each session to profile directory. Asyncio worker profiles its '
+                                 'whole event loop instead')
+        parser.add_argument('--profile-memory', action='store_true',
+                            help='Trace allocations with tracemalloc and write top allocation sites to profile '
+                                 'directory when a session ends')
         return parser.parse_args()
 
     @staticmethod
@@ -48,9 +181,7 @@ class Server:
         Serializes and sends 1 object message.
         Sends header with message length.
         """
-        message = pickle.dumps(message)
-        message_header = bytes(f'{len(message):<{Server.HEADER_LENGTH}}', 'utf-8')
-        s.sendall(message_header + message)
+        send_frame(s, encode_message(message))
 
     @staticmethod
     def receive_object_message(s: socket.socket) -> Optional[dict]:
@@ -58,19 +189,12 @@ class Server:
         Receives 1 object message and deserialize it.
         """
         try:
-            message_header = s.recv(Server.HEADER_LENGTH)
-            if not message_header:
-                print('Failed to receive message header!')
-                return None
-
-            message_length = int(message_header.decode('utf-8').strip())
-            message = s.recv(message_length)
-            if not message:
-                print('Failed to receive message!')
-                return None
+            message = receive_frame(s, MAX_MESSAGE_LENGTH)
+            return decode_message(message)
 
-            message = pickle.loads(message)
-            return message
+        except ConnectionError:
+            print('Failed to receive message!')
+            return None
 
         except Exception as e:
             print(f'Exception occurred during receiving a message!\n{e}')
@@ -78,198 +202,825 @@ class Server:
 
     def run(self) -> None:
         """
-        Main loop of server. Server listens for connections and handles each in separate thread.
+        Main loop of server. Server listens for connections and hands each to a thread of bounded session pool.
+        TLS handshake is done by that thread, so a slow client does not hold up accepting others. Connections over
+        limits are answered with "BUSY" status by a few separate threads.
         """
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain('cert.pem', 'key.pem')
+        context = Server.make_tls_context()
+        self.session_pool = WorkerPool(self.max_sessions, self.session_queue, 'session')
+        self.reject_pool = WorkerPool(REJECT_WORKERS, REJECT_QUEUE, 'reject')
+        self.passive = PassivePorts(self.host, self.passive_ports, self.backlog)
+        self.passive.start()
+        start_reporting(self.stats, self.stats_port, self.stats_file, self.stats_interval)
+        self.hash_index.start_saving()
 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_sock:
             server_sock.bind((self.host, self.port))
-            server_sock.listen(5)
-
-            with context.wrap_socket(server_sock, server_side=True) as server:
-                print(f'Server listening on {self.host}:{self.port}')
+            server_sock.listen(self.backlog)
+            print(f'Server listening on {self.host}:{self.port}')
 
+            try:
                 while True:
-                    conn, address = server.accept()
+                    conn, address = server_sock.accept()
                     print(f'Connection from {address}')
-                    t = threading.Thread(target=self.handle_connection, args=(conn, address))
-                    t.start()
+                    if not self.limits.enter_address(address[0]):
+                        self.reject_connection(conn, context, address, 'too many sessions from address')
+                    elif not self.session_pool.submit(self.start_session, conn, context, address):
+                        self.limits.leave_address(address[0])
+                        self.limits.reject()
+                        self.reject_connection(conn, context, address, 'session queue is full')
+            finally:
+                self.hash_index.save()
+
+    def admission_stats(self) -> dict:
+        """
+        Returns counts of sessions and connections admitted, queued and rejected by threaded engine.
+        """
+        stats = self.limits.stats()
+        if self.session_pool:
+            stats.update(queued=self.session_pool.depth(), peak_queued=self.session_pool.peak_depth)
+        return stats
+
+    def stats(self) -> dict:
+        """
+        Returns metrics of sessions together with admission counts.
+        """
+        return {'engine': self.engine, 'admission': self.admission_stats(), 'throttle': self.throttles.stats(),
+                **self.metrics.snapshot()}
+
+    def reject_connection(self, conn: socket.socket, context: ssl.SSLContext, address: Tuple[str, int],
+                          reason: str) -> None:
+        print(f'Connection from {address} rejected: {reason} {self.admission_stats()}')
+        if not self.reject_pool.submit(Server.refuse_session, conn, context, address):
+            conn.close()
+
+    @staticmethod
+    def refuse_session(conn: socket.socket, context: ssl.SSLContext, address: Tuple[str, int]) -> None:
+        """
+        Answers credentials of rejected connection with "BUSY" status, so client knows it should try again later.
+        """
+        conn.settimeout(LOGIN_TIMEOUT)
+        try:
+            with context.wrap_socket(conn, server_side=True) as tls_conn:
+                if Server.receive_object_message(tls_conn) is not None:
+                    Server.send_object_message(tls_conn, {'status': BUSY})
+        except OSError as e:
+            print(f'Could not answer rejected connection from {address}\n{e}')
+        finally:
+            conn.close()
+
+    def start_session(self, conn: socket.socket, context: ssl.SSLContext, address: Tuple[str, int]) -> None:
+        """
+        Runs in thread of session pool. Client must finish TLS handshake and log in within LOGIN_TIMEOUT.
+        """
+        self.limits.admit()
+        try:
+            conn.settimeout(LOGIN_TIMEOUT)
+            try:
+                tls_conn = context.wrap_socket(conn, server_side=True)
+            except OSError as e:
+                print(f'TLS handshake with {address} failed!\n{e}')
+                conn.close()
+                return
+            self.handle_connection(tls_conn, address)
+        finally:
+            self.limits.leave_address(address[0])
+
+    @staticmethod
+    def make_tls_context() -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain('cert.pem', 'key.pem')
+        context.num_tickets = TLS_TICKETS
+        return context
 
     def handle_connection(self, conn: socket.socket, address: Tuple[str, int]) -> None:
         """
         Handles connection with individual client, manages Command Channel, starts thread handling Data Channel.
         """
         # Authenticate user
-        if not Server.authenticate_user(conn):
+        login = self.authenticate_user(conn)
+        if not login:
             print(f'User authentication from {address} failed!')
             print(f'Connection with {address} closed')
             conn.close()
             return
 
-        print(f'User authentication from {address} successful!')
+        user_credentials, session = login
+        print(f'User authentication from {address} successful{" (session resumed)" if session else ""}!')
+        conn.settimeout(None)
+        try:
+            self.serve_session(conn, address, user_credentials, session)
+        finally:
+            self.limits.leave_user(user_credentials['name'])
 
+    def serve_session(self, conn: socket.socket, address: Tuple[str, int], user_credentials: dict,
+                      session: Optional[Session]) -> None:
+        """
+        Serves session of logged in user.
+        """
         # Agree on Data Channel
-        data_conn, key, iv = self.agree_on_data_channel(conn, address)
-        if not data_conn:
+        data_channel = self.agree_on_data_channel(conn, address, session)
+        if not data_channel:
             print(f'Failed to establish Data Channel connection with {address}')
             print(f'Connection with {address} closed')
             conn.close()
             return
 
-        print(f'Data channel established with {address} on port {data_conn.getsockname()[1]}')
+        data_conns, key, iv, cipher = data_channel
+        ports = [data_conn.getsockname()[1] for data_conn in data_conns]
+        print(f'Data channel established with {address} on port(s) {ports} using {cipher}')
 
-        communication_buffer = queue.Queue()
-        data_channel_event = threading.Event()
-        command_channel_event = threading.Event()
+        # Client may reconnect later with the ticket instead of logging in and agreeing on keys again
+        try:
+            Server.send_object_message(conn, {'ticket': self.issue_ticket(user_credentials, cipher, key, iv)})
+        except OSError as e:
+            print(f'Exception occurred during sending session ticket to {address}\n{e}')
 
-        # Start Data Channel thread
-        dt = threading.Thread(target=self.handle_data_channel, args=(data_conn, communication_buffer,
-                                                                     data_channel_event, command_channel_event,
-                                                                     key, iv))
-        dt.start()
+        # Start threads receiving frames of all transfers of the session, one per connection
+        throttle = self.throttles.open_session(user_credentials['name'])
+        channels = [DataChannel(data_conn, MAX_FRAME_LENGTH, throttle) for data_conn in data_conns]
+        for channel in channels:
+            dt = threading.Thread(target=channel.run)
+            dt.start()
 
         # Listen for new commands from user, verify and respond to them
-        self.handle_commands(conn, address, communication_buffer, data_channel_event, command_channel_event)
-
-    @staticmethod
-    def authenticate_user(conn: socket.socket) -> bool:
+        metrics = self.metrics.open_session(address, user_credentials['name'].decode('utf-8', 'replace'))
+        metrics.channels = channels
+        if self.profiler:
+            metrics.profile = self.profiler.session(f'{metrics.user}-{address[0]}-{address[1]}')
+        try:
+            with metrics.profile.thread_cpu() if metrics.profile else nullcontext():
+                self.handle_commands(conn, address, channels, key, iv, cipher, metrics)
+        finally:
+            self.throttles.close_session(throttle)
+            self.metrics.close_session(metrics)
+            if metrics.profile:
+                metrics.profile.close()
+
+    def authenticate_user(self, conn: socket.socket) -> Optional[Tuple[dict, Optional[Session]]]:
         """
         Handles user authentication by comparing hash received from user with hashes stored in authentication file.
+        Returns credentials of authenticated user and session resumed with ticket, None if authentication failed.
         """
         user_credentials = Server.receive_object_message(conn)
         if not user_credentials:
-            return False
+            return None
 
         try:
-            with open('auth.json', 'r', encoding='utf-8') as f:
-                auth_data = json.load(f)
-
-            # Compare hashes
-            if auth_data[user_credentials['name'].decode('utf-8')] == user_credentials['pass']:
-                # Send "OK" status
-                Server.send_object_message(conn, {'status': 'OK'})
-                return True
-
-            Server.send_object_message(conn, {'status': 'INV'})  # Invalid credentials
-            return False
+            status, session = self.log_in(user_credentials)
+        except Exception as e:
+            print(f'Exception occurred during user authentication!\n{e}')
+            return None
 
+        logged_in = status in ('OK', 'RESUMED')
+        try:
+            # Send "OK" or "RESUMED" status, "INV" for invalid credentials, "BUSY" if user has too many sessions
+            Server.send_object_message(conn, {'status': status})
         except Exception as e:
             print(f'Exception occurred during user authentication!\n{e}')
-            return False
+            if logged_in:
+                self.limits.leave_user(user_credentials['name'])
+            return None
+        return (user_credentials, session) if logged_in else None
+
+    def log_in(self, user_credentials: dict) -> Tuple[str, Optional[Session]]:
+        """
+        Checks credentials of user. Session of valid ticket sent along with them is resumed without verifying
+        password hash. Returns status for client and resumed session. User logged in with "OK" or "RESUMED" is
+        counted in session limits until limits.leave_user is called.
+        """
+        status, session = 'INV', None
+        if 'ticket' in user_credentials:
+            # Ticket is bound to entry of user in authentication file, which must not have changed since it was issued
+            session = self.tickets.resume(user_credentials['ticket'], user_credentials['name'],
+                                          user_credentials['pass'],
+                                          self.credentials.lookup(user_credentials['name'].decode('utf-8')))
+            if session and session.cipher in self.ciphers:
+                status = 'RESUMED'
+            else:
+                session = None
+        if status == 'INV' and self.verify_credentials(user_credentials):
+            status = 'OK'
+
+        if status != 'INV' and not self.limits.enter_user(user_credentials['name']):
+            print(f'Too many sessions of user {user_credentials["name"].decode("utf-8", "replace")}')
+            return BUSY, None
+        return status, session
+
+    def issue_ticket(self, user_credentials: dict, cipher: str, key: bytes, iv: bytes) -> bytes:
+        """
+        Issues ticket of session bound to current entry of user in authentication file. Ticket of user removed from it
+        since logging in is never accepted.
+        """
+        entry = self.credentials.lookup(user_credentials['name'].decode('utf-8')) or ''
+        return self.tickets.issue(user_credentials['name'], user_credentials['pass'], entry, Session(cipher, key, iv))
 
-    def agree_on_data_channel(self, conn: socket.socket, address: Tuple[str, int]) -> \
-            Optional[Tuple[socket.socket, bytes, bytes]]:
+    def verify_credentials(self, user_credentials: dict) -> bool:
+        """
+        Verifies hash received from user against credentials loaded from authentication file.
         """
-        Negotiates Data Channel.
+        return self.credentials.verify(user_credentials['name'].decode('utf-8'), user_credentials['pass'])
+
+    @staticmethod
+    def choose_connections(connection_mode_message: dict) -> int:
+        """
+        Returns number of Data Channel connections requested by client, limited by server.
+        """
+        return max(1, min(connection_mode_message.get('connections', 1), MAX_DATA_CONNECTIONS))
+
+    def agree_on_data_channel(self, conn: socket.socket, address: Tuple[str, int],
+                              session: Optional[Session] = None) -> \
+            Optional[Tuple[List[socket.socket], bytes, bytes, str]]:
+        """
+        Negotiates Data Channel - connection mode, number of connections and cipher used for file transfers.
+        Cipher and keys of resumed session are kept.
         """
         Server.send_object_message(conn, {'mode': 'ready'})
         connection_mode_message = Server.receive_object_message(conn)
         try:
+            if session:
+                cipher = session.cipher
+            else:
+                try:
+                    cipher = choose_cipher(connection_mode_message.get('ciphers', [DEFAULT_CIPHER]), self.ciphers)
+                except ValueError as e:
+                    # Client is told which ciphers server accepts, e.g. when it offers only unencrypted one
+                    Server.send_object_message(conn, {'ERR': str(e), 'ciphers': self.ciphers})
+                    raise
+            connections = Server.choose_connections(connection_mode_message)
+            Server.send_object_message(conn, {'cipher': cipher, 'connections': connections})
+
             if connection_mode_message['mode'] == 'p':
-                return self.connect_data_channel_passive(conn)
+                data_channel = self.connect_data_channel_passive(conn, connections, session)
             elif connection_mode_message['mode'] == 'a':
-                return self.connect_data_channel_active(conn)
+                data_channel = self.connect_data_channel_active(conn, connections, session)
             else:
                 raise Exception('Client sent invalid Data Channel connection mode argument!')
 
+            if not data_channel:
+                return None
+            data_conns, key, iv = data_channel
+            return data_conns, key, iv, cipher
+
         except Exception as e:
             print(f'Exception occurred during attempt to establish Data Channel connection with {address}\n{e}')
             return None
 
-    def connect_data_channel_passive(self, conn: socket.socket) -> Tuple[socket.socket, bytes, bytes]:
+    @staticmethod
+    def generate_secret(length: int) -> bytes:
         """
-        Performs connection with server Data Channel in passive mode.
+        Generates random key or IV for Data Channel cipher.
         """
-        # Create Data Channel and send port number to client
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as data_channel:
-            data_channel.bind((self.host, 0))  # Get random unused port
-            data_channel.listen(1)
-
-            port = int(data_channel.getsockname()[1])
-            Server.send_object_message(conn, {'port': port})
+        return secrets.token_bytes(length)
 
-            key = ''.join(secrets.choice(string.ascii_letters + string.digits) for x in range(32))
-            key = key.encode("utf8")
-            Server.send_object_message(conn, key)
+    def connect_data_channel_passive(self, conn: socket.socket, connections: int,
+                                     session: Optional[Session] = None) -> Tuple[List[socket.socket], bytes, bytes]:
+        """
+        Performs connection with server Data Channel in passive mode. Client connects to listeners of passive port
+        pool and identifies its connections with token. Keys are sent only for a new session.
+        """
+        token, ports = self.passive.expect(connections)
+        try:
+            Server.send_object_message(conn, {'ports': ports, 'token': token})
 
-            iv = ''.join(secrets.choice(string.ascii_letters + string.digits) for x in range(16))
-            iv = iv.encode("utf8")
-            Server.send_object_message(conn, iv)
+            if session:
+                key, iv = session.key, session.iv
+            else:
+                key = Server.generate_secret(32)
+                Server.send_object_message(conn, key)
 
-            connected = False
+                iv = Server.generate_secret(16)
+                Server.send_object_message(conn, iv)
 
-            while not connected:
-                data_conn, address = data_channel.accept()
-                connected = True
+            return self.passive.wait(token), key, iv
 
-            return data_conn, key, iv
+        finally:
+            self.passive.cancel(token)
 
-    def connect_data_channel_active(self, s: socket.socket) -> Optional[Tuple[socket.socket, dict, dict]]:
+    def connect_data_channel_active(self, s: socket.socket, connections: int, session: Optional[Session] = None) -> \
+            Optional[Tuple[List[socket.socket], bytes, bytes]]:
         """
-        Performs connection with server Data Channel in active mode.
+        Performs connection with server Data Channel in active mode. Keys are received only for a new session.
         """
         try:
             message = Server.receive_object_message(s)
 
-            if not message['port']:
+            if not message['ports']:
                 return None
 
-            key_message = Server.receive_object_message(s)
-            key = key_message
+            if session:
+                key, iv = session.key, session.iv
+            else:
+                key_message = Server.receive_object_message(s)
+                key = key_message
 
-            iv_message = Server.receive_object_message(s)
-            iv = iv_message
+                iv_message = Server.receive_object_message(s)
+                iv = iv_message
 
-            # Connect to a port specified by client
-            data_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            data_s.settimeout(5)
-            data_s.connect((s.getsockname()[0], message['port']))
+            # Connect to ports specified by client
+            data_conns = []
+            for port in message['ports'][:connections]:
+                data_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                data_s.settimeout(5)
+                data_s.connect((s.getsockname()[0], int(port)))
+                data_s.settimeout(None)  # Data Channel may stay idle between transfers
+                data_conns.append(data_s)
 
-            return data_s, key, iv
+            return data_conns, key, iv
 
         except Exception as e:
             print(f'Exception occurred during attempt to establish connection with Data Channel in active mode!\n{e}')
             return None
 
-    def handle_commands(self, conn: socket.socket, address: Tuple[str, int], communication_buffer: queue.Queue,
-                        data_channel_event: threading.Event, command_channel_event: threading.Event) -> None:
+    @staticmethod
+    def change_directory(current_dir: str, path: str) -> str:
         """
-        Receives commands from client, verifies and responds to them.
+        Returns current directory after "cd" command. Raises exception if path is invalid.
+        """
+        # Go up in directory tree
+        if path.strip() == '..':
+            return os.path.dirname(current_dir)
+
+        # Return current directory
+        elif path.strip() == '.':
+            return current_dir
+
+        # Go down directory tree or change absolute path
+        elif os.path.isdir(os.path.join(current_dir, path)):
+            if os.path.isabs(path):
+                return path
+            return os.path.join(current_dir, path)
+
+        raise Exception('Invalid command!')
+
+    @staticmethod
+    def iterate_directory(current_dir: str, ls_args: str, cache: Optional[DirectoryCache] = None) -> Iterator[str]:
+        """
+        Returns iterator over lines of directory tree for "ls" command. Raises exception if arguments are invalid.
+        """
+        args = ls_args.split()
+
+        # Default - print all from current directory
+        if len(args) == 0:
+            root, max_level = current_dir, 1
+
+        # Print all from given directory
+        elif len(args) == 1:
+            root, max_level = args[0].strip(), 1
+
+        # Print from specified directory recursively
+        elif len(args) == 2:
+            root, max_level = args[0].strip(), int(args[1])
+
+        else:
+            raise Exception
+
+        if root == '.':
+            root = current_dir
+        namespace = SimpleNamespace(root=root, output='', exclude_folder=[], exclude_name=[], max_level=max_level)
+        return FileTreeMaker(cache).iterate(namespace)
+
+    @staticmethod
+    def next_listing_page(listing: Optional[Listing], current_dir: str, ls_args: str, cursor: int,
+                          cache: Optional[DirectoryCache] = None) -> Tuple[dict, Listing]:
+        """
+        Returns reply with next page of "ls" command and listing to continue from. Cursor is the number of lines
+        client already received. Listing of the session is continued if cursor matches it, otherwise the tree is
+        listed again and lines before cursor are skipped.
+        """
+        if listing is None or listing[:2] != (current_dir, ls_args) or listing[3] != cursor:
+            lines = Server.iterate_directory(current_dir, ls_args, cache)
+            next(itertools.islice(lines, cursor, cursor), None)
+        else:
+            lines = listing[2]
+
+        page = list(itertools.islice(lines, LS_PAGE_LINES))
+        cursor += len(page)
+        reply = {'ls': '\n'.join(page)}
+        if len(page) == LS_PAGE_LINES:
+            reply['cursor'] = cursor
+        return reply, (current_dir, ls_args, lines, cursor)
+
+    @staticmethod
+    def list_records(current_dir: str, path: str, with_hash: bool = False,
+                     hash_index: Optional[HashIndex] = None) -> List[list]:
+        """
+        Returns records of directory for "mlsd" command - [name, type, size, mtime in ns] of each entry,
+        followed by hex SHA-256 (None for directories) if client asked for hashes.
+        """
+        hasher = hash_index.digest if hash_index else hash_file
+        records = scan_records(os.path.join(current_dir, path.strip()), with_hash, hasher)
+        return [list(record) if with_hash else list(record[:4]) for record in records]
+
+    @staticmethod
+    def resolve_get_path(current_dir: str, filepath: str) -> Optional[str]:
+        """
+        Returns path of file requested with "get" command or None if there is no such file.
+        """
+        if not os.path.isfile(os.path.join(current_dir, filepath)):
+            return None
+        if not os.path.isabs(filepath):
+            filepath = os.path.join(current_dir, filepath)
+        return filepath
+
+    @staticmethod
+    def resolve_put_path(current_dir: str, filepath: str, reserved: Iterable[str] = ()) -> Tuple[str, str]:
+        """
+        Creates remote filepath from local filepath sent with "put" command. Reserved paths are treated as existing.
+        Returns filepath for file to be uploaded to and info for user.
+        """
+        _, filename = os.path.split(filepath)
+        filepath = os.path.join(current_dir, filename)
+
+        # Check if generated filepath already exists
+        info = ''
+        if os.path.isfile(filepath) or filepath in reserved:
+            # Add random extension to filename in such case
+            path, filename = os.path.split(filepath)
+            filename, file_type = os.path.splitext(filename)
+            extension = ''.join([str(random.randint(0, 9)) for _ in range(10)])
+            new_filename = f'{filename}_{extension}{file_type}'
+            filepath = os.path.join(current_dir, new_filename)
+
+            info = f'File with such name already exists on server. ' \
+                   f'File will be uploaded as: {new_filename}'
+
+        return filepath, info
+
+    def reserve_upload(self, current_dir: str, filepath: str, resume: bool) -> Tuple[str, str, int]:
+        """
+        Chooses filepath for file sent with "put" command and marks it as being uploaded until release_upload.
+        Returns filepath, info for user and offset the upload starts from - size of partial file left by interrupted
+        upload of the same file if client asked to resume it.
+        """
+        with self.files_in_transfer_mutex:
+            filepath, info = self.lock_put_path(current_dir, filepath)
+            offset = partial_size(filepath) if resume else 0
+            if offset:
+                info = f'Resuming upload of {os.path.basename(filepath)} from byte {offset}'
+        return filepath, info, offset
+
+    def lock_put_path(self, current_dir: str, filepath: str) -> Tuple[str, str]:
+        """
+        Chooses filepath for uploaded file like resolve_put_path and reserves it - marks it as being uploaded and locks
+        its partial file. Paths whose partial files are locked by other processes are treated as existing.
+        Called under files_in_transfer_mutex.
+        """
+        reserved = set(self.files_in_transfer_buffer)
+        while True:
+            path, info = Server.resolve_put_path(current_dir, filepath, reserved)
+            lock = lock_partial(path)
+            # File may have been completed by another process since the path was chosen
+            if lock is not None and not os.path.isfile(path):
+                self.files_in_transfer_buffer.add(path)
+                self.partial_locks[path] = lock
+                return path, info
+            if lock is not None:
+                unlock_partial(path, lock)
+            reserved.add(path)
+
+    @staticmethod
+    def choose_compression(command: dict, filepath: str, offset: int) -> Optional[str]:
+        """
+        Returns compression of file sent with "get" command - the one client asked for, unless sample of the file
+        does not compress.
+        """
+        if 'compression' not in command:
+            return None
+        check_compression(command['compression'], command['level'])
+        return command['compression'] if is_file_compressible(filepath, offset) else None
+
+    def reserve_update(self, current_dir: str, filepath: str) -> Optional[str]:
+        """
+        Marks existing file updated by delta upload as being uploaded until release_upload. Returns None if there
+        is no such file or it is being uploaded.
+        """
+        filepath = os.path.join(current_dir, os.path.basename(filepath))
+        with self.files_in_transfer_mutex:
+            if not os.path.isfile(filepath) or filepath in self.files_in_transfer_buffer:
+                return None
+            lock = lock_partial(filepath)
+            if lock is None:
+                return None
+            self.files_in_transfer_buffer.add(filepath)
+            self.partial_locks[filepath] = lock
+        return filepath
+
+    def release_upload(self, filepath: str) -> None:
+        with self.files_in_transfer_mutex:
+            self.release_locked([filepath])
+
+    def deduplicate_upload(self, current_dir: str, filepath: str, digest: str, size: int) -> Optional[list]:
+        """
+        Handles "put" of content offered with its hash, which server may already have. Returns reply for client if
+        nothing has to be uploaded - file with the same name and content exists, or identical file was hard linked
+        under the name. Returns None if content has to be uploaded.
+        """
+        filename = os.path.basename(filepath)
+        target = os.path.join(current_dir, filename)
+        if os.path.isfile(target) and os.path.getsize(target) == size and self.hash_index.digest(target) == digest:
+            return ['SKIP', f'{filename} with the same content is already on server, upload skipped.']
+
+        source = self.hash_index.find(digest, size)
+        if source is None:
+            return None
+        # Files are always replaced by uploads, never modified in place, so linked files cannot affect each other
+        filepath, _, _ = self.reserve_upload(current_dir, filepath, False)
+        try:
+            os.link(source, filepath)
+        except OSError:
+            return None
+        finally:
+            self.release_upload(filepath)
+        self.hash_index.add_link(source, filepath)
+        return ['LINK', f'Identical file found on server, linked as {os.path.basename(filepath)} instead of uploading.']
+
+    def index_file(self, filepath: str, digest: str, received: str) -> None:
+        """
+        Adds uploaded file to hash index under hash of its content computed while it was received, so later uploads
+        of the same content can be skipped. Digest is the hash client offered the file with.
+        """
+        if received != digest:
+            print(f'Hash of {filepath} sent by client does not match received content!')
+        self.hash_index.add(filepath, received)
+
+    def reserve_uploads(self, current_dir: str, filepaths: Iterable[str]) -> List[Tuple[str, str]]:
+        """
+        Batch version of reserve_upload for "mput" command, files of a batch are never resumed.
+        Returns filepath and info for user of each file.
+        """
+        reserved = []
+        with self.files_in_transfer_mutex:
+            try:
+                for filepath in filepaths:
+                    reserved.append(self.lock_put_path(current_dir, filepath))
+            except OSError:
+                self.release_locked([filepath for filepath, _ in reserved])
+                raise
+        return reserved
+
+    def release_uploads(self, filepaths: Iterable[str]) -> None:
+        with self.files_in_transfer_mutex:
+            self.release_locked(filepaths)
+
+    def release_locked(self, filepaths: Iterable[str]) -> None:
+        """
+        Releases reservations of uploads. Called under files_in_transfer_mutex.
+        """
+        for filepath in filepaths:
+            if filepath in self.files_in_transfer_buffer:
+                self.files_in_transfer_buffer.remove(filepath)
+                unlock_partial(filepath, self.partial_locks.pop(filepath))
+
+    @staticmethod
+    def resolve_mget_files(current_dir: str, patterns: Iterable[str]) -> List[Tuple[str, int]]:
+        """
+        Returns path and size of files matching names or glob patterns sent with "mget" command, each file once.
+        """
+        files = dict()
+        for pattern in patterns:
+            for filepath in sorted(glob.glob(os.path.join(current_dir, pattern))):
+                if filepath not in files and os.path.isfile(filepath):
+                    files[filepath] = os.path.getsize(filepath)
+        return list(files.items())
+
+    @staticmethod
+    def parse_batch(entries: list) -> List[Tuple[str, int]]:
+        """
+        Validates list of [filepath, size] sent with "mput" command.
+        """
+        files = []
+        for entry in entries:
+            if not isinstance(entry, list) or len(entry) != 2 or type(entry[0]) is not str \
+                    or type(entry[1]) is not int or entry[1] < 0:
+                raise Exception(f'Invalid batch entry: {entry}')
+            files.append((entry[0], entry[1]))
+        if not files:
+            raise Exception('Empty batch!')
+        return files
+
+    def prepare_transfer(self, verb: str, command: dict, current_dir: str, channels: list, address: Tuple[str, int],
+                         metrics: SessionMetrics, new_encryptor: Callable[[], Encryptor],
+                         new_decryptor: Callable[[], Decryptor]) -> Transfer:
+        """
+        Validates "get", "put", "mget" or "mput" command and prepares its transfer on channels of the session - files
+        are resolved, reserved and opened. Shared by both engines, blocks on disk, so event loop engine runs it in
+        executor. Raises exception if command is invalid, client is answered with "ERR" then.
+        """
+        if verb == 'get':
+            return Server.prepare_get(command, current_dir, channels, address, metrics, new_encryptor)
+        if verb == 'put':
+            return self.prepare_put(command, current_dir, channels, address, metrics, new_decryptor)
+        if verb == 'mget':
+            return Server.prepare_mget(command, current_dir, channels, address, metrics, new_encryptor)
+        return self.prepare_mput(command, current_dir, channels, address, metrics, new_decryptor)
+
+    @staticmethod
+    def prepare_get(command: dict, current_dir: str, channels: list, address: Tuple[str, int],
+                    metrics: SessionMetrics, new_encryptor: Callable[[], Encryptor]) -> Transfer:
+        """
+        Opens file requested with "get" command. Client opened the stream before sending the command. Client with old
+        copy of the file gets only its changes, on one stream.
+        """
+        filepath = Server.resolve_get_path(current_dir, command['get'])
+        if not filepath:
+            return Transfer({'get': 'ERR'})
+
+        stream_id, offset = command['stream'], command.get('offset', 0)
+        size = os.path.getsize(filepath)
+        if not 0 <= offset <= size:
+            raise Exception(f'Invalid offset: {offset}')
+        is_text_mode = command.get('is_text_mode', False)
+        delta = 'signature' in command and not is_text_mode
+        if delta:
+            index_signature(command['signature'], command['block'])
+        compression = None if delta else Server.choose_compression(command, filepath, offset)
+        # Disk and encryption of each transfer are timed, in its profile if session is profiled
+        recorder = metrics.transfer('get', filepath, size - offset)
+        f = recorder.timed_file(open(filepath, 'rb'))
+
+        if delta:
+            get_channels = recorder.timed_channels(stripe_channels(channels, stream_id, 1))
+            return Transfer({'get': 'OK', 'size': size, 'stripes': 1, 'delta': True}, 'upload_delta',
+                            (get_channels[0], stream_id, f, size, command['signature'], command['block'],
+                             recorder.timed_encryptors(new_encryptor)(), address, recorder), release=f.close)
+
+        stripes = plan_stripes(size - offset, len(channels), is_text_mode)
+        reply = {'get': 'OK', 'size': size, 'stripes': stripes}
+        new_compressor = None
+        if compression:
+            reply['compression'] = compression
+            new_compressor = partial(make_compressor, compression, command['level'])
+        get_channels = recorder.timed_channels(stripe_channels(channels, stream_id, stripes))
+        return Transfer(reply, 'upload_file', (get_channels, stream_id, f, size, offset,
+                                               recorder.timed_encryptors(new_encryptor), new_compressor, address,
+                                               recorder), release=f.close)
+
+    def prepare_put(self, command: dict, current_dir: str, channels: list, address: Tuple[str, int],
+                    metrics: SessionMetrics, new_decryptor: Callable[[], Decryptor]) -> Transfer:
+        """
+        Reserves and opens partial file of file sent with "put" command. Content offered with its hash may already be
+        on server and existing file may be updated with changes of its new content only, sent on one stream.
+        """
+        is_text_mode = command['is_text_mode']
+        stream_id, size, stripes = command['stream'], command['size'], command['stripes']
+        if not 1 <= stripes <= len(channels):
+            raise Exception(f'Invalid number of stripes: {stripes}')
+
+        # Offsets of text mode transfers do not match file sizes, so they are never resumed
+        resume = command.get('resume', False) and not is_text_mode
+
+        digest = command.get('hash') if not is_text_mode else None
+        if digest:
+            reply = self.deduplicate_upload(current_dir, command['put'], digest, size)
+            if reply:
+                return Transfer({'put': reply})
+
+        filepath = None
+        if command.get('delta', False) and not is_text_mode:
+            filepath = self.reserve_update(current_dir, command['put'])
+        if filepath:
+            recorder = metrics.transfer('put', filepath, size)
+            try:
+                signature, block_size = file_signature(filepath)
+                f = recorder.timed_file(open_partial(filepath, 0))
+            except Exception:
+                self.release_upload(filepath)
+                raise
+            return Transfer({'put': ['OK', ''], 'signature': signature, 'block': block_size}, 'download_delta',
+                            (f, filepath, size, block_size, recorder.timed_decryptors(new_decryptor)(), digest,
+                             address, recorder),
+                            Server.stream_opener(recorder, stripe_channels(channels, stream_id, 1), stream_id),
+                            partial(self.cancel_upload, f, filepath))
+
+        # Client compresses file only if it is told that server takes it compressed
+        compression = command.get('compression')
+        if compression:
+            check_compression(compression, command.get('level', 0))
+
+        filepath, info, offset = self.reserve_upload(current_dir, command['put'], resume)
+        offset = min(offset, size)
+        recorder = metrics.transfer('put', filepath, size - offset)
+        try:
+            f = recorder.timed_file(open_partial(filepath, offset))
+        except Exception:
+            self.release_upload(filepath)
+            raise
+        reply = {'put': ['OK', info], 'offset': offset}
+        if compression:
+            reply['compression'] = compression
+        return Transfer(reply, 'download_file',
+                        (f, filepath, size, offset, recorder.timed_decryptors(new_decryptor),
+                         partial(make_decompressor, compression) if compression else None, is_text_mode, digest,
+                         address, recorder),
+                        Server.stream_opener(recorder, stripe_channels(channels, stream_id, stripes), stream_id),
+                        partial(self.cancel_upload, f, filepath))
+
+    @staticmethod
+    def prepare_mget(command: dict, current_dir: str, channels: list, address: Tuple[str, int],
+                     metrics: SessionMetrics, new_encryptor: Callable[[], Encryptor]) -> Transfer:
+        """
+        Resolves files requested with "mget" command. Whole batch is answered at once and sent back to back on one
+        stream per connection.
+        """
+        files = Server.resolve_mget_files(current_dir, command['mget'])
+        if not files:
+            return Transfer({'mget': 'ERR'})
+
+        stream_id = command['stream']
+        stripes = min(len(channels), len(files))
+        recorder = metrics.transfer('mget', ' '.join(command['mget']), sum(size for _, size in files))
+        get_channels = recorder.timed_channels(stripe_channels(channels, stream_id, stripes))
+        return Transfer({'mget': [[os.path.basename(filepath), size] for filepath, size in files],
+                         'stripes': stripes}, 'upload_files',
+                        (get_channels, stream_id, files, recorder.timed_encryptors(new_encryptor), address, recorder))
+
+    def prepare_mput(self, command: dict, current_dir: str, channels: list, address: Tuple[str, int],
+                     metrics: SessionMetrics, new_decryptor: Callable[[], Decryptor]) -> Transfer:
+        """
+        Reserves files of batch sent with "mput" command.
+        """
+        batch = Server.parse_batch(command['mput'])
+        stream_id, stripes = command['stream'], command['stripes']
+        if not 1 <= stripes <= min(len(channels), len(batch)):
+            raise Exception(f'Invalid number of stripes: {stripes}')
+
+        reserved = self.reserve_uploads(current_dir, [filepath for filepath, _ in batch])
+        files = [(filepath, size) for (filepath, _), (_, size) in zip(reserved, batch)]
+        recorder = metrics.transfer('mput', ' '.join(filepath for filepath, _ in files),
+                                    sum(size for _, size in files))
+        return Transfer({'mput': [info for _, info in reserved]}, 'download_files',
+                        (files, recorder.timed_decryptors(new_decryptor), command.get('is_text_mode', False), address,
+                         recorder),
+                        Server.stream_opener(recorder, stripe_channels(channels, stream_id, stripes), stream_id),
+                        partial(self.release_uploads, [filepath for filepath, _ in files]))
+
+    @staticmethod
+    def stream_opener(recorder: Metrics, put_channels: list, stream_id: int) -> Callable[[], list]:
+        return lambda: recorder.timed_frames(open_streams(put_channels, stream_id))
+
+    @staticmethod
+    def open_transfer(transfer: Transfer) -> tuple:
+        """
+        Opens streams of received transfer, so frames client sends once it gets reply are not lost. Returns arguments
+        of method of transfer. Transfer is released if its streams cannot be opened.
+        """
+        if transfer.open_streams is None:
+            return transfer.args
+        try:
+            return (transfer.open_streams(), *transfer.args)
+        except Exception:
+            transfer.release()
+            raise
+
+    def cancel_upload(self, f: BinaryIO, filepath: str) -> None:
+        f.close()
+        self.release_upload(filepath)
+
+    @staticmethod
+    def start_transfer(transfers: List[threading.Thread], t: threading.Thread) -> None:
+        """
+        Starts transfer thread of session. Finished transfers are dropped, so long sessions do not keep every thread
+        they ever ran.
+        """
+        transfers[:] = [transfer for transfer in transfers if transfer.is_alive()]
+        t.start()
+        transfers.append(t)
+
+    def handle_commands(self, conn: socket.socket, address: Tuple[str, int], channels: List[DataChannel],
+                        key: bytes, iv: bytes, cipher: str, metrics: SessionMetrics) -> None:
+        """
+        Receives commands from client, verifies and responds to them. Each accepted "get", "put", "mget" and "mput" is
+        prepared by prepare_transfer and transferred by its own thread on Data Channel stream chosen by client, so
+        transfers of the session run concurrently.
+        Large files are split into ranges moved in parallel over all Data Channel connections.
         """
         current_dir = os.getcwd()  # Only to init
+        listing = None  # "ls" being sent in pages
+        transfers: List[threading.Thread] = []
+        new_encryptor = partial(make_encryptor, cipher, key, iv)
+        new_decryptor = partial(make_decryptor, cipher, key, iv)
         while True:
             command = self.receive_object_message(conn)
 
             if not command:
                 conn.close()
                 print(f'Connection with {address} closed!')
-                communication_buffer.put({'close': ''})  # Make Data Channel close its connection
-                data_channel_event.set()
+                # Let transfers consume frames already sent by client before Data Channel is torn down
+                for t in transfers:
+                    t.join()
+                for channel in channels:
+                    channel.close()
+                print(f'Data Channel of {address} closed.')
                 break
 
+            verb = next((name for name in COMMANDS if name in command), 'invalid')
+            start = time.perf_counter()
             try:
                 if 'cd' in command.keys():
                     # Change current working directory if path is valid
                     try:
-                        # Go up in directory tree
-                        if command['cd'].strip() == '..':
-                            current_dir = os.path.dirname(current_dir)
-
-                        # Return current directory
-                        elif command['cd'].strip() == '.':
-                            pass
-
-                        # Go down directory tree or change absolute path
-                        elif os.path.isdir(os.path.join(current_dir, command['cd'])):
-                            if os.path.isabs(command['cd']):
-                                current_dir = command['cd']
-                            else:
-                                current_dir = os.path.join(current_dir, command['cd'])
-
-                        else:
-                            raise Exception('Invalid command!')
-
+                        current_dir = Server.change_directory(current_dir, command['cd'])
                         self.send_object_message(conn, {'cd': current_dir})  # Send to client updated path
 
                     except Exception as e:
@@ -279,96 +1030,38 @@ class Server:
                 elif 'ls' in command.keys():
 
                     try:
-                        args = command['ls'].split()
-
-                        # Default - print all from current directory
-                        if len(args) == 0:
-                            namespace = SimpleNamespace(root=current_dir, output='', exclude_folder=[],
-                                                        exclude_name=[], max_level=1)
-                            tree_str = FileTreeMaker().make(namespace)
-
-                        # Print all from given directory
-                        elif len(args) == 1:
-                            r = args[0].strip()
-                            if r == '.':
-                                r = current_dir
-                            namespace = SimpleNamespace(root=r, output='', exclude_folder=[],
-                                                        exclude_name=[], max_level=1)
-                            tree_str = FileTreeMaker().make(namespace)
-
-                        # Print from specified directory recursively
-                        elif len(args) == 2:
-                            r = args[0].strip()
-                            if r == '.':
-                                r = current_dir
-                            namespace = SimpleNamespace(root=r, output='', exclude_folder=[],
-                                                        exclude_name=[], max_level=int(args[1]))
-                            tree_str = FileTreeMaker().make(namespace)
-
-                        else:
-                            raise Exception
-
-                        self.send_object_message(conn, {'ls': tree_str})
+                        page, listing = Server.next_listing_page(listing, current_dir, command['ls'],
+                                                                 command.get('cursor', 0), self.listing_cache)
+                        self.send_object_message(conn, page)
 
                     except Exception as e:
+                        listing = None
                         print(f'Exception occurred in command channel of {address}\n{e}')
                         self.send_object_message(conn, {'ls': 'ERR'})
 
-                elif 'get' in command.keys():
+                elif 'mlsd' in command.keys():
                     try:
-                        # Validate path of received file
-                        filepath = command['get']
-
-                        if os.path.isfile(os.path.join(current_dir, filepath)):
-                            if not os.path.isabs(filepath):
-                                filepath = os.path.join(current_dir, filepath)
-
-                            # Init upload
-                            communication_buffer.put({'get': filepath})
-                            self.send_object_message(conn, {'get': 'OK'})
-                            message = self.receive_object_message(conn)  # Wait for response message
-                            if message['get'] == 'ready':
-                                data_channel_event.set()
-
-                        else:
-                            self.send_object_message(conn, {'get': 'ERR'})
+                        records = Server.list_records(current_dir, command['mlsd'], command.get('hashes', False),
+                                                      self.hash_index)
+                        self.send_object_message(conn, {'mlsd': records})
 
                     except Exception as e:
                         print(f'Exception occurred in command channel of {address}\n{e}')
-                        self.send_object_message(conn, {'get': 'ERR'})
+                        self.send_object_message(conn, {'mlsd': 'ERR'})
 
-                elif 'put' in command.keys():
+                elif verb in TRANSFER_COMMANDS:
                     try:
-                        # Create remote filepath from local filepath
-                        filepath = command['put']  # Local filepath
-                        _, filename = os.path.split(filepath)
-                        filepath = os.path.join(current_dir, filename)  # Filepath for file to be uploaded to
-                        is_text_mode = command["is_text_mode"]
-
-                        # Check if generated filepath already exists
-                        info = ''
-                        if os.path.isfile(filepath):
-                            # Add random extension to filename in such case
-                            path, filename = os.path.split(filepath)
-                            filename, file_type = os.path.splitext(filename)
-                            extension = ''.join([str(random.randint(0, 9)) for _ in range(10)])
-                            new_filename = f'{filename}_{extension}{file_type}'
-                            filepath = os.path.join(current_dir, new_filename)
-
-                            info = f'File with such name already exists on server. ' \
-                                   f'File will be uploaded as: {new_filename}'
-
-                        # Init download (from client to server)
-                        communication_buffer.put({'put': filepath, 'is_text_mode': is_text_mode})
-                        self.send_object_message(conn, {'put': ['OK', info]})
-                        data_channel_event.set()
-                        command_channel_event.wait()  # Wait for Data Channel info
-                        command_channel_event.clear()
-                        self.send_object_message(conn, {'put': 'ready'})
+                        transfer = self.prepare_transfer(verb, command, current_dir, channels, address, metrics,
+                                                         new_encryptor, new_decryptor)
+                        args = Server.open_transfer(transfer)
+                        self.send_object_message(conn, transfer.reply)
+                        if transfer.method:
+                            Server.start_transfer(transfers, threading.Thread(target=getattr(self, transfer.method),
+                                                                              args=args))
 
                     except Exception as e:
                         print(f'Exception occurred in command channel of {address}\n{e}')
-                        self.send_object_message(conn, {'put': 'ERR'})
+                        self.send_object_message(conn, {verb: 'ERR'})
 
                 else:
                     print(f'Received invalid command from {address}')
@@ -376,96 +1069,133 @@ class Server:
             except Exception as e:
                 print(f'Exception occurred in command channel of {address}\n{e}')
                 try:
-                    self.send_object_message(conn, {'ERR': e})
+                    self.send_object_message(conn, {'ERR': str(e)})
                 except Exception as e:
                     print(f'Exception occurred in command channel of {address}\n{e}')
 
-    def handle_data_channel(self, data_conn: socket.socket, communication_buffer: queue.Queue,
-                            data_channel_event: threading.Event, command_channel_event: threading.Event,
-                            key: bytes, iv: bytes) -> None:
+            finally:
+                metrics.observe(f'command.{verb}', time.perf_counter() - start)
+
+    @staticmethod
+    def upload_file(channels: List[DataChannel], stream_id: int, f: BinaryIO, size: int, offset: int,
+                    new_encryptor: Callable[[], Encryptor], new_compressor: Optional[Callable],
+                    address: Tuple[str, int], metrics: Metrics) -> None:
         """
-        Handles Data Channel - sending and receiving files.
+        Sends file requested with "get" command on its Data Channel streams, starting from offset.
         """
-        while True:
-            data_channel_event.wait()  # Wait for task
-            data_channel_event.clear()
-
-            command = communication_buffer.get()
-
-            if 'close' in command.keys():
-                print(f'Data Channel with {data_conn.getsockname()} closed.')
-                data_conn.close()
-                break
-
-            elif 'get' in command.keys():
-                with open(command['get'], 'rb') as f:
-
-                    data = f.read()
-                    data = Server.encrypt(data, key, iv)
-
-                    filesize = len(data)
-                    data_header = bytes(f'{filesize:<{Server.HEADER_LENGTH}}', 'utf-8')
+        with f:
+            try:
+                with metrics.timed('transfer.get'):
+                    send_file_striped(channels, stream_id, f, size, new_encryptor, offset, new_compressor)
 
-                    data_conn.sendall(data_header + data)
+            except Exception as e:
+                print(f'Exception occurred during sending data to {address}!\n{e}')
 
-            elif 'put' in command.keys():
-                with open(command['put'], 'wb') as f:
-                    command_channel_event.set()  # Inform about readiness to download a file
+    def download_file(self, streams: List[Iterator[bytes]], f: BinaryIO, filepath: str, size: int, offset: int,
+                      new_decryptor: Callable[[], Decryptor], new_decompressor: Optional[Callable[[], Decompressor]],
+                      is_text_mode: bool, digest: Optional[str], address: Tuple[str, int],
+                      metrics: Metrics) -> None:
+        """
+        Receives file sent with "put" command from its Data Channel streams into partial file, which replaces
+        filepath once complete. Partial file of failed upload is kept, so the upload can be resumed.
+        File offered with its hash is indexed.
+        """
+        try:
+            with metrics.timed('transfer.put'):
+                if digest:
+                    f = HashingFile(f, offset)
+                with f:
+                    receive_file_striped(streams, f, size, new_decryptor, is_text_mode, offset, new_decompressor)
+                    received = f.hexdigest(size) if digest else None
+                complete_partial(filepath, None if is_text_mode else size)
+            if digest:
+                self.index_file(filepath, digest, received)
 
-                    try:
-                        data_header = data_conn.recv(Server.HEADER_LENGTH)
-                        if not data_header:
-                            print(f'Failed to receive data header! Connection: {data_conn.getsockname()}')
-                            break
+        except Exception as e:
+            print(f'Exception occurred during receiving data from {address}!\n{e}')
 
-                        data_length = int(data_header.decode('utf-8').strip())
-                        data = data_conn.recv(data_length)
+        finally:
+            abandon_streams(streams)
+            self.release_upload(filepath)
 
-                        if not data:
-                            print(f'Failed to receive data! Connection: {data_conn.getsockname()}')
-                            break
+    @staticmethod
+    def upload_delta(channel: DataChannel, stream_id: int, f: BinaryIO, size: int, signature: bytes,
+                     block_size: int, encryptor: Encryptor, address: Tuple[str, int], metrics: Metrics) -> None:
+        """
+        Sends changes of file requested with "get" command against client's copy of signature.
+        """
+        with f:
+            try:
+                with metrics.timed('transfer.get_delta'):
+                    send_delta(channel, stream_id, f, size, signature, block_size, encryptor)
 
-                        data = Server.decrypt(data, key, iv)
+            except Exception as e:
+                print(f'Exception occurred during sending data to {address}!\n{e}')
 
-                        if command['is_text_mode']:
-                            data = data.replace(b"/n/r", b"/n")
-                            if platform.system() == "Windows":
-                                data = data.replace(b"/n", b"/n/r")
-                            elif platform.system() != "Linux":
-                                print(f'detected an unsupported system: {platform.system()}, '
-                                      f'assuming Linux-like behavior')
+    def download_delta(self, streams: List[Iterator[bytes]], f: BinaryIO, filepath: str, size: int,
+                       block_size: int, decryptor: Decryptor, digest: Optional[str], address: Tuple[str, int],
+                       metrics: Metrics) -> None:
+        """
+        Rebuilds file updated by "put" command from its current content and changes received on its one stream into
+        partial file, which replaces filepath once complete.
+        """
+        try:
+            with metrics.timed('transfer.put_delta'):
+                if digest:
+                    f = HashingFile(f)
+                with f, metrics.timed_file(open(filepath, 'rb')) as basis:
+                    receive_delta(streams[0], basis, f, block_size, decryptor)
+                    received = f.hexdigest(size) if digest else None
+                complete_partial(filepath, size)
+            if digest:
+                self.index_file(filepath, digest, received)
 
-                        f.write(data)
+        except Exception as e:
+            print(f'Exception occurred during receiving data from {address}!\n{e}')
 
-                    except Exception as e:
-                        print(f'Exception occurred during receiving data! Connection: {data_conn.getsockname()}\n{e}')
-                        return None
+        finally:
+            abandon_streams(streams)
+            self.release_upload(filepath)
 
     @staticmethod
-    def decrypt(message, key, iv):
+    def upload_files(channels: List[DataChannel], stream_id: int, files: List[Tuple[str, int]],
+                     new_encryptor: Callable[[], Encryptor], address: Tuple[str, int],
+                     metrics: Metrics) -> None:
         """
-        Decrypts received message
+        Sends batch of files requested with "mget" command on its Data Channel streams.
         """
-        message = base64.b64decode(message)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        decrypted_text = cipher.decrypt(message)
-        return decrypted_text[:-ord(decrypted_text[len(decrypted_text) - 1:])]
+        try:
+            with metrics.timed('transfer.mget'):
+                send_batch_striped(channels, stream_id, files, new_encryptor)
 
-    @staticmethod
-    def encrypt(message, key, iv):
+        except Exception as e:
+            print(f'Exception occurred during sending data to {address}!\n{e}')
+
+    def download_files(self, streams: List[Iterator[bytes]], files: List[Tuple[str, int]],
+                       new_decryptor: Callable[[], Decryptor], is_text_mode: bool, address: Tuple[str, int],
+                       metrics: Metrics) -> None:
         """
-        Encrypts passed message that is going to be sent
+        Receives batch of files sent with "mput" command from its Data Channel streams.
         """
-        message = message + (AES.block_size - len(message) % AES.block_size) * str.encode(
-            chr(AES.block_size - len(message) % AES.block_size))
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        encrypted_text = cipher.encrypt(message)
-        return base64.b64encode(encrypted_text)
+        try:
+            with metrics.timed('transfer.mput'):
+                receive_batch_striped(streams, files, new_decryptor, is_text_mode)
+
+        except Exception as e:
+            print(f'Exception occurred during receiving data from {address}!\n{e}')
+
+        finally:
+            abandon_streams(streams)
+            self.release_uploads([filepath for filepath, _ in files])
 
 
 def main() -> None:
     server = Server()
-    server.run()
+    if server.engine == 'asyncio':
+        from async_server import AsyncServer
+        AsyncServer(server, server.workers).run()
+    else:
+        server.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+"""
+Session tickets - reconnecting client resumes its authenticated session and Data Channel keys without verifying its
+password hash and generating and exchanging keys again.
+
+Ticket is the session state (user, password hash, digest of user's entry of authentication file, cipher, key, IV,
+expiry) encrypted and authenticated with AES-GCM under a key known only to server, so server keeps no state per
+session and any worker process can resume any session. Tickets are valid until they expire, server restarts or entry
+of the user changes - user removed from authentication file or given a new password cannot resume sessions.
+"""
+import hashlib
+import hmac
+import secrets
+import time
+from typing import NamedTuple, Optional
+
+from Crypto.Cipher import AES
+
+from codec import CodecError, encode_message, decode_message
+
+# Seconds a ticket may be used for
+TICKET_LIFETIME = 3600
+
+NONCE_LENGTH = 12
+TAG_LENGTH = 16
+
+
+class Session(NamedTuple):
+    cipher: str
+    key: bytes
+    iv: bytes
+
+
+class SessionTickets:
+    """
+    Issues and verifies session tickets. Ticket key is generated once per server run and must be created before
+    worker processes are started.
+    """
+
+    def __init__(self, lifetime: int = TICKET_LIFETIME):
+        self.lifetime = lifetime
+        self.key = secrets.token_bytes(32)
+
+    @staticmethod
+    def entry_digest(entry: str) -> bytes:
+        return hashlib.sha256(entry.encode('utf-8')).digest()
+
+    def issue(self, name: bytes, password_hash: str, entry: str, session: Session) -> bytes:
+        """
+        Issues ticket of session of user, whose entry of authentication file is entry.
+        """
+        state = encode_message({'name': name, 'pass': password_hash, 'credential': SessionTickets.entry_digest(entry),
+                                'cipher': session.cipher, 'key': session.key, 'iv': session.iv,
+                                'expires': int(time.time()) + self.lifetime})
+        nonce = secrets.token_bytes(NONCE_LENGTH)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_LENGTH)
+        ciphertext, tag = cipher.encrypt_and_digest(state)
+        return nonce + ciphertext + tag
+
+    def resume(self, ticket: bytes, name: bytes, password_hash: str, entry: Optional[str]) -> Optional[Session]:
+        """
+        Returns session of ticket if it is valid and was issued to user with the same credentials, None otherwise.
+        Entry is the current entry of the user in authentication file, None if the user is not there anymore.
+        """
+        if not entry or len(ticket) < NONCE_LENGTH + TAG_LENGTH:
+            return None
+        try:
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=ticket[:NONCE_LENGTH], mac_len=TAG_LENGTH)
+            state = decode_message(cipher.decrypt_and_verify(ticket[NONCE_LENGTH:-TAG_LENGTH], ticket[-TAG_LENGTH:]))
+        except (ValueError, CodecError):
+            return None
+
+        if state['expires'] < time.time() or state['name'] != name or \
+                not hmac.compare_digest(state['pass'].encode('utf-8'), password_hash.encode('utf-8')) or \
+                not hmac.compare_digest(state.get('credential', b''), SessionTickets.entry_digest(entry)):
+            return None
+        return Session(state['cipher'], state['key'], state['iv'])
@@ -0,0 +1,178 @@
+"""
+Bandwidth limits of Data Channel. Every frame a session sends or receives takes tokens from the bucket of the session,
+the bucket shared by all sessions of its user and the bucket of its fair share of total bandwidth of server. Frame
+which takes more tokens than there are waits until they are refilled, so transfers slow down instead of failing.
+Received frames are limited by reading the next one later, which lets TCP flow control slow down the sender.
+
+Total bandwidth is divided equally among sessions which moved data within the last ACTIVE_WINDOW seconds, so one bulk
+transfer does not starve transfers of other sessions. Command Channel is never throttled, so "ls" and "cd" answer
+right away while transfers wait. Each worker process of asyncio engine enforces limits on its own sessions.
+"""
+import asyncio
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+# Seconds of full rate a bucket may save up, so short bursts are not slowed down
+BURST_SECONDS = 0.25
+# Session which moved no data for so long does not take a share of total bandwidth
+ACTIVE_WINDOW = 1.0
+# Seconds between recounts of active sessions
+RECOUNT_INTERVAL = 0.1
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(spec: str) -> int:
+    """
+    Parses bytes per second given by user, e.g. "500K" or "10M". 0 means unlimited.
+    """
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)', spec.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Invalid rate: {spec}')
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+class TokenBucket:
+    """
+    Tokens are bytes, refilled at rate per second up to BURST_SECONDS of rate. Not thread-safe, guarded by its
+    Throttles.
+    """
+
+    def __init__(self, rate: float, now: float):
+        self.rate = rate
+        self.tokens = rate * BURST_SECONDS
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * BURST_SECONDS)
+        self.updated = now
+
+    def set_rate(self, rate: float, now: float) -> None:
+        """
+        Changes rate, tokens saved up above burst of the new rate are dropped.
+        """
+        self.refill(now)
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * BURST_SECONDS)
+
+    def reserve(self, count: int, now: float) -> float:
+        """
+        Takes count tokens, going into debt if there are not enough of them. Returns seconds until the debt is paid,
+        so frames reserved one after another are spaced at rate of the bucket.
+        """
+        self.refill(now)
+        self.tokens -= count
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Throttle:
+    """
+    Limits of one session, shared by all its Data Channel connections.
+    """
+
+    def __init__(self, throttles: 'Throttles', user: bytes, bucket: Optional[TokenBucket]):
+        self.throttles = throttles
+        self.user = user
+        self.bucket = bucket
+
+    def wait(self, count: int) -> None:
+        """
+        Blocks until count bytes may be moved.
+        """
+        delay = self.throttles.reserve(self, count)
+        if delay:
+            time.sleep(delay)
+
+    async def async_wait(self, count: int) -> None:
+        delay = self.throttles.reserve(self, count)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class Throttles:
+    """
+    Buckets of sessions, their users and their shares of total bandwidth. Thread-safe.
+    """
+
+    def __init__(self, session_rate: int = 0, user_rate: int = 0, total_rate: int = 0):
+        self.session_rate = session_rate
+        self.user_rate = user_rate
+        self.total_rate = total_rate
+        self.users: Dict[bytes, TokenBucket] = dict()
+        self.user_sessions = Counter()
+        # Fair share buckets of sessions and when each session moved data last
+        self.shares: Dict[Throttle, TokenBucket] = dict()
+        self.last_active: Dict[Throttle, float] = dict()
+        self.active = 1
+        self.counted = 0.0
+        # Seconds frames were held back, for stats
+        self.waited = 0.0
+        self.mutex = threading.Lock()
+
+    def open_session(self, user: bytes) -> Optional[Throttle]:
+        """
+        Returns limits of new session of user, None if bandwidth is not limited at all.
+        """
+        if not (self.session_rate or self.user_rate or self.total_rate):
+            return None
+        now = time.monotonic()
+        throttle = Throttle(self, user, TokenBucket(self.session_rate, now) if self.session_rate else None)
+        with self.mutex:
+            if self.user_rate:
+                self.user_sessions[user] += 1
+                if user not in self.users:
+                    self.users[user] = TokenBucket(self.user_rate, now)
+            if self.total_rate:
+                self.shares[throttle] = TokenBucket(self.total_rate, now)
+        return throttle
+
+    def close_session(self, throttle: Optional[Throttle]) -> None:
+        if throttle is None:
+            return
+        with self.mutex:
+            if self.user_rate:
+                self.user_sessions[throttle.user] -= 1
+                if self.user_sessions[throttle.user] <= 0:
+                    del self.user_sessions[throttle.user]
+                    del self.users[throttle.user]
+            self.shares.pop(throttle, None)
+            self.last_active.pop(throttle, None)
+
+    def reserve(self, throttle: Throttle, count: int) -> float:
+        """
+        Takes count bytes from all buckets of session, returns seconds the session has to wait before moving them.
+        """
+        now = time.monotonic()
+        delay = 0.0
+        with self.mutex:
+            if throttle.bucket:
+                delay = throttle.bucket.reserve(count, now)
+            if self.user_rate:
+                delay = max(delay, self.users[throttle.user].reserve(count, now))
+            if self.total_rate:
+                # Session which starts moving data takes its share right away
+                recount = throttle not in self.last_active or now - self.counted >= RECOUNT_INTERVAL
+                self.last_active[throttle] = now
+                if recount:
+                    self.count_active(now)
+                share = self.shares[throttle]
+                share.set_rate(self.total_rate / self.active, now)
+                delay = max(delay, share.reserve(count, now))
+            self.waited += delay
+        return delay
+
+    def count_active(self, now: float) -> None:
+        """
+        Counts sessions sharing total bandwidth. Called under mutex.
+        """
+        for throttle in [throttle for throttle, active in self.last_active.items() if now - active > ACTIVE_WINDOW]:
+            del self.last_active[throttle]
+        self.active = max(len(self.last_active), 1)
+        self.counted = now
+
+    def stats(self) -> dict:
+        with self.mutex:
+            return {'session_rate': self.session_rate, 'user_rate': self.user_rate, 'total_rate': self.total_rate,
+                    'active_sessions': len(self.last_active), 'throttled_s': round(self.waited, 3)}
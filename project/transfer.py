@@ -0,0 +1,638 @@
+import asyncio
+import itertools
+import os
+import platform
+import threading
+from typing import AsyncIterable, BinaryIO, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows runs only threaded engine, whose reservations of uploads are enough
+    fcntl = None
+
+from ciphers import Encryptor, Decryptor
+from compression import Decompressor
+from mux import DataChannel, AsyncDataChannel
+
+# Size of plaintext read from disk per frame
+CHUNK_SIZE = 64 * 1024
+# Largest frame accepted on Data Channel - chunk with cipher overhead
+MAX_FRAME_LENGTH = 2 * CHUNK_SIZE
+
+# Files smaller than this are sent over one Data Channel connection, even if the session has more
+STRIPE_MIN_SIZE = 1024 * 1024
+
+TEXT_MODE_PATTERN = b"/n/r"
+
+# File is received under its name with this suffix and renamed once complete. Partial file left by interrupted
+# transfer tells where the transfer may be resumed.
+PARTIAL_SUFFIX = '.part'
+
+# Serializes seek+read/write where positional I/O is not available (Windows)
+POSITIONAL_IO_MUTEX = threading.Lock()
+
+
+class TextModeConverter:
+    """
+    Converts line endings of a stream received in text mode. Bytes which may be the beginning of a line ending
+    split between two chunks are held back until the next chunk arrives.
+    """
+
+    def __init__(self):
+        self.tail = b''
+        if platform.system() not in ('Windows', 'Linux'):
+            print(f'detected an unsupported system: {platform.system()}, assuming Linux-like behavior')
+
+    @staticmethod
+    def convert(data: bytes) -> bytes:
+        data = data.replace(b"/n/r", b"/n")
+        if platform.system() == "Windows":
+            data = data.replace(b"/n", b"/n/r")
+        return data
+
+    def update(self, data: bytes) -> bytes:
+        data = self.tail + data
+        held = 0
+        for length in range(len(TEXT_MODE_PATTERN) - 1, 0, -1):
+            if data.endswith(TEXT_MODE_PATTERN[:length]):
+                held = length
+                break
+        self.tail = data[len(data) - held:] if held else b''
+        return self.convert(data[:len(data) - held])
+
+    def finish(self) -> bytes:
+        data, self.tail = self.tail, b''
+        return self.convert(data)
+
+
+def read_at(f: BinaryIO, length: int, offset: int) -> bytes:
+    if hasattr(f, 'read_at'):  # File timed by metrics
+        return f.read_at(length, offset)
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), length, offset)
+    with POSITIONAL_IO_MUTEX:
+        f.seek(offset)
+        return f.read(length)
+
+
+def write_at(f: BinaryIO, data: bytes, offset: int) -> None:
+    if hasattr(f, 'write_at'):  # File timed by metrics
+        f.write_at(data, offset)
+        return
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with POSITIONAL_IO_MUTEX:
+        f.seek(offset)
+        f.write(data)
+
+
+def read_range_chunks(f: BinaryIO, offset: int, length: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    end = offset + length
+    while offset < end:
+        chunk = read_at(f, min(chunk_size, end - offset), offset)
+        if not chunk:
+            return
+        offset += len(chunk)
+        yield chunk
+
+
+def open_partial(filepath: str, offset: int) -> BinaryIO:
+    """
+    Opens partial file of filepath for writing, and reading back what was written. First offset bytes, received by
+    interrupted transfer, are kept.
+    """
+    partial = filepath + PARTIAL_SUFFIX
+    if not offset:
+        return open(partial, 'w+b')
+    f = open(partial, 'r+b')
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def lock_partial(filepath: str) -> Optional[int]:
+    """
+    Takes exclusive lock of partial file of filepath, created if missing, so worker processes of server never
+    receive the same file at once. Returns descriptor holding the lock until unlock_partial, None if another process
+    holds it. Lock follows the file when it is completed under filepath.
+    """
+    fd = os.open(filepath + PARTIAL_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+    return fd
+
+
+def unlock_partial(filepath: str, fd: int) -> None:
+    """
+    Releases lock of partial file. Partial file left empty, e.g. by upload which failed before receiving anything,
+    is removed.
+    """
+    partial = filepath + PARTIAL_SUFFIX
+    try:
+        stat = os.fstat(fd)
+        if not stat.st_size and os.path.samestat(stat, os.stat(partial)):
+            os.remove(partial)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def complete_partial(filepath: str, size: Optional[int]) -> None:
+    """
+    Replaces filepath with its partial file if all size bytes were received, None skips the check.
+    """
+    partial = filepath + PARTIAL_SUFFIX
+    received = os.path.getsize(partial)
+    if size is not None and received != size:
+        raise ValueError(f'Transfer incomplete, received {received} of {size} bytes!')
+    os.replace(partial, filepath)
+
+
+def partial_size(filepath: str) -> int:
+    """
+    Returns number of bytes of filepath received by interrupted transfer.
+    """
+    partial = filepath + PARTIAL_SUFFIX
+    return os.path.getsize(partial) if os.path.isfile(partial) else 0
+
+
+def plan_stripes(size: int, connections: int, is_text_mode: bool) -> int:
+    """
+    Returns number of byte ranges a file is split into. Text mode changes length of data,
+    so such files are never split.
+    """
+    if is_text_mode or size < STRIPE_MIN_SIZE:
+        return 1
+    return connections
+
+
+def split_ranges(size: int, stripes: int, start: int = 0) -> List[Tuple[int, int]]:
+    """
+    Splits part of file from start to size into stripes ranges of (offset, length), the last one takes the remainder.
+    """
+    length = (size - start) // stripes
+    ranges = [(start + i * length, length) for i in range(stripes - 1)]
+    last = start + (stripes - 1) * length
+    ranges.append((last, size - last))
+    return ranges
+
+
+def stripe_channels(channels: Sequence, stream_id: int, stripes: int) -> list:
+    """
+    Returns connections carrying stripes of a transfer. Consecutive transfers start on different connections,
+    so concurrent unsplit transfers are spread over all of them.
+    """
+    return [channels[(stream_id + i) % len(channels)] for i in range(stripes)]
+
+
+def run_stripes(target: Callable, stripes_args: List[tuple]) -> None:
+    """
+    Runs target for every stripe in its own thread and raises the first exception of a failed stripe.
+    """
+    errors = []
+
+    def run(*args) -> None:
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=args) for args in stripes_args]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def send_stream(channel: DataChannel, stream_id: int, chunks: Iterable[bytes], encryptor: Encryptor) -> None:
+    """
+    Encrypts and sends chunks one frame at a time. Stream is terminated with an empty frame.
+    """
+    try:
+        for chunk in chunks:
+            frame = encryptor.update(chunk)
+            if frame:
+                channel.send(stream_id, frame)
+        frame = encryptor.finish()
+        if frame:
+            channel.send(stream_id, frame)
+    finally:
+        # Receiver is released even if sending failed - incomplete stream is rejected by its decryptor
+        channel.send(stream_id, b'')
+
+
+def receive_stream(frames: Iterable[bytes], decryptor: Decryptor) -> Iterator[bytes]:
+    """
+    Decrypts frames of one stream until its end and yields decrypted chunks.
+    """
+    for frame in frames:
+        if not frame:
+            break
+        data = decryptor.update(frame)
+        if data:
+            yield data
+    data = decryptor.finish()
+    if data:
+        yield data
+
+
+def compress_chunks(chunks: Iterable[bytes], compressor, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Compresses chunks into chunks of up to chunk_size. Compressor may hold data back and release it in one piece.
+    """
+    for chunk in itertools.chain(chunks, [None]):
+        data = compressor.compress(chunk) if chunk is not None else compressor.flush()
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+
+def decompress_chunks(chunks: Iterable[bytes], decompressor: Decompressor,
+                      chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield from decompressor.update(chunk, chunk_size)
+    decompressor.finish()
+
+
+def send_file(channel: DataChannel, stream_id: int, f: BinaryIO, offset: int, length: int,
+              encryptor: Encryptor, compressor=None) -> None:
+    """
+    Sends range of file as one stream, compressed if compressor is given. Unencrypted uncompressed data goes from
+    page cache to socket with sendfile.
+    """
+    if compressor is None and encryptor.zero_copy and channel.can_send_file():
+        try:
+            channel.send_file(stream_id, f, offset, length)
+        finally:
+            channel.send(stream_id, b'')
+        return
+
+    chunks = read_range_chunks(f, offset, length)
+    send_stream(channel, stream_id, compress_chunks(chunks, compressor) if compressor else chunks, encryptor)
+
+
+def send_file_striped(channels: List[DataChannel], stream_id: int, f: BinaryIO, size: int,
+                      new_encryptor: Callable[[], Encryptor], start: int = 0,
+                      new_compressor: Optional[Callable] = None) -> None:
+    """
+    Sends file from start offset split into one byte range per channel, ranges are sent in parallel on streams
+    with the same id. Each range is compressed separately.
+    """
+    ranges = split_ranges(size, len(channels), start)
+    if len(channels) == 1:
+        send_file(channels[0], stream_id, f, *ranges[0], new_encryptor(), new_compressor() if new_compressor else None)
+        return
+
+    run_stripes(send_file, [(channel, stream_id, f, offset, length, new_encryptor(),
+                             new_compressor() if new_compressor else None)
+                            for channel, (offset, length) in zip(channels, ranges)])
+
+
+def receive_file(frames: Iterable[bytes], f: BinaryIO, decryptor: Decryptor, is_text_mode: bool = False,
+                 decompressor: Optional[Decompressor] = None) -> None:
+    """
+    Receives stream and writes it to file chunk by chunk, so memory usage does not depend on file size.
+    """
+    converter = TextModeConverter() if is_text_mode else None
+    chunks = receive_stream(frames, decryptor)
+    for data in decompress_chunks(chunks, decompressor) if decompressor else chunks:
+        if converter:
+            data = converter.update(data)
+        f.write(data)
+    if converter:
+        f.write(converter.finish())
+
+
+def receive_range(frames: Iterable[bytes], f: BinaryIO, offset: int, decryptor: Decryptor,
+                  decompressor: Optional[Decompressor] = None) -> None:
+    """
+    Writes received stream into its place in file, so ranges can be written in any order.
+    """
+    chunks = receive_stream(frames, decryptor)
+    for data in decompress_chunks(chunks, decompressor) if decompressor else chunks:
+        write_at(f, data, offset)
+        offset += len(data)
+
+
+def receive_file_striped(streams: List[Iterable[bytes]], f: BinaryIO, size: int,
+                         new_decryptor: Callable[[], Decryptor], is_text_mode: bool = False, start: int = 0,
+                         new_decompressor: Optional[Callable[[], Decompressor]] = None) -> None:
+    """
+    Receives file sent with send_file_striped. Each range is written by its own thread as it arrives,
+    nothing is buffered beyond frames queued per stream.
+    """
+    if is_text_mode:
+        # Length of converted data differs, so it is written sequentially
+        receive_file(streams[0], f, new_decryptor(), is_text_mode, new_decompressor() if new_decompressor else None)
+        return
+
+    ranges = split_ranges(size, len(streams), start)
+    if len(streams) == 1:
+        receive_range(streams[0], f, ranges[0][0], new_decryptor(), new_decompressor() if new_decompressor else None)
+        return
+
+    run_stripes(receive_range, [(frames, f, offset, new_decryptor(), new_decompressor() if new_decompressor else None)
+                                for frames, (offset, _) in zip(streams, ranges)])
+
+
+def split_batch(files: Sequence[Tuple[str, int]], stripes: int) -> List[Sequence[Tuple[str, int]]]:
+    """
+    Splits batch of (filepath, size) into stripes groups of consecutive files, one group per Data Channel connection.
+    """
+    return [files[offset:offset + length] for offset, length in split_ranges(len(files), stripes)]
+
+
+def read_files_chunks(files: Iterable[Tuple[str, int]], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yields first size bytes of each file back to back. Small files are packed together into chunks of up to
+    chunk_size, so a batch of small files does not cost a frame per file.
+    """
+    buffer = bytearray()
+    for filepath, size in files:
+        with open(filepath, 'rb') as f:
+            offset = 0
+            while offset < size:
+                chunk = read_at(f, min(chunk_size - len(buffer), size - offset), offset)
+                if not chunk:
+                    raise ValueError(f'{filepath} was truncated during transfer!')
+                buffer += chunk
+                offset += len(chunk)
+                if len(buffer) == chunk_size:
+                    yield bytes(buffer)
+                    buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class BatchWriter:
+    """
+    Splits stream of files sent back to back into partial files by their sizes. Each file replaces its filepath
+    as soon as all its bytes arrive.
+    """
+
+    def __init__(self, files: Iterable[Tuple[str, int]], is_text_mode: bool = False):
+        self.files = iter(files)
+        self.is_text_mode = is_text_mode
+        self.f = None
+        self.filepath = ''
+        self.size = 0
+        self.left = 0
+        self.converter = None
+        self.open_next()
+
+    def open_next(self) -> None:
+        """
+        Opens partial file of the next file with data to receive. Empty files are completed on the way.
+        """
+        self.f = None
+        for self.filepath, self.size in self.files:
+            self.f = open_partial(self.filepath, 0)
+            self.left = self.size
+            self.converter = TextModeConverter() if self.is_text_mode else None
+            if self.left:
+                return
+            self.complete()
+
+    def complete(self) -> None:
+        with self.f:
+            if self.converter:
+                self.f.write(self.converter.finish())
+        self.f = None
+        complete_partial(self.filepath, None if self.is_text_mode else self.size)
+
+    def update(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            if self.f is None:
+                raise ValueError('Received more data than files of the batch hold!')
+            piece, view = view[:self.left], view[self.left:]
+            self.left -= len(piece)
+            self.f.write(self.converter.update(bytes(piece)) if self.converter else piece)
+            if not self.left:
+                self.complete()
+                self.open_next()
+
+    def finish(self) -> None:
+        if self.f is not None:
+            raise ValueError(f'Stream ended in the middle of {self.filepath}!')
+
+    def close(self) -> None:
+        """
+        Closes partial file of unfinished transfer, it is kept on disk.
+        """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def send_files(channel: DataChannel, stream_id: int, files: Sequence[Tuple[str, int]], encryptor: Encryptor) -> None:
+    """
+    Sends files back to back as one stream, receiver splits it by sizes of files.
+    """
+    send_stream(channel, stream_id, read_files_chunks(files), encryptor)
+
+
+def receive_files(frames: Iterable[bytes], files: Sequence[Tuple[str, int]], decryptor: Decryptor,
+                  is_text_mode: bool = False) -> None:
+    writer = BatchWriter(files, is_text_mode)
+    try:
+        for data in receive_stream(frames, decryptor):
+            writer.update(data)
+        writer.finish()
+    finally:
+        writer.close()
+
+
+def send_batch_striped(channels: List[DataChannel], stream_id: int, files: Sequence[Tuple[str, int]],
+                       new_encryptor: Callable[[], Encryptor]) -> None:
+    """
+    Sends batch of files split into one group per channel, groups are sent in parallel on streams with the same id.
+    """
+    run_stripes(send_files, [(channel, stream_id, group, new_encryptor())
+                             for channel, group in zip(channels, split_batch(files, len(channels)))])
+
+
+def receive_batch_striped(streams: List[Iterable[bytes]], files: Sequence[Tuple[str, int]],
+                          new_decryptor: Callable[[], Decryptor], is_text_mode: bool = False) -> None:
+    run_stripes(receive_files, [(frames, group, new_decryptor(), is_text_mode)
+                                for frames, group in zip(streams, split_batch(files, len(streams)))])
+
+
+async def async_send_file(channel: AsyncDataChannel, stream_id: int, f: BinaryIO, offset: int, length: int,
+                          encryptor: Encryptor, compressor=None) -> None:
+    """
+    Event loop version of send_file. Disk reads are done in default executor, so slow disk does not stall the loop.
+    """
+    if compressor is not None:
+        # Compression takes CPU time, so it is done in default executor together with reads
+        await async_send_stream(channel, stream_id, compress_chunks(read_range_chunks(f, offset, length), compressor),
+                                encryptor)
+        return
+
+    loop = asyncio.get_running_loop()
+    end = offset + length
+    try:
+        if encryptor.zero_copy and channel.can_send_file():
+            await channel.send_file(stream_id, f, offset, length)
+            return
+
+        while offset < end:
+            chunk = await loop.run_in_executor(None, read_at, f, min(CHUNK_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            frame = encryptor.update(chunk)
+            if frame:
+                await channel.send(stream_id, frame)
+        frame = encryptor.finish()
+        if frame:
+            await channel.send(stream_id, frame)
+    finally:
+        await channel.send(stream_id, b'')
+
+
+def write_chunks(f: BinaryIO, chunks: Iterable[bytes], converter: Optional[TextModeConverter] = None) -> None:
+    for data in chunks:
+        f.write(converter.update(data) if converter else data)
+
+
+def write_chunks_at(f: BinaryIO, chunks: Iterable[bytes], offset: int) -> int:
+    """
+    Writes chunks from offset of file on and returns offset following them.
+    """
+    for data in chunks:
+        write_at(f, data, offset)
+        offset += len(data)
+    return offset
+
+
+async def async_receive_file(frames: AsyncIterable[bytes], f: BinaryIO, decryptor: Decryptor,
+                             is_text_mode: bool = False, decompressor: Optional[Decompressor] = None) -> None:
+    """
+    Event loop version of receive_file. Data is decompressed and written in default executor.
+    """
+    loop = asyncio.get_running_loop()
+    converter = TextModeConverter() if is_text_mode else None
+    async for frame in frames:
+        data = decryptor.update(frame) if frame else decryptor.finish()
+        if data:
+            chunks = decompressor.update(data, CHUNK_SIZE) if decompressor else [data]
+            await loop.run_in_executor(None, write_chunks, f, chunks, converter)
+        if not frame:
+            break
+    if decompressor:
+        decompressor.finish()
+    if converter:
+        await loop.run_in_executor(None, f.write, converter.finish())
+
+
+async def async_receive_range(frames: AsyncIterable[bytes], f: BinaryIO, offset: int, decryptor: Decryptor,
+                              decompressor: Optional[Decompressor] = None) -> None:
+    loop = asyncio.get_running_loop()
+    async for frame in frames:
+        data = decryptor.update(frame) if frame else decryptor.finish()
+        if data:
+            chunks = decompressor.update(data, CHUNK_SIZE) if decompressor else [data]
+            offset = await loop.run_in_executor(None, write_chunks_at, f, chunks, offset)
+        if not frame:
+            break
+    if decompressor:
+        decompressor.finish()
+
+
+async def async_send_file_striped(channels: List[AsyncDataChannel], stream_id: int, f: BinaryIO, size: int,
+                                  new_encryptor: Callable[[], Encryptor], start: int = 0,
+                                  new_compressor: Optional[Callable] = None) -> None:
+    """
+    Event loop version of send_file_striped.
+    """
+    await asyncio.gather(*(async_send_file(channel, stream_id, f, offset, length, new_encryptor(),
+                                           new_compressor() if new_compressor else None)
+                           for channel, (offset, length) in zip(channels, split_ranges(size, len(channels), start))))
+
+
+async def async_receive_file_striped(streams: List[AsyncIterable[bytes]], f: BinaryIO, size: int,
+                                     new_decryptor: Callable[[], Decryptor], is_text_mode: bool = False,
+                                     start: int = 0, new_decompressor: Optional[Callable[[], Decompressor]] = None
+                                     ) -> None:
+    """
+    Event loop version of receive_file_striped.
+    """
+    if is_text_mode:
+        await async_receive_file(streams[0], f, new_decryptor(), is_text_mode,
+                                 new_decompressor() if new_decompressor else None)
+        return
+
+    await asyncio.gather(*(async_receive_range(frames, f, offset, new_decryptor(),
+                                               new_decompressor() if new_decompressor else None)
+                           for frames, (offset, _) in zip(streams, split_ranges(size, len(streams), start))))
+
+
+async def async_send_stream(channel: AsyncDataChannel, stream_id: int, chunks: Iterator[bytes],
+                            encryptor: Encryptor) -> None:
+    """
+    Event loop version of send_stream. Chunks are produced in default executor, so reading disk does not stall
+    the loop.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            frame = encryptor.update(chunk)
+            if frame:
+                await channel.send(stream_id, frame)
+        frame = encryptor.finish()
+        if frame:
+            await channel.send(stream_id, frame)
+    finally:
+        await channel.send(stream_id, b'')
+
+
+async def async_send_files(channel: AsyncDataChannel, stream_id: int, files: Sequence[Tuple[str, int]],
+                           encryptor: Encryptor) -> None:
+    """
+    Event loop version of send_files.
+    """
+    await async_send_stream(channel, stream_id, read_files_chunks(files), encryptor)
+
+
+async def async_receive_files(frames: AsyncIterable[bytes], files: Sequence[Tuple[str, int]], decryptor: Decryptor,
+                              is_text_mode: bool = False) -> None:
+    loop = asyncio.get_running_loop()
+    # Partial files are opened and completed in default executor
+    writer = await loop.run_in_executor(None, BatchWriter, files, is_text_mode)
+    try:
+        async for frame in frames:
+            data = decryptor.update(frame) if frame else decryptor.finish()
+            if data:
+                await loop.run_in_executor(None, writer.update, data)
+            if not frame:
+                break
+        writer.finish()
+    finally:
+        await loop.run_in_executor(None, writer.close)
+
+
+async def async_send_batch_striped(channels: List[AsyncDataChannel], stream_id: int,
+                                   files: Sequence[Tuple[str, int]], new_encryptor: Callable[[], Encryptor]) -> None:
+    await asyncio.gather(*(async_send_files(channel, stream_id, group, new_encryptor())
+                           for channel, group in zip(channels, split_batch(files, len(channels)))))
+
+
+async def async_receive_batch_striped(streams: List[AsyncIterable[bytes]], files: Sequence[Tuple[str, int]],
+                                      new_decryptor: Callable[[], Decryptor], is_text_mode: bool = False) -> None:
+    await asyncio.gather(*(async_receive_files(frames, group, new_decryptor(), is_text_mode)
+                           for frames, group in zip(streams, split_batch(files, len(streams)))))